@@ -24,6 +24,7 @@ Created on Tue Dec 29 16:05:19 2015
 
 
 from FeatureUtils import *
+from featureStore import get_feature_store
 import numpy as np
 from sklearn.preprocessing import scale
 
@@ -40,9 +41,10 @@ def generateInput_v1(fout=False):
     """
     Generate complete observation matrix
     """
-    des, X = generate_corina_features('ca')
+    store = get_feature_store(2010, 'ca')
+    des, X = store.get('demographics')
     
-    F_dist = generate_geographical_SpatialLag_ca()
+    F_dist = store.get('spatial')[1]
     F_flow = generate_transition_SocialLag(year=2010, lehd_type=0, region='ca')
     
     
@@ -215,8 +217,9 @@ def generateInput_v2(fout=False):
     """
     Generate complete observation matrix
     """
-    des, X = generate_corina_features('ca')
-    F_dist = generate_geographical_SpatialLag_ca()
+    store = get_feature_store(2010, 'ca')
+    des, X = store.get('demographics')
+    F_dist = store.get('spatial')[1]
     F_flow = generate_transition_SocialLag(year=2010, lehd_type=0, region='ca')
 
     Y = retrieve_crime_count(year=2010, col=['total'], region='ca')
@@ -361,8 +364,9 @@ def generateInput_v3(fout=False):
     """
     Generate complete observation matrix
     """
-    des, X = generate_corina_features('ca')
-    F_dist = generate_geographical_SpatialLag_ca()
+    store = get_feature_store(2010, 'ca')
+    des, X = store.get('demographics')
+    F_dist = store.get('spatial')[1]
     F_flow = generate_transition_SocialLag(year=2010, lehd_type=0, region='ca')
 
     Y = retrieve_crime_count(year=2010, col=['total'], region='ca')
@@ -613,7 +617,7 @@ CRF model version 4
 ========================================================================== """
 
 
-from taxiFlow import getTaxiFlow
+from taxiFlow import getTaxiFlow, taxi_flow_normalization
 from foursquarePOI import getFourSquareCount, getFourSquarePOIDistribution
 
 
@@ -634,19 +638,20 @@ def generateInput_v4(fout=False):
     """
     Generate complete observation matrix
     """
-    des, X = generate_corina_features('ca')
+    store = get_feature_store(2010, 'ca')
+    des, X = store.get('demographics')
     pvt = X[:,2]    # poverty index of each CA
     popul = X[:,0].reshape(X.shape[0],1)
     
 #    poi_cnt = getFourSquareCount()
 #    poi_cnt = np.divide(poi_cnt, popul) * 10000
     
-    poi_dist = getFourSquarePOIDistribution()
+    poi_dist = store.get('poi')[1]
     poi_dist = np.divide(poi_dist, popul) * 10000
     
-    F_dist = generate_geographical_SpatialLag_ca()
+    F_dist = store.get('spatial')[1]
     F_flow = generate_transition_SocialLag(year=2010, lehd_type=0, region='ca')
-    F_taxi = getTaxiFlow()
+    F_taxi = taxi_flow_normalization(np.array(store.get('taxi')[1]))
 
     Y = retrieve_crime_count(year=2010, col=['total'], region='ca')
     Y = np.divide(Y, popul) * 10000
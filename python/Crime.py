@@ -6,66 +6,112 @@ Extract crime count by tracts.
 """
 
 import numpy as np
-from shapely.geometry import Point
+import pandas as pd
 from tract import Tract
+from regionAssign import assign_regions, region_index
 import sys
 import os
 here = os.path.dirname(os.path.abspath(__file__))
 
 
-class CrimeRecord:
+
+"""
+Column layout of the raw file Crimes_-_2001_to_present.csv.
+
+The per-year files written by older versions of splitFileIntoYear have no
+header line, so we fall back to the column positions below.
+"""
+CRIME_COLUMNS = {'Date': 2, 'Primary Type': 5, 'Latitude': 19, 'Longitude': 20}
+CRIME_DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+
+
+
+def hasCrimeHeader( fname ):
+    with open(fname, 'r') as fin:
+        return fin.readline().startswith('ID,')
+
+
+
+def readCrimeBlocks( fname, chunksize=500000 ):
+    """
+    Read the crime file in column blocks of at most `chunksize` records.
     
-    cntBadRecord = 0    # record without GPS is bad
-    cntTotal = 0
-    CrimeType = ['total']
-
-    def __init__( self, line ):
-        ls = line.split(",")
-        if len(ls) > 21:
-            try:
-                self.point = Point( float(ls[-3]), float(ls[-4]) )  # longitude, latitude
-                self.id = ls[0]
-                self.caseNumber = ls[1]
-                self.date = ls[2]
-                self.type = ls[5]
-                if self.type not in CrimeRecord.CrimeType:
-                    CrimeRecord.CrimeType.append(self.type)
-                CrimeRecord.cntTotal += 1
-            except ValueError:
-                self.id = None
-                CrimeRecord.cntBadRecord += 1
-        else:
-            self.id = None
-        
-        
-    def __str__( self ):
-        return ' '.join( [self.id, self.caseNumber, self.date, self.type, self.lat, self.lon ] )
-        
-        
-    def getDateField(self, field):
-        """
-        Get month/day/year/hour/miniute/second field from date
-        """
-        if field == 'hour':
-            hour = int(self.date[11:13])
-            # is it PM?
-            if hour < 12 and self.date[20:22] == 'PM':
-                delta = 12
-            elif hour == 12 and self.date[20:22] == 'AM':
-                delta = -12
-            else:
-                delta = 0
-            return hour + delta
-        else:
-            return self.date
-            
+    Quoted fields (e.g. the Location column) are handled by the csv parser.
+    Each block is a pandas DataFrame with the columns
+        date - parsed datetime64
+        type - categorical crime type
+        lat  - float latitude, NaN if the record has no GPS
+        lon  - float longitude, NaN if the record has no GPS
+    """
+    names = ['Date', 'Primary Type', 'Latitude', 'Longitude']
+    if hasCrimeHeader(fname):
+        reader = pd.read_csv(fname, usecols=names, dtype=str, chunksize=chunksize)
+    else:
+        reader = pd.read_csv(fname, header=None, usecols=[CRIME_COLUMNS[c] for c in names],
+                             dtype=str, chunksize=chunksize)
+    for chunk in reader:
+        chunk.columns = names   # both ways keep the file order of the columns
+        block = pd.DataFrame({
+            'date': pd.to_datetime(chunk['Date'], format=CRIME_DATE_FORMAT, errors='coerce'),
+            'type': chunk['Primary Type'].astype('category'),
+            'lat': pd.to_numeric(chunk['Latitude'], errors='coerce'),
+            'lon': pd.to_numeric(chunk['Longitude'], errors='coerce')},
+            columns=['date', 'type', 'lat', 'lon'])
+        yield block
+
         
 
         
 class CrimeDataset:
     
-    def __init__( self, fname ):
-        self.f = open( fname, 'r' )
+    def __init__( self, fname, chunksize=500000 ):
+        self.fname = fname
+        self.chunksize = chunksize
+        self.cntBadRecord = 0    # record without GPS is bad
+        self.cntTotal = 0
+        self.crimeTypes = set(['total'])
+        
+        
+    def blocks( self ):
+        """
+        Yield the blocks of valid crime records
+        """
+        for block in readCrimeBlocks(self.fname, self.chunksize):
+            good = block['lat'].notnull() & block['lon'].notnull() & block['date'].notnull()
+            self.cntBadRecord += int((~good).sum())
+            block = block[good]
+            self.cntTotal += len(block)
+            self.crimeTypes.update(block['type'].unique())
+            yield block
+        
+        
+    def countBlock( self, block, areas, hour=False ):
+        """
+        Count the crimes of one block per (area, crime type [, hour of day])
+        
+        Output:
+            a list of (area ID, crime type, [hour,] count)
+        """
+        ordKey = sorted(areas.keys())
+        ridx = region_index(assign_regions(block['lon'].values, block['lat'].values, areas), ordKey)
+        # a missing crime type has the categorical code -1
+        valid = (ridx != -1) & (block['type'].cat.codes.values >= 0)
+        categories = block['type'].cat.categories
+        codes = block['type'].cat.codes.values[valid].astype(int)
+        key = ridx[valid] * len(categories) + codes
+        if hour:
+            key = key * 24 + block['date'].dt.hour.values[valid]
+        uniq, cnts = np.unique(key, return_counts=True)
+        res = []
+        for k, c in zip(uniq.tolist(), cnts.tolist()):
+            if hour:
+                k, h = divmod(k, 24)
+            r, t = divmod(k, len(categories))
+            if hour:
+                res.append((ordKey[r], categories[t], h, c))
+            else:
+                res.append((ordKey[r], categories[t], c))
+        return res
         
         
     def crimeCount_PerTract( self, tracts ):
@@ -75,16 +121,11 @@ class CrimeDataset:
         Input:
             tracts - a map of tract ID to tract object
         """
-        for line in self.f:
-            cr = CrimeRecord( line )
-            if cr.id != None:
-                for tract in tracts.values():
-                    if tract.containCrime (cr):
-                        tract.count['total'] += 1
-                        if cr.type not in tract.count:
-                            tract.count[cr.type] = 1
-                        else:
-                            tract.count[cr.type] += 1
+        for block in self.blocks():
+            for key, tp, cnt in self.countBlock(block, tracts):
+                tract = tracts[key]
+                tract.count['total'] += cnt
+                tract.count[tp] = tract.count.get(tp, 0) + cnt
                             
 
 
@@ -93,35 +134,35 @@ class CrimeDataset:
         Generate the temporal distribution of crime occurrences over 
         each category for each area
         """
-        for line in self.f:
-            cr = CrimeRecord(line)
-            if cr.id != None:
-                for area in areas.values():
-                    if area.containCrime(cr):
-                        hoc = cr.getDateField('hour')
-                        if cr.type not in area.timeHist:
-                            area.timeHist[cr.type] = np.zeros(24)
-                        area.timeHist[cr.type][hoc] += 1
-                        area.timeHist['total'][hoc] += 1
+        for block in self.blocks():
+            for key, tp, hoc, cnt in self.countBlock(block, areas, hour=True):
+                area = areas[key]
+                if tp not in area.timeHist:
+                    area.timeHist[tp] = np.zeros(24)
+                area.timeHist[tp][hoc] += cnt
+                area.timeHist['total'][hoc] += cnt
                         
                         
             
         
         
     @classmethod
-    def splitFileIntoYear( cls, rawfileName ):
+    def splitFileIntoYear( cls, rawfileName, chunksize=500000 ):
         """
         Split the raw file according to the year filed
+        
+        The raw columns are copied as strings, and every year file keeps the
+        header line of the raw file.
         """
-        cls.f = open(rawfileName, 'r')
-        header = cls.f.readline()  # get rid of header line
         years = {}
-        for line in cls.f:
-            cr = CrimeRecord(line)
-            year = cr.date[6:10]
-            if year not in years:
-                years[year] = open(here + '/../data/chicago-crime-{0}.csv'.format(year), 'w')
-            years[year].write(line)
+        for chunk in pd.read_csv(rawfileName, dtype=str, keep_default_na=False,
+                                 chunksize=chunksize):
+            for year, rows in chunk.groupby(chunk['Date'].str[6:10]):
+                if year not in years:
+                    years[year] = open(here + '/../data/chicago-crime-{0}.csv'.format(year), 'w')
+                    rows.to_csv(years[year], index=False)
+                else:
+                    rows.to_csv(years[year], index=False, header=False)
             
         for F in years.values():
             F.close()
@@ -145,7 +186,15 @@ def main():
         print """Usage: Crime.py [options] [value]
         Possible options:
             year       e.g. 2010 default '2010'
-            splitfile  e.g. true default false"""
+            splitfile  e.g. true default false
+            cube       e.g. true default false"""
+
+    if 'cube' in arguments:
+        if arguments['cube'] == 'true':
+            # all years, tract and CA level in one pass
+            from crimeCube import build_crime_cube
+            build_crime_cube(here + '/../data/Crimes_-_2001_to_present.csv')
+            return 0
 
     if 'splitfile' in arguments:
         if arguments['splitfile'] == 'true':
@@ -165,8 +214,7 @@ def main():
     c = CrimeDataset(here + '/../data/chicago-crime-{0}.csv'.format(year))
     T = Tract.createAllTractObjects()
     c.crimeCount_PerTract(T)    
-    CrimeRecord.CrimeType.sort()
-    cntKey = CrimeRecord.CrimeType
+    cntKey = sorted(c.crimeTypes)
     print 'Write tract level crime file for year {0}'.format(year)
     print len(cntKey), cntKey
         
@@ -182,25 +230,37 @@ def main():
             fout.write(','.join( [str(k)] + cntstr ))
             fout.write("\n")
             
-    print "Bad records: {0}".format(CrimeRecord.cntBadRecord)
-    print "Total records: {0}".format(CrimeRecord.cntTotal)          
+    print "Bad records: {0}".format(c.cntBadRecord)
+    print "Total records: {0}".format(c.cntTotal)          
 
 
 
 
 def crime_time_histogram(year=2010):
-    CA = Tract.createAllCAObjects()
-    c = CrimeDataset("../data/chicago-crime-{0}.csv".format(year))
-    c.temporalDistribution_perTract_perCategory(CA)
+    """
+    Hourly crime count of each CA, shape (24, 77)
     
-    hourlyCrime = []
-    for h in range(24):
-        hlist = []
-        for i in range(1, 78):
-            hlist.append(CA[i].timeHist['total'][h])
-        hourlyCrime.append(hlist)
-        
-    hourlyCrime = np.array(hourlyCrime)
+    Read from the crime cube if it is built, otherwise parse the year file.
+    The CA counts of the cube are aggregated from the tracts, so a crime in a
+    tract without a CA reference is not counted, unlike with the CA polygons.
+    """
+    from crimeCube import load_crime_cube
+    cube = load_crime_cube()
+    if cube is not None and int(year) in cube.years:
+        hourlyCrime = cube.hourly(year, region='ca').astype(float)
+    else:
+        CA = Tract.createAllCAObjects()
+        c = CrimeDataset(here + "/../data/chicago-crime-{0}.csv".format(year))
+        c.temporalDistribution_perTract_perCategory(CA)
+        
+        hourlyCrime = []
+        for h in range(24):
+            hlist = []
+            for i in range(1, 78):
+                hlist.append(CA[i].timeHist['total'][h])
+            hourlyCrime.append(hlist)
+            
+        hourlyCrime = np.array(hourlyCrime)
     import pickle
     pickle.dump(hourlyCrime, open("chicago-hourly-crime-{0}.pickle".format(year), 'w'))
     return hourlyCrime
@@ -12,10 +12,14 @@ various functions for generating feature matrices/vectors
 """
 
 from Crime import Tract
+from tract import getRegionLayer
+from crimeCube import load_crime_cube
 import numpy as np
+import warnings
+from scipy.spatial.distance import cdist
+from scipy import sparse
 import csv
 from openpyxl import load_workbook
-import heapq
 import pickle
 
 
@@ -30,7 +34,8 @@ def generate_corina_features(region='ca', leaveOut=-1):
 
     parameter region taks 'ca' or 'tract'
 
-    Return values are field description, value array
+    Return values are field description, value array. The tract rows follow
+    the sorted tract IDs (see tract_demographics).
     """
     if region == 'ca':
         f = open(here + '/../data/Chicago_demographics.csv', 'r')
@@ -55,26 +60,101 @@ def generate_corina_features(region='ca', leaveOut=-1):
 
         return  fields_dsp, C
     elif region == 'tract':
-        from pandas import read_stata
+        fields_dsp, ids, C, present = tract_demographics()
+        return fields_dsp, np.array(C)
 
-        r = read_stata('../data/SE2000_AG20140401_MSAcmsaID.dta')
-        cnt = 0
-        header = ['pop00', 'ppov00', 'disadv00', 'pdensmi00', 'hetero00', 'phisp00', 'pnhblk00']
+
+
+TRACT_DEMO_FILE = here + '/../data/SE2000_AG20140401_MSAcmsaID.dta'
+TRACT_DEMO_CACHE = here + '/../data/chicago-tract-demographics.npz'
+_tract_demographics = {}
+
+def tract_demographics(fname=TRACT_DEMO_FILE, cache=TRACT_DEMO_CACHE):
+    """
+    Demographics of the Cook County tracts from the national Stata file.
+    
+    Only the needed columns are read, and the Cook County rows are saved to
+    `cache`. The Stata file is parsed again only when it changes. The rows
+    are aligned to the sorted tract IDs of the tract layer, and the tracts
+    missing from the file have rows of zeros.
+    
+    Return values are field description, sorted tract IDs, read-only value
+    array, boolean array of the tracts found in the file
+    """
+    header = ['pop00', 'ppov00', 'disadv00', 'pdensmi00', 'hetero00', 'phisp00', 'pnhblk00']
+    fields_dsp = ['total population', 'poverty index', 'disadvantage index',
+                  'population density', 'ethnic diversity', 'pct hispanic', 'pct black']
+    
+    mtime = os.path.getmtime(fname)
+    if fname not in _tract_demographics or _tract_demographics[fname][0] != mtime:
+        tid = vals = None
+        if os.path.exists(cache):
+            data = np.load(cache)
+            if data['mtime'] == mtime:
+                tid, vals = data['tract'], data['values']
+        if tid is None:
+            r = pd.read_stata(fname, columns=['statetrim', 'countrim', 'tracttrim'] + header)
+            r = r[(r['statetrim'] == '17').values & (r['countrim'] == '031').values]
+            tid = ('17031' + r['tracttrim']).astype(np.int64).values
+            vals = r[header].values.astype(float)
+            np.savez(cache, tract=tid, values=vals, mtime=mtime)
         
-        fields_dsp = ['total population', 'poverty index', 'disadvantage index',
-                      'population density', 'ethnic diversity', 'pct hispanic', 'pct black']
+        ids = np.array(getRegionLayer('tract').ids)
+        pos = np.minimum(np.searchsorted(ids, tid), len(ids) - 1)
+        valid = ids[pos] == tid
+        C = np.zeros((len(ids), len(header)))
+        C[pos[valid]] = vals[valid]
+        present = np.zeros(len(ids), dtype=bool)
+        present[pos[valid]] = True
+        C.flags.writeable = False
+        present.flags.writeable = False
+        _tract_demographics[fname] = (mtime, (fields_dsp, ids.tolist(), C, present))
+    return _tract_demographics[fname][1]
+
+
+
+_centroid_distance = {}
+
+def get_centroid_distance(region='ca'):
+    """
+    Pairwise distance matrix between the region centroids, computed once per
+    process. Rows and columns follow the sorted region IDs.
+    
+    Return values are the read-only distance matrix, sorted region IDs
+    """
+    if region not in _centroid_distance:
+        layer = getRegionLayer(region)
+        D = cdist(layer.centroids, layer.centroids)
+        D.flags.writeable = False
+        _centroid_distance[region] = (D, layer.ids)
+    return _centroid_distance[region]
+
+
+
+def leaveOut_mask(n, leaveOut=-1):
+    """
+    Index of the regions kept when region `leaveOut` (1 to n) is left out
+    """
+    keep = np.arange(n)
+    if leaveOut > 0:
+        keep = keep[keep != leaveOut-1]
+    return keep
+
 
-        ST = {}
-        for row in r.iterrows():
-            tract = row[1]
-            if tract['statetrim'] == '17' and tract['countrim'] == '031':
-                cnt += 1
-                tl = []
-                tid = long('17031' + tract['tracttrim'])
-                for h in header:
-                    tl.append(tract[h])
-                ST[tid] = tl
-        return fields_dsp, ST
+
+def inverse_distance_weight(D, knearest=None):
+    """
+    Inverse distance weight 1/d_ij with zero diagonal.
+    
+    If knearest is given, only keep the weights of the k-nearest neighbors
+    in each row.
+    """
+    W = np.zeros(D.shape)
+    np.divide(1., D, out=W, where=D > 0)
+    if knearest is not None:
+        threshold = np.sort(W, axis=1)[:, -knearest]
+        W[W < threshold[:,None]] = 0
+    return W
 
 
 
@@ -82,16 +162,8 @@ def generate_geographical_SpatialLag():
     """
     Generate the spatial lag from the geographically adjacent regions.
     """
-    ts = Tract.createAllTractObjects()
-    ordkey = sorted(ts)
-    centers = [ts[k].polygon.centroid for k in ordkey]
-
-    W = np.zeros((len(centers), len(centers)))
-    for i, src in enumerate(centers):
-        for j, dst in enumerate(centers):
-            if src != dst:
-                W[i][j] = 1 / src.distance(dst)
-    return W, ordkey
+    D, ordkey = get_centroid_distance('tract')
+    return inverse_distance_weight(D), list(ordkey)
 
 
 
@@ -104,35 +176,41 @@ def generate_geographical_SpatialLag_ca(knearest=True, leaveOut=-1):
 
     leaveOut will select the CA and remove it. take value from 1 to 77
     """
-    cas = Tract.createAllCAObjects()
-    centers = []
-    iset = range(1, 78)
-    if leaveOut > 0:
-        iset.remove(leaveOut)
-    for i in iset:
-        centers.append(cas[i].polygon.centroid)
-    
-    W = np.zeros( (len(iset),len(iset)) )
-    for i, src in enumerate(centers):
-        for j, dst in enumerate(centers):
-            if src != dst:
-                W[i][j] = 1 / src.distance(dst)
-                
-        # find n-largest (n=6)
-        if knearest == True:
-            threshold = heapq.nlargest(6, W[i,:])[-1]
-            for j in range(len(W[i,:])):
-                W[i][j] = 0 if W[i][j] < threshold else W[i][j]
-    return W
+    D, ordkey = get_centroid_distance('ca')
+    keep = leaveOut_mask(len(ordkey), leaveOut)
+    D = D[np.ix_(keep, keep)]
+    return inverse_distance_weight(D, 6 if knearest == True else None)
+    
+
+_contiguity = {}
+
+def generate_contiguity_SpatialLag_ca(snap=np.sqrt(np.finfo(float).eps)):
+    """
+    Binary contiguity matrix of the CAs, computed once per process.
+    
+    Two CAs are neighbors if their boundaries share at least one point
+    within the snap distance, as the queen contiguity of R spdep poly2nb.
+    """
+    if snap not in _contiguity:
+        layer = getRegionLayer('ca')
+        n = len(layer.ids)
+        A = np.zeros((n, n))
+        b = layer.bounds
+        for i in range(n):
+            for j in range(i+1, n):
+                if b[i,0] - snap > b[j,2] or b[j,0] - snap > b[i,2] or \
+                        b[i,1] - snap > b[j,3] or b[j,1] - snap > b[i,3]:
+                    continue
+                if layer.polygon[layer.ids[i]].distance(layer.polygon[layer.ids[j]]) <= snap:
+                    A[i,j] = A[j,i] = 1
+        A.flags.writeable = False
+        _contiguity[snap] = A
+    return _contiguity[snap]
+    
     
 
 def get_centroid_ca():
-    cas = Tract.createAllCAObjects()
-    centers = []
-    for i in range(1, 78):
-        ctd = cas[i].polygon.centroid
-        centers.append([ctd.x, ctd.y])
-    return centers
+    return getRegionLayer('ca').centroids.tolist()
 
         
 
@@ -140,17 +218,8 @@ def generate_GWR_weight(h = 1):
     """
     Generate the GWR weighting matrix with exponential function.
     """
-    cas = Tract.createAllCAObjects()
-    centers = []
-    for i in range(1, 78):
-        centers.append(cas[i].polygon.centroid)
-    
-    gamma = np.ones((len(centers), len(centers)))
-    for i, src in enumerate(centers):
-        for j, dst in enumerate(centers):
-            if i != j:
-                gamma[i][j] = np.exp(-0.5 * src.distance(dst)**2 / h**2)
-    return gamma
+    D, ordkey = get_centroid_distance('ca')
+    return np.exp(-0.5 * D**2 / h**2)
     
     
 def generate_geo_graph_embedding_src():
@@ -163,8 +232,55 @@ def generate_geo_graph_embedding_src():
                     fout.write('{0} {1} {2}\n'.format(i, j, flow[i,j]))
 
 
+_od_matrix = {}
+
+def load_od_matrix(year=2010, lehd_type=0, region='ca'):
+    """
+    Load the LEHD origin-destination counts of one year into a sparse CSR
+    matrix, cached per (year, lehd_type, region). Rows are the source
+    regions and columns are the destination regions, both in sorted ID
+    order.
+    
+    Return values are the read-only CSR matrix, sorted region IDs
+    """
+    key = (year, lehd_type, region)
+    if key not in _od_matrix:
+        if region == 'ca':
+            fn = here + '/../data/chicago_ca_od_{0}.csv'.format(year)
+        elif region == 'tract':
+            fn = here + '/../data/chicago_od_tract_{0}.csv'.format(year)
+        ordkey = getRegionLayer(region).ids
+        keyIdx = dict((k, i) for i, k in enumerate(ordkey))
+        
+        od = pd.read_csv(fn, header=None, usecols=[0, 1, 2 + lehd_type],
+                         dtype={0: str, 1: str})
+        src = np.array([keyIdx.get(int(v[5:]), -1) for v in od[0].values])
+        dst = np.array([keyIdx.get(int(v[5:]), -1) for v in od[1].values])
+        val = od[2 + lehd_type].values.astype(float)
+        valid = (src != -1) & (dst != -1)
+        n = len(ordkey)
+        W = sparse.csr_matrix((val[valid], (src[valid], dst[valid])), shape=(n, n))
+        W.data.flags.writeable = False
+        _od_matrix[key] = (W, ordkey)
+    return _od_matrix[key]
+
+
+
+def _row_normalize(W):
+    """
+    Divide each row of the sparse matrix by its sum. All-zero rows stay zero.
+    """
+    s = np.asarray(W.sum(axis=1)).ravel()
+    inv = np.zeros(len(s))
+    np.divide(1., s, out=inv, where=s != 0)
+    return sparse.diags(inv).dot(W).tocsr()
+
+
+
+_social_lag = {}
                     
-def generate_transition_SocialLag(year = 2010, lehd_type=0, region='ca', leaveOut=-1, normalization='source'):
+def generate_transition_SocialLag(year = 2010, lehd_type=0, region='ca', leaveOut=-1,
+                                  normalization='source', sparseOutput=False):
     """
     Generate the spatial lag matrix from the transition flow connected CAs.
     
@@ -178,70 +294,44 @@ def generate_transition_SocialLag(year = 2010, lehd_type=0, region='ca', leaveOu
     7 - #jobs in goods producing, 
     8 - #jobs in trade transportation, 
     9 - #jobs in other services
-    """
     
-    if region == 'ca':
-        ts = Tract.createAllCAObjects()
-        fn = here + '/../data/chicago_ca_od_{0}.csv'.format(year)
-    elif region == 'tract':
-        ts = Tract.createAllTractObjects()
-        fn = here + '/../data/chicago_od_tract_{0}.csv'.format(year)
-    ordkey = sorted(ts.keys())
-    
-    listIdx = {}
-    fin = open(fn)
-    for line in fin:
-        ls = line.split(",")
-        srcid = int(ls[0][5:])
-        dstid = int(ls[1][5:])
-        val = int(ls[2 + lehd_type])
-        if srcid in listIdx:
-            listIdx[srcid][dstid] = val
-        else:
-            listIdx[srcid] = {}
-            listIdx[srcid][dstid] = val                            
-    fin.close()
-
-    if leaveOut > 0:
-        ordkey.remove(leaveOut)
-    
-    W = np.zeros( (len(ts),len(ts)) )
-    for srcid in ordkey:
-        if srcid in listIdx:
-            sdict = listIdx[srcid]
-            if leaveOut in sdict:
-                del sdict[leaveOut]
-            for dstid, val in sdict.items():
-                W[ordkey.index(srcid)][ordkey.index(dstid)] = val
-        else:
-            W[ordkey.index(srcid)] = np.zeros( (1,len(ts)) )
-    
-    # update diagonal as 0
-#    if normalization != 'none':
-#        for i in range(len(W)):
-#            W[i,i] = 0
-    # first make all self-factor 0
-    assert W.dtype == "float64"
+    The matrix is built from the cached sparse OD counts, and the normalized
+    full matrix is cached too. Every call returns a new copy, as a dense
+    array or a CSR matrix if sparseOutput is True. Rows with no flow are
+    all zero after normalization.
+    
+    leaveOut removes the flows of that region, and the remaining regions
+    fill the first n-1 rows and columns.
+    """
+    key = (year, lehd_type, region, normalization)
+    if leaveOut > 0 or key not in _social_lag:
+        W, ordkey = load_od_matrix(year, lehd_type, region)
+        n = len(ordkey)
+        if leaveOut > 0:
+            keep = [i for i, k in enumerate(ordkey) if k != leaveOut]
+            sel = sparse.csr_matrix((np.ones(len(keep)), (range(len(keep)), keep)), shape=(n, n))
+            W = sel.dot(W).dot(sel.T).tocsr()
         
-    # normalization section
-    if normalization == 'source':
-        # source mean the residence
-        W = np.transpose(W)    
-        sW = np.sum(W, axis=1, keepdims=True)
-        W = W / sW
-        assert abs( np.sum(W[1,]) - 1 ) < 0.0000000001 and W.dtype == "float64"
-    elif normalization == 'destination': # 
-        # destination mean workplace
-        sW = np.sum(W, axis=1)
-        sW = sW.reshape((len(sW),1))
-        W = W / sW
-    elif normalization == 'pair':
-        sW = W + np.transpose(W)
-        sW = np.sum(sW)
-        W = W / sW
+        # normalization section
+        if normalization == 'source':
+            # source mean the residence
+            W = _row_normalize(W.T.tocsr())
+        elif normalization == 'destination':
+            # destination mean workplace
+            W = _row_normalize(W)
+        elif normalization == 'pair':
+            W = W / (2 * W.sum())
+        W = W.tocsr()
+        if leaveOut > 0:
+            return W if sparseOutput else W.toarray()
+        _social_lag[key] = W
     
     # by default, the output is the workplace-to-residence count matrix
-    return W
+    W = _social_lag[key]
+    if sparseOutput:
+        return W.copy()
+    return W.toarray()
+
 
 
 import pandas as pd
@@ -255,6 +345,18 @@ def retrieve_health_data():
 
 
 
+def crime_columns(header, col):
+    """
+    Column indices of the crime types `col` in the header of a per-year
+    crime file, the types not in the file are skipped with a warning
+    """
+    missing = [c for c in col if c not in header]
+    if missing:
+        warnings.warn("Crime types {0} are not in the crime file".format(missing))
+    return [header.index(c) for c in col if c in header]
+
+
+
 def retrieve_crime_count(year, col=['total'], region='ca'):
     """
     Retrieve the crime count in a vector
@@ -265,16 +367,26 @@ def retrieve_crime_count(year, col=['total'], region='ca'):
         
     Output:
         if region == 'ca':  Y is a column vector of size (77,1)
+        if region == 'tract':  Y is a map of tract ID to count
+        
+    The counts are sliced from the crime cube (see crimeCube.py) if it is
+    built, otherwise they are read from the per-year region level files.
+    Either way, the crime types of `col` that are not in the data are
+    skipped with a warning.
     """
+    cube = load_crime_cube()
+    if cube is not None and int(year) in cube.years:
+        cnt = cube.count(year, col, region)
+        if region == 'ca':
+            return cnt.reshape((77,1)).astype(float)
+        elif region == 'tract':
+            return dict(zip(cube.ids['tract'], cnt.tolist()))
+    
     if region == 'ca':
         Y =np.zeros( (77,1) )
         with open(here + '/../data/chicago-crime-ca-level-{0}.csv'.format(year)) as fin:
             header = fin.readline().strip().split(",")
-            crime_idx = []
-            for c in col:
-                if c in header:
-                    i = header.index(c)
-                    crime_idx.append(i)
+            crime_idx = crime_columns(header, col)
             for line in fin:
                 ls = line.split(",")
                 idx = int(ls[0])
@@ -289,10 +401,7 @@ def retrieve_crime_count(year, col=['total'], region='ca'):
         Y = {}
         with open(here + '/../data/chicago-crime-tract-level-{0}.csv'.format(year)) as fin:
             header = fin.readline().strip().split(",")
-            crime_idx = []
-            for c in col:
-                i = header.index(c)
-                crime_idx.append(i)
+            crime_idx = crime_columns(header, col)
             for line in fin:
                 ls = line.split(",")
                 tid = int(ls[0])
@@ -305,6 +414,63 @@ def retrieve_crime_count(year, col=['total'], region='ca'):
 
 
 
+_xlsx_table = {}
+
+def read_xlsx_table(fname, headerRange, valueRange):
+    """
+    Read the header cells and the value cells of the active sheet of an xlsx
+    file. The first import saves both into fname.npz, and later calls read
+    the cache, until the xlsx file changes. The table is also kept in memory
+    once per process.
+    
+    Return values are the header list, read-only float array of the values
+    """
+    mtime = os.path.getmtime(fname)
+    cache = os.path.splitext(fname)[0] + '.npz'
+    if fname in _xlsx_table and _xlsx_table[fname][0] == mtime:
+        return _xlsx_table[fname][1]
+    
+    header = values = None
+    if os.path.exists(cache):
+        data = np.load(cache)
+        if data['mtime'] == mtime and data['ranges'].tolist() == [headerRange, valueRange]:
+            header = [unicode(h) for h in data['header']]
+            values = data['values']
+    if values is None:
+        wb = load_workbook(fname)
+        ws = wb.active
+        h0, h1 = headerRange.split(':')
+        header = [c.value for c in tuple(ws[h0:h1])[0]]
+        values = np.array([[c.value for c in row] for row in ws.iter_rows(valueRange)],
+                          dtype=float)
+        header = [unicode(h) for h in header]
+        np.savez(cache, header=np.array(header), values=values, mtime=mtime,
+                 ranges=np.array([headerRange, valueRange]))
+    values.flags.writeable = False
+    _xlsx_table[fname] = (mtime, (header, values))
+    return header, values
+
+
+
+def grouped_stats(counts, total, bins):
+    """
+    Grouped mean and standard deviation of each row of the histogram counts.
+    
+    Input:
+        counts - N x k counts of the k groups
+        total - N total counts
+        bins - the value of each group
+    Output:
+        N x 2 array of mean, std
+    """
+    bins = np.asarray(bins, dtype=float)
+    total = np.ravel(total)
+    mean = counts.dot(bins) / total
+    std = np.sqrt( (counts * (bins[None,:] - mean[:,None])**2).sum(axis=1) / total )
+    return np.column_stack((mean, std))
+
+
+
 def retrieve_income_features():
     """
     read the xlsx file: ../data/chicago-ca-income.xlsx
@@ -314,27 +480,15 @@ def retrieve_income_features():
     2. probability distribution over all categories (normalize by population)
     3. Grouped mean, variance    
     """
-    wb = load_workbook(here + "/../data/chicago-ca-income.xlsx")
-    ws = wb.active
-    header = ws['l3':'aa3']
-    header = [c.value for c in tuple(header)[0]]
+    header, T = read_xlsx_table(here + "/../data/chicago-ca-income.xlsx", 'l3:aa3', 'k4:aa80')
     
     bins = [5000, 12500, 17500, 22500, 27500, 32500, 37500, 42500, 47500, 55000, 67500,
             87500, 112500, 137500, 175000, 300000]
 #    bins = range(1,17)
-    l = len(header)
-    I = np.zeros((77,l))
     stats_header = ['income mean', 'std var']
-    stats = np.zeros((77,2))    # mean, variance
-    total = np.zeros( (77,1) )
-    for idx, row in enumerate(ws.iter_rows('k4:aa80')):
-        for j, c in enumerate(row):
-            if j == 0:
-                total[idx] =  float(c.value)
-            else:
-                I[idx][j-1] = c.value # / total
-        stats[idx][0] = np.dot(bins, I[idx][:]) / total[idx]
-        stats[idx][1] = np.sqrt( np.dot(I[idx][:], (bins - stats[idx][0])**2) / total[idx] )
+    total = T[:,0:1]
+    I = T[:,1:]
+    stats = grouped_stats(I, total, bins)    # mean, variance
 #    return header, I
     return stats_header + ['population'], np.concatenate((stats, total), axis=1)
 
@@ -346,25 +500,11 @@ def retrieve_education_features():
     """
     read the xlsx file: ../data/chicago-ca-education.xlsx
     """
-    wb = load_workbook(here + "/../data/chicago-ca-education.xlsx")
-    ws = wb.active
-    header = ws['k3':'n3']
-    header = [c.value for c in tuple(header)[0]]
+    header, T = read_xlsx_table(here + "/../data/chicago-ca-education.xlsx", 'k3:n3', 'j4:n80')
     
     bins = range(1,5)
-    l = len(header)
-    E = np.zeros((77,l))
     stats_header = ['education level', 'std var']
-    stats = np.zeros((77,2))
-    for i, row in enumerate(ws.iter_rows('j4:n80')):
-        total = 0
-        for j, c in enumerate(row):
-            if j == 0:
-                total = float(c.value)
-            else:
-                E[i][j-1] = c.value # / total
-        stats[i][0] = np.dot(E[i][:], bins) / total
-        stats[i][1] = np.sqrt( np.dot(E[i][:], (bins - stats[i][0])**2) / total)
+    stats = grouped_stats(T[:,1:], T[:,0], bins)
     return stats_header, stats
                     
         
@@ -376,26 +516,12 @@ def retrieve_race_features():
     """
     read the xlsx file: ../data/chicago-ca-race.xlsx
     """
-    wb = load_workbook(here + "/../data/chicago-ca-race.xlsx")
-    ws = wb.active
-    header = ws['j2':'p2']
-    header = [c.value for c in tuple(header)[0]]
-    l = len(header)
-    R = np.zeros((77,l))
+    header, R = read_xlsx_table(here + "/../data/chicago-ca-race.xlsx", 'j2:p2', 'j4:p80')
     
     bins = range(1,8)
     
     stats_header = ['race level', 'std var']
-    stats = np.zeros((77,2))
-    for i, row in enumerate(ws.iter_rows('j4:p80')):
-        total = 0
-        for c in row:
-            total += float(c.value)
-        for j, c in enumerate(row):
-            R[i][j] = c.value # / total
-        
-        stats[i][0] = np.dot(R[i][:], bins) / total
-        stats[i][1] = np.sqrt( np.dot(R[i][:], (bins - stats[i][0])**2) / total)
+    stats = grouped_stats(R, R.sum(axis=1), bins)
     return stats_header, stats
 #    return header, R
     
@@ -449,6 +575,15 @@ class TestFeatureUtils(unittest.TestCase):
         assert np.amax(gamma) <= 1
         print np.amin(gamma)
         
+    def test_generate_geographical_SpatialLag_ca(self):
+        W = generate_geographical_SpatialLag_ca()
+        assert W.shape == (77, 77)
+        for i in range(77):
+            assert W[i,i] == 0 and np.sum(W[i] > 0) >= 6
+        Wf = generate_geographical_SpatialLag_ca(knearest=False)
+        Wl = generate_geographical_SpatialLag_ca(knearest=False, leaveOut=3)
+        np.testing.assert_almost_equal(Wl, np.delete(np.delete(Wf, 2, 0), 2, 1))
+        
         
 def generate_binary_crime_label():
     y = retrieve_crime_count(2013)
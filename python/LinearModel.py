@@ -15,6 +15,8 @@ the dynamic coefficient model
 
 
 from sklearn import linear_model
+import sys
+import numpy as np
 import matplotlib
 matplotlib.use("AGG")
 import matplotlib.pyplot as plt
@@ -37,6 +39,77 @@ def linearRegression(features, Y):
     res = mod.fit(features, Y)
     return res
     
+    
+
+# leverage closer to 1 than this is refitted explicitly
+LEVERAGE_TOL = 1e-8
+
+
+
+def hat_matrix(features, ridge=0.):
+    """
+    Hat matrix H of the linear regression with intercept, so that the fitted
+    values are H y. With ridge > 0, the coefficients (not the intercept) get
+    the L2 penalty ridge * ||w||^2, as sklearn Ridge.
+    
+    features can be one n x p matrix or a batch of them, B x n x p.
+    """
+    X = np.asarray(features, dtype=float)
+    # centering lets the intercept absorb constant columns, as sklearn does
+    Xc = X - X.mean(axis=-2, keepdims=True)
+    if ridge == 0:
+        return 1. / X.shape[-2] + np.matmul(Xc, np.linalg.pinv(Xc))
+    p = X.shape[-1]
+    G = np.matmul(np.swapaxes(Xc, -1, -2), Xc) + ridge * np.eye(p)
+    return 1. / X.shape[-2] + np.matmul(Xc, np.linalg.solve(G, np.swapaxes(Xc, -1, -2)))
+    
+    
+    
+def leaveOneOut_predict(features, Y, ridge=0.):
+    """
+    Leave-one-out predictions of the linear regression from a single fit,
+    with the PRESS residuals e_i / (1 - h_ii). They are exact for OLS and
+    ridge regression.
+    
+    A sample with leverage h_ii = 1 (e.g. the only sample of a one-hot
+    column) is predicted by an explicit refit without it instead.
+    
+    Input:
+        features - n x p matrix, or a batch B x n x p
+        Y - n responses, or a batch B x n
+    Output:
+        the held-out prediction of each sample, in the shape of Y (or B x n)
+    """
+    H = hat_matrix(features, ridge)
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 2 and Y.shape[-1] == 1:
+        Y = Y.ravel()
+    e = Y - np.matmul(H, Y[...,None])[...,0]
+    h = np.diagonal(H, axis1=-2, axis2=-1)
+    degenerate = 1 - h < LEVERAGE_TOL
+    pred = Y - e / np.where(degenerate, 1, 1 - h)
+    
+    X = np.broadcast_to(np.asarray(features, dtype=float), e.shape + (np.shape(features)[-1],))
+    Y = np.broadcast_to(Y, e.shape)
+    for idx in zip(*np.nonzero(degenerate)):
+        b, i = idx[:-1], idx[-1]
+        keep = np.arange(e.shape[-1]) != i
+        mod = linear_model.Ridge(alpha=ridge) if ridge > 0 else linear_model.LinearRegression()
+        mod.fit(X[b][keep], Y[b][keep])
+        pred[idx] = mod.predict(X[b][i:i+1])[0]
+    return pred
+    
+    
+    
+def leaveOneOut_error(features, Y, ridge=0.):
+    """
+    Leave-one-out absolute errors of the linear regression from a single fit
+    """
+    Y = np.asarray(Y, dtype=float)
+    if Y.ndim == 2 and Y.shape[-1] == 1:
+        Y = Y.ravel()
+    return np.abs(Y - leaveOneOut_predict(features, Y, ridge))
+    
 
 
 
@@ -117,13 +190,16 @@ def update_wi(xi, Si, yi, W, i, eta):
 
 
 from foursquarePOI import getFourSquarePOIDistribution, getFourSquareCount
-from taxiFlow import getTaxiFlow
+from taxiFlow import getTaxiFlow, taxi_flow_normalization
 from FeatureUtils import *
+from featureStore import get_feature_store
 
 
 
 def prepare_features(features=["poi", "taxi", "demos", "spatiallag"], leaveOneOut=-1):
     
+    store = get_feature_store(2013, 'ca')
+    keep = leaveOut_mask(77, leaveOneOut)
     Y = retrieve_crime_count(year=2013)
     Y = Y.reshape((-1,1))
     if leaveOneOut > 0:
@@ -133,10 +209,11 @@ def prepare_features(features=["poi", "taxi", "demos", "spatiallag"], leaveOneOu
         poi_dist = getFourSquareCount(leaveOut=leaveOneOut)
     
     if "taxi" in features:
-        F_taxi = getTaxiFlow(leaveOut=leaveOneOut, normalization="bysource")
+        F_taxi = taxi_flow_normalization(store.get('taxi')[1][np.ix_(keep, keep)], "bysource")
 
     if "demos" in features:
-        C = generate_corina_features(leaveOut=leaveOneOut)
+        C = store.get('demographics')
+        C = (C[0], C[1][keep])
         demos = ['total population', 'population density', 'disadvantage index', 
                  'residential stability', 'ethnic diversity']
         demos_idx = [C[0].index(ele) for ele in demos]
@@ -161,7 +238,60 @@ def prepare_features(features=["poi", "taxi", "demos", "spatiallag"], leaveOneOu
     return Y, f, S
         
 
-if __name__ == '__main__':
+
+
+import unittest
+
+class TestLeaveOneOut(unittest.TestCase):
+    
+    def sample(self, n=30, p=3, seed=0):
+        rng = np.random.RandomState(seed)
+        X = rng.randn(n, p)
+        Y = X.dot(rng.randn(p)) + 2 + 0.5 * rng.randn(n)
+        return X, Y
+    
+    def explicit(self, X, Y, ridge=0.):
+        pred = np.empty(len(Y))
+        for i in range(len(Y)):
+            keep = np.arange(len(Y)) != i
+            mod = linear_model.Ridge(alpha=ridge) if ridge > 0 else linear_model.LinearRegression()
+            mod.fit(X[keep], Y[keep])
+            pred[i] = mod.predict(X[i:i+1])[0]
+        return pred
+    
+    def test_ols(self):
+        X, Y = self.sample()
+        np.testing.assert_allclose(leaveOneOut_predict(X, Y), self.explicit(X, Y))
+        np.testing.assert_allclose(leaveOneOut_error(X, Y[:,None]), np.abs(Y - self.explicit(X, Y)))
+    
+    def test_ridge(self):
+        X, Y = self.sample()
+        np.testing.assert_allclose(leaveOneOut_predict(X, Y, ridge=2.), self.explicit(X, Y, ridge=2.))
+    
+    def test_batch(self):
+        X, Y = self.sample()
+        Ys = np.array([Y, 2 * Y + 1, Y ** 2])
+        pred = leaveOneOut_predict(X, Ys)
+        for b in range(len(Ys)):
+            np.testing.assert_allclose(pred[b], self.explicit(X, Ys[b]))
+        Xs = np.array([X, X[::-1]])
+        pred = leaveOneOut_predict(Xs, Ys[:2])
+        np.testing.assert_allclose(pred[1], self.explicit(X[::-1], Ys[1]))
+    
+    def test_leverage_one(self):
+        X, Y = self.sample()
+        # the one-hot column of sample 4 gives it leverage 1
+        X = np.column_stack((X, np.arange(len(Y)) == 4))
+        pred = leaveOneOut_predict(X, Y)
+        assert np.all(np.isfinite(pred))
+        np.testing.assert_allclose(pred, self.explicit(X, Y), atol=1e-8)
+        
+
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'test':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestLeaveOneOut)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+elif __name__ == '__main__':
     
     
     Y, f, S = prepare_features()
@@ -12,29 +12,34 @@ date:8/20/2015
 
 coefficients_pvalue()
 
-It calls the external R script to do the random permutation. We use the leave-
+It does the random permutation with pvalueEvaluation.py. We use the leave-
 one-out errors to measure the significance.
 
-This implementation use multi-processing in Python. Namely muliple R-instance
-will be called to run simultaneously.
+The permutations run in a multi-processing Pool in Python, and the workers
+share the loaded inputs through shared memory.
 """
 
 import matplotlib
 matplotlib.use("AGG")
 from FeatureUtils import *
 from NegBinStatModel import negativeBinomialRegression
+from nbGLM import NegBinGLM, nb_loo_evaluation
+from permutationEngine import permutation_indices, run_permutations
+from pvalueEvaluation import pvalue_evaluation
 import warnings
-from LinearModel import linearRegression
+from LinearModel import linearRegression, leaveOneOut_predict, leaveOneOut_error
 import numpy as np
 import pandas as pd
 from sklearn import cross_validation
 import matplotlib.pyplot as plt
 import subprocess
 import os.path
+import multiprocessing
 import os
 from sklearn.utils import shuffle
 from foursquarePOI import getFourSquarePOIDistribution
-from taxiFlow import getTaxiFlow
+from taxiFlow import getTaxiFlow, taxi_flow_normalization
+from featureStore import get_feature_store
 import statsmodels.api as sm
 
 here = os.path.dirname(os.path.abspath(__file__))
@@ -47,19 +52,16 @@ here = os.path.dirname(os.path.abspath(__file__))
 
 def NB_training_R(features, featureNames, crimeRates, region, verboseoutput):
     """
-    Use R package (glmmADMB) to train NB regression model
-    """
+    Leave-one-out evaluation of the NB regression model fitted as R glm.nb
+    (MASS) does, in the same process. It replaces the nbr_eval.R script.
     
-    f = pd.DataFrame(features, columns = featureNames)  
-    # call the Rscript to get Negative Binomial Regression results
-    # region - controls tract vs. CA level
+    Return MAE, SD of absolute errors, MRE
+    """
+    # region - controls tract vs. CA level, only one fit per region anyway
     # verbose - controls the output
-    np.savetxt("Y.csv", crimeRates, delimiter=",")
-    f.to_csv("f.csv", sep=",", index=False)
+    nbres = nb_loo_evaluation(features, crimeRates, verboseoutput)
     if verboseoutput:
-        subprocess.call( ['Rscript', 'nbr_eval.R', region, 'verbose'] )
-    else:
-        nbres = subprocess.check_output( ['Rscript', 'nbr_eval.R', region] )
+        print "MAE", nbres[0], "SD", nbres[1], "MRE", nbres[2]
     return nbres
     
     
@@ -82,6 +84,16 @@ def NB_training_python(features, crimeRates):
     
 def LR_training_python(lrf, Y, verboseoutput):    
     Y = Y.reshape((len(Y),))
+    if np.all(np.isfinite(lrf)):
+        # all leave-one-out errors from a single fit
+        y2 = leaveOneOut_predict(lrf, Y)
+        errors2 = np.abs(Y - y2)
+        if verboseoutput:
+            for i in range(len(Y)):
+                print Y[i], y2[i]
+        mae2 = np.mean(errors2)
+        return mae2, np.std(errors2), mae2 / Y.mean()
+    
     loo = cross_validation.LeaveOneOut(len(Y))
     mae2 = 0
     errors2 = []
@@ -123,19 +135,20 @@ def leaveOneOut_evaluation_onChicagoCrimeData(year=2010, features= ["all"],
                                           normalization='pair')
     
     
+    store = get_feature_store(year, region)
     # add POI distribution and taxi flow
-    poi_dist = getFourSquarePOIDistribution(useRatio=False, gridLevel=region)
-    F_taxi = getTaxiFlow(normalization="bydestination", gridLevel=region)
+    poi_dist = store.get('poi')[1]
+    F_taxi = taxi_flow_normalization(np.array(store.get('taxi')[1]), "bydestination")
         
         
     if region == 'ca':
-        W2 = generate_geographical_SpatialLag_ca()
+        W2 = store.get('spatial')[1]
         
         Yhat = retrieve_crime_count(year-1, col = crime_t)
 #        h = retrieve_health_data()
 #        Y = h[0].reshape((77,1))
         Y = retrieve_crime_count(year, col = crime_t)
-        C = generate_corina_features()
+        C = store.get('demographics')
         popul = C[1][:,0].reshape(C[1].shape[0],1)
         
         
@@ -162,18 +175,8 @@ def leaveOneOut_evaluation_onChicagoCrimeData(year=2010, features= ["all"],
         Y_map = retrieve_crime_count(year, col = crime_t, region='tract')
         Y = np.array( [Y_map[k] for k in tractkey] ).reshape( len(Y_map), 1 )
         
+        # aligned to tractkey, zeros for the tracts without demographics
         C = generate_corina_features(region='tract')
-        C_mtx = []
-        cnt = 0
-        
-        for k in tractkey:
-            if k in C[1]:
-                C_mtx.append(C[1][k])
-            else:
-                cnt += 1
-                C_mtx.append( [0 for i in range(7)] )
-        
-        C = ( C[0], np.array( C_mtx ) )
         
         
         # at tract level we don't normalize by population, since the tract is
@@ -183,9 +186,10 @@ def leaveOneOut_evaluation_onChicagoCrimeData(year=2010, features= ["all"],
     
     
     
-    i = retrieve_income_features()
-    e = retrieve_education_features()
-    r = retrieve_race_features()
+    demos = get_feature_store(year, 'ca')
+    i = demos.get('income')
+    e = demos.get('education')
+    r = demos.get('race')
     
     f2 = np.dot(W2, Y)
     ftaxi = np.dot(F_taxi, Y)
@@ -257,9 +261,9 @@ def leaveOneOut_evaluation_onChicagoCrimeData(year=2010, features= ["all"],
     if verboseoutput:
         print "Linear Regression MAE", mae2, "std", var2, "MRE", mre2
     else:
-        print nbres
+        print nbres[0], nbres[1], nbres[2]
         print mae2, var2, mre2
-        return np.array([[float(ele) for ele in nbres.split(" ")], [mae2, var2, mre2]])
+        return np.array([list(nbres), [mae2, var2, mre2]])
     
 
 
@@ -357,16 +361,8 @@ def tenFoldCV_onChicagoCrimeData(features=['corina'], CVmethod='10Fold', P = 10,
         f_train, f_test = f[train_idx, :], f[test_idx, :]
         Y_train, Y_test = Y[train_idx, :], Y[test_idx, :]
         
-
-        # write file for invoking NB regression in R        
-        np.savetxt("Y_train.csv", Y_train, delimiter=",")
-        np.savetxt("Y_test.csv", Y_test, delimiter=",")        
-        pd.DataFrame(f_train, columns = columnName).to_csv("f_train.csv", sep=",", index=False)
-        pd.DataFrame(f_test, columns = columnName).to_csv("f_test.csv", sep=",", index=False)
-        
         # NB regression 
-        nbres = subprocess.check_output( ['Rscript', 'nbr_eval_kfold.R'] ).split(" ")
-        y1 = np.array([float(e) for e in nbres])
+        y1 = NegBinGLM().fit(f_train, Y_train).predict(f_test)
         y1 = y1.reshape((y1.shape[0], 1))
         a = np.abs( Y_test - y1 )
         
@@ -411,9 +407,12 @@ def tenFoldCV_onChicagoCrimeData(features=['corina'], CVmethod='10Fold', P = 10,
 
 
 def permutationTest_onChicagoCrimeData(year=2010, features= ["all"], logFeatures = [], flowType=0, 
-                                       crimeType = ['total'], iters=1001):
+                                       crimeType = ['total'], iters=1001, workdir=here):
     """
     Permutation test with regression model residuals
+
+    The input files of permutation_test.R are written into `workdir`, where
+    the Rscript runs. Concurrent runs need different work directories.
     
     How to do the permutation?
     
@@ -429,11 +428,14 @@ def permutationTest_onChicagoCrimeData(year=2010, features= ["all"], logFeatures
     permute the feature of interest
     """
     W = generate_transition_SocialLag(year, lehd_type=flowType, normalization='source')
-    np.savetxt(here + "/W.csv", W, delimiter="," )
+    np.savetxt(workdir + "/W.csv", W, delimiter="," )
 
+    store = get_feature_store(year, 'ca')
     Yhat = retrieve_crime_count(year-1, crimeType)
     Y = retrieve_crime_count(year, crimeType)
-    C = generate_corina_features()
+    # a copy, the population column is log transformed below
+    C = store.get('demographics')
+    C = (C[0], np.array(C[1]))
     popul = C[1][:,0].reshape((77,1))
     
     # crime count is normalized by the total population as crime rate
@@ -441,12 +443,12 @@ def permutationTest_onChicagoCrimeData(year=2010, features= ["all"], logFeatures
     Y = np.divide(Y, popul) * 10000
     Yhat = np.divide(Yhat, popul) * 10000
     
-    W2 = generate_geographical_SpatialLag_ca()
-    np.savetxt(here + "/W2.csv", W2, delimiter=",")
+    W2 = store.get('spatial')[1]
+    np.savetxt(workdir + "/W2.csv", W2, delimiter=",")
     
-    i = retrieve_income_features()
-    e = retrieve_education_features()
-    r = retrieve_race_features()
+    i = store.get('income')
+    e = store.get('education')
+    r = store.get('race')
     
     f1 = np.dot(W, Y)
     f2 = np.dot(W2, Y)
@@ -523,10 +525,10 @@ def permutationTest_onChicagoCrimeData(year=2010, features= ["all"], logFeatures
     f = pd.DataFrame(f, columns = columnName)
     flr = pd.DataFrame(flr, columns = columnName)
     
-    flr.to_csv(here + "/flr.csv", sep=",", index=False)
-    f.to_csv(here + "/f.csv", sep=",", index=False)
-    np.savetxt(here + "/Y.csv", Y, delimiter=",")
-    subprocess.call( ['Rscript', 'permutation_test.R'], cwd=here )
+    flr.to_csv(workdir + "/flr.csv", sep=",", index=False)
+    f.to_csv(workdir + "/f.csv", sep=",", index=False)
+    np.savetxt(workdir + "/Y.csv", Y, delimiter=",")
+    subprocess.call( ['Rscript', here + '/permutation_test.R', str(iters)], cwd=workdir )
     
     """
     The following permutation design is obsolete, due to the inefficiency.
@@ -603,6 +605,38 @@ def permutationTest_onChicagoCrimeData(year=2010, features= ["all"], logFeatures
         
     =================  old code finishes here =============  
     """ 
+    return permutation_arrays(workdir)
+    
+    
+    
+def permutation_arrays(workdir):
+    """
+    Convert the CSV output of permutation_test.R in `workdir` into
+    permutation.npz there, with
+        features - the permuted features
+        coefficient - the coefficient of each feature in the fitted model
+        pvalue - the permutation p-value of each feature
+        coefs - the coefficients of each permutation, features x iters x coef_names
+    
+    Output:
+        a dict of the features, their coefficients and p-values, and the key
+        'arrays', the name of the .npz file
+    """
+    summary = pd.read_csv(workdir + "/permutation-summary.csv")
+    features = [str(f) for f in summary['feature']]
+    if os.path.exists(workdir + "/permutation-coefficients.csv"):
+        dist = pd.read_csv(workdir + "/permutation-coefficients.csv")
+    else:
+        dist = pd.DataFrame({'feature': []})
+    coef_names = [c for c in dist.columns if c != 'feature']
+    coefs = np.array([dist.loc[dist['feature'] == f, coef_names].values for f in features])
+    fname = os.path.abspath(workdir + "/permutation.npz")
+    np.savez(fname, features=np.array(features), coefficient=summary['coefficient'].values,
+             pvalue=summary['pvalue'].values, coefs=coefs, coef_names=np.array(coef_names))
+    return {'features': features,
+            'coefficients': dict(zip(features, summary['coefficient'].tolist())),
+            'pvalues': dict(zip(features, summary['pvalue'].tolist())),
+            'arrays': fname}
     
     
     
@@ -682,7 +716,46 @@ def generate_flowType_crimeCount_matrix():
 
 
 
-def permutationTest_accuracy(iters, permute='taxiflow'):
+_accuracy_data = {}
+
+def _init_accuracy(Y, D, f2, ftaxi, poi_dist, W2, F_taxi, permute):
+    _accuracy_data.update(Y=Y, D=D, f2=f2, ftaxi=ftaxi, poi_dist=poi_dist,
+                          W2=W2, F_taxi=F_taxi, permute=permute)
+    
+    
+def _accuracy_permutations(perms):
+    """
+    NB and linear leave-one-out errors for a batch of permutations.
+    
+    Only the permuted feature block is rebuilt. The lag features of the
+    whole batch come from one matrix product, and the linear regression
+    errors of the batch from one batched hat matrix.
+    """
+    d = _accuracy_data
+    Y, permute = d['Y'], d['permute']
+    B = len(perms)
+    blocks = dict((k, np.repeat(d[k][None], B, axis=0)) for k in ['D', 'f2', 'ftaxi', 'poi_dist'])
+    if permute == 'corina':
+        blocks['D'] = d['D'][perms]
+    elif permute == 'spatiallag':
+        blocks['f2'] = np.dot(d['W2'], Y[perms,0].T).T[...,None]
+    elif permute == 'taxiflow':
+        blocks['ftaxi'] = np.dot(d['F_taxi'], Y[perms,0].T).T[...,None]
+    elif permute == 'POIdist':
+        blocks['poi_dist'] = d['poi_dist'][perms]
+    F = np.concatenate((np.ones((B, len(Y), 1)), blocks['D'], blocks['f2'], 
+                        blocks['ftaxi'], blocks['poi_dist']), axis=2)
+    
+    lr_mae = np.mean(leaveOneOut_error(F, Y), axis=1)
+    res = []
+    for b in range(B):
+        mae1, sd1, mre1 = nb_loo_evaluation(F[b], Y)
+        res.append([mae1, mre1, lr_mae[b], lr_mae[b] / Y.mean()])
+    return np.array(res)
+    
+    
+    
+def permutationTest_accuracy(iters, permute='taxiflow', seed=0, n_jobs=1, checkpoint=None):
     """
     Evaluate crime rate
     
@@ -695,8 +768,10 @@ def permutationTest_accuracy(iters, permute='taxiflow'):
     leave one out
     
     permutation
-        permute one feature 1000 times takes roughly 30-40 minutes.
-        The results are dumped as "permute-{feature}.pickle"
+        The permutations are drawn up front from a RNG with the given seed,
+        and evaluated in batches by `n_jobs` worker processes. Finished
+        batches are saved to the `checkpoint` file, e.g.
+        "permute-{feature}.npz", and an interrupted run resumes from it.
     """
     poi_dist = getFourSquarePOIDistribution(useRatio=False)
     F_taxi = getTaxiFlow(normalization="bydestination")
@@ -714,45 +789,11 @@ def permutationTest_accuracy(iters, permute='taxiflow'):
     f2 = np.dot(W2, Y)
     ftaxi = np.dot(F_taxi, Y)
     
-    
-    nb_mae = []
-    nb_mre = []
-    lr_mae = []
-    lr_mre = []
-    for i in range(iters):
-        if permute == 'corina':
-            D = np.random.permutation(D)
-        elif permute == 'spatiallag':
-            yhat = np.random.permutation(Y)
-            f2 = np.dot(W2, yhat)
-        elif permute == 'taxiflow':            
-            yhat = np.random.permutation(Y)
-            ftaxi = np.dot(F_taxi, Y)
-        elif permute == 'POIdist':
-            poi_dist = np.random.permutation(poi_dist)
-        f = np.ones(f2.shape)
-        f = np.concatenate( (f, D, f2, ftaxi, poi_dist), axis=1 )
-        header = ['intercept'] + C[0] + [ 'spatiallag', 'taxiflow'] + \
-            ['POI food', 'POI residence', 'POI travel', 'POI arts entertainment', 
-                           'POI outdoors recreation', 'POI education', 'POI nightlife', 
-                           'POI professional', 'POI shops', 'POI event']
-        df = pd.DataFrame(f, columns=header)
-        
-        np.savetxt("Y.csv", Y, delimiter=",")
-        df.to_csv("f.csv", sep=",", index=False)
-        
-        # NB permute
-        nbres = subprocess.check_output( ['Rscript', 'nbr_eval.R', 'ca'] )
-        ls = nbres.split(' ')
-        nb_mae.append( float(ls[0]) )
-        nb_mre.append( float(ls[2]) )
-
-        mae2, mre2 = permutation_Test_LR(Y, f)
-        lr_mae.append(mae2)
-        lr_mre.append(mre2)
-        
-        if i % 10 == 0:
-            print i
+    perms = permutation_indices(len(Y), iters, seed)
+    res = run_permutations(_accuracy_permutations, perms, _init_accuracy,
+                           (Y, D, f2, ftaxi, poi_dist, W2, F_taxi, permute), 
+                           n_jobs, checkpoint=checkpoint)
+    nb_mae, nb_mre, lr_mae, lr_mre = [res[:,i].tolist() for i in range(4)]
         
     print '{0} iterations finished.'.format(iters)
     print pvalue(412.305, lr_mae), pvalue(0.363, lr_mre), \
@@ -772,17 +813,7 @@ def pvalue(v, l):
 def permutation_Test_LR(Y, f):
     
     Y = Y.reshape((len(Y),))
-    loo = cross_validation.LeaveOneOut(len(Y))
-    
-    errors = []
-    for train_idx, test_idx in loo:
-        f_train, f_test = f[train_idx], f[test_idx]
-        Y_train, Y_test = Y[train_idx], Y[test_idx]
-        
-        r = linearRegression(f_train, Y_train)
-        y = r.predict(f_test)
-        errors.append(np.abs(Y_test - y))
-        
+    errors = leaveOneOut_error(f, Y)
     mae = np.mean(errors)
     mre = mae / Y.mean()
     
@@ -815,17 +846,9 @@ def NB_coefficients(year=2010):
         ['POI food', 'POI residence', 'POI travel', 'POI arts entertainment', 
                        'POI outdoors recreation', 'POI education', 'POI nightlife', 
                        'POI professional', 'POI shops', 'POI event']
-    df = pd.DataFrame(f, columns=header)
     
-    np.savetxt("Y.csv", Y, delimiter=",")
-    df.to_csv("f.csv", sep=",", index=False)
-    
-    # NB permute
-    nbres = subprocess.check_output( ['Rscript', 'nbr_eval.R', 'ca', 'coefficient'] )
-    print nbres
-    
-    ls = nbres.strip().split(" ")
-    coef = [float(e) for e in ls]
+    # NB coefficients without the intercept
+    coef = NegBinGLM().fit(f, Y).coef[1:].tolist()
     print coef
     return coef, header
 
@@ -833,7 +856,7 @@ def NB_coefficients(year=2010):
 
 def coefficients_pvalue(lagsFlag, tempflag="templag", selfflow="selfflow", itersN="10", 
                         exposure="exposure", year=2010, lehdType="total", 
-                        crimeType='total'):
+                        crimeType='total', outdir=here + "/../R"):
     """Return the pvalue of Negative Binomial model coefficients.
     Permutation test + leave-one-out evaluation
     Retrieve leave-one-out error distribution. To determine the p-value
@@ -846,11 +869,12 @@ def coefficients_pvalue(lagsFlag, tempflag="templag", selfflow="selfflow", iters
     crimeType -- the type of predicated crime (default "violent", alternative "total")
     exposure -- exposure or noexposure
     lagsFlag -- social lag, spatial lag, socai lag disadv, spatial lag disadv
+    outdir -- the directory of the pvalue-*.json summaries, the .npz arrays
+              and the checkpoints. The file names include all the settings.
     """
-    
+    outdir = os.path.abspath(outdir)
     C = generate_corina_features('ca')
-    demo = pd.DataFrame(data=C[1], columns=C[0], dtype="float")
-    W1 = generate_geographical_SpatialLag_ca()
+    A = generate_contiguity_SpatialLag_ca()
     
     # the LEHD type
     if lehdType == "lowincome":
@@ -860,86 +884,51 @@ def coefficients_pvalue(lagsFlag, tempflag="templag", selfflow="selfflow", iters
         W2 = generate_transition_SocialLag(year=year, lehd_type=0, region='ca',
                                            normalization='none')
     elif lehdType == "taxi":
-        W2 = getTaxiFlow(normalization="none")
+        W2 = np.array(getTaxiFlow(normalization="none"))
     
+    sf = None
     if selfflow == 'selfflow':
-        s = [W2[i,i] for i in range(W2.shape[0])]
-        np.savetxt(here + "/../R/pvalue-selfflow.csv", s)
+        sf = np.diag(W2).copy()
             
-    
-    for i in range(W2.shape[0]):
-        W2[i,i] = 0
+    np.fill_diagonal(W2, 0)
     
     # the predicated crime type                                           
     violentCrime = ['HOMICIDE', 'CRIM SEXUAL ASSAULT', 'BATTERY', 'ROBBERY', 
                 'ARSON', 'DOMESTIC VIOLENCE', 'ASSAULT']
     if crimeType == 'total':
-        Y = retrieve_crime_count(year=year, col=['total'], region='ca')
-        if tempflag == "templag":
-            ystart = (year-3) if year - 3 >= 2003 else 2003
-            tlag = []
-            for ytmp in range(ystart, year):
-                yt = retrieve_crime_count(year=ytmp, col=['total'], region='ca')
-                tlag.append(yt)
-            yt = np.mean(tlag, axis=0)
-            assert yt.shape == Y.shape
-            np.savetxt(here + "/../R/pvalue-templag.csv", yt)
+        col = ['total']
     elif crimeType == 'violent':
-        Y = retrieve_crime_count(year=year, col=violentCrime, region='ca')
-        if tempflag == "templag":
-            ystart = (year-3) if year - 3 >= 2003 else 2003
-            tlag = []
-            for ytmp in range(ystart, year):
-                yt = retrieve_crime_count(year=ytmp, col=violentCrime, region='ca')
-                tlag.append(yt)
-            yt = np.mean(tlag, axis=0)
-            assert yt.shape == Y.shape
-            np.savetxt(here + "/../R/pvalue-templag.csv", yt)
-    
-        
-    demo.to_csv(here + "/../R/pvalue-demo.csv", index=False)
-    np.savetxt(here + "/../R/pvalue-spatiallag.csv", W1, delimiter=",")
-    np.savetxt(here + "/../R/pvalue-sociallag.csv", W2, delimiter=",")
-    np.savetxt(here + "/../R/pvalue-crime.csv", Y)
-    
-    
-
-    # use a multiprocess Pool to run subprocess in parallel
+        col = violentCrime
+    Y = retrieve_crime_count(year=year, col=col, region='ca')
+    yt = None
+    if tempflag == "templag":
+        ystart = (year-3) if year - 3 >= 2003 else 2003
+        tlag = []
+        for ytmp in range(ystart, year):
+            tlag.append(retrieve_crime_count(year=ytmp, col=col, region='ca'))
+        yt = np.mean(tlag, axis=0)
+        assert yt.shape == Y.shape
+    
+    
+    # evaluate each setting in turn, the permutations use all cores
+    from multiprocessing import cpu_count
     socialNorm = ['bydestination', 'bysource', 'bypair']
-    os.chdir(here + "/../R")
-    from multiprocessing import Pool, cpu_count
-    subProcessPool = Pool(cpu_count() / 2)
-
+    res = []
     for sn in socialNorm[1:2]:
         for logpop in ["logpop", "pop"][0:1]:
             for logpopden in ["logpopdensty", "popdensty"][0:1]:
-                subProcessPool.apply_async(subPworker, (lehdType, crimeType, sn, exposure, logpop, lagsFlag, itersN, logpopden, tempflag, selfflow))
-#                p = subprocess.Popen(['Rscript', 'pvalue-evaluation.R', 
-#                                      lehdType+"lehd", crimeType+"crime", sn, 
-#                                      exposure, logpop, lagsFlag, itersN, 
-#                                      logpopden, tempflag, selfflow])
-#                p.wait()
-    subProcessPool.close()
-    subProcessPool.join()
+                args = [lehdType+"lehd", crimeType+"crime", sn, exposure, logpop, lagsFlag, 
+                        str(itersN), logpopden, tempflag, selfflow, str(year)]
+                print "Start evaluation with", ' '.join(args)
+                fout = os.path.join(outdir, "pvalue-{0}.json".format('-'.join(args)))
+                r = pvalue_evaluation(C, W2, A, Y, lagsFlag, sn, exposure, logpop, logpopden,
+                                      yt, sf, int(itersN), n_jobs=cpu_count(), fout=fout,
+                                      checkpoint=fout[:-5] + ".checkpoint.npz")
+                res.append(r)
+    return res
+    
     
     
-
-
-def subPworker(lehdType, crimeType, sn, ep, logpop, lagsFlag, itersN, logpopden, tempflag, selfflow):
-    print "Start worker with", sn, ep, logpop, lagsFlag, itersN, logpopden, tempflag, selfflow
-    import platform
-    if platform.system() == "Windows":
-        p = subprocess.Popen(['Rscript', 'pvalue-evaluation.R', lehdType+"lehd", crimeType+"crime", 
-                          sn, ep, logpop, lagsFlag, itersN, logpopden, tempflag, selfflow], shell=True)
-    elif platform.system() == "Linux":
-        p = subprocess.Popen(['Rscript', 'pvalue-evaluation.R', lehdType+"lehd", crimeType+"crime", 
-                          sn, ep, logpop, lagsFlag, itersN, logpopden, tempflag, selfflow])
-        
-    print p.pid, "is running"
-    p.wait()
-        
-
-
 
 def longTable_features_allYears():
     """
@@ -1033,7 +1022,8 @@ if __name__ == '__main__':
             W = generate_transition_SocialLag(year, lehd_type=0)
             np.savetxt(here + "/W-{0}.csv".format(year), W, delimiter="," )
     elif t == 'permuteAccu':
-        r = permutationTest_accuracy(1000)
+        r = permutationTest_accuracy(1000, n_jobs=multiprocessing.cpu_count(),
+                                     checkpoint='permute-taxiflow.npz')
     elif t == 'coefficient':
         v = []
         for year in range(2010, 2015):
@@ -8,12 +8,30 @@ Build tract level flow from LEHD dataset.
 Dependency:
     Use the LEHD-download.py script first to extract all the block level OD data.
     
-This task is memory consuming. On my 8GB laptop it cannot be executed.
-Rewrite in Groovy.
+The block level OD files are aggregated out of core, with bounded memory:
+
+    1. Each file is read in chunks of integer arrays. The block codes are
+       mapped to tracts (block // 10000), and each chunk is reduced by
+       (origin tract, destination tract) with a sort and group.
+    2. The reduced rows are spilled to binary files, partitioned by a hash of
+       the tract pair. The files are processed in parallel.
+    3. Each partition is reduced again and appended to the output file.
+
+The memory cap bounds the chunk size and the partition size. The old
+dict-of-dicts version needed more than 8GB, and was rewritten in Groovy.
+
+Usage:
+    python TractFlow.py year 2010 memory 2048 jobs 4
 """
 
 import sys
 import os
+import glob
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+import pandas as pd
 
 
 def mergeBlockCensus( a , b ):
@@ -43,9 +61,202 @@ def savePairWiseTractsFeatures( fname, tracts ):
                 
     
 
-if __name__ == '__main__':
+# S000 SA01 SA02 SA03 SE01 SE02 SE03 SI01 SI02 SI03
+N_COUNTS = 10
+RECORD = np.dtype([('org', np.int64), ('dst', np.int64), ('counts', np.int64, N_COUNTS)])
+# memory of one parsed row in a chunk, with the copies of the reduction
+ROW_BYTES = 512
+
+
+
+def reduce_pairs(org, dst, counts):
+    """
+    Sum the counts of the same (org, dst) pair.
     
-    print 'Warning: you need more than 8GB memroy to run this script. 16GB is recommended.'
+    Output:
+        unique org, dst, summed counts, sorted by (org, dst)
+    """
+    if len(org) == 0:
+        return org, dst, counts
+    order = np.lexsort((dst, org))
+    org, dst, counts = org[order], dst[order], counts[order]
+    new = np.ones(len(org), dtype=bool)
+    new[1:] = (org[1:] != org[:-1]) | (dst[1:] != dst[:-1])
+    starts = np.nonzero(new)[0]
+    return org[starts], dst[starts], np.add.reduceat(counts, starts, axis=0)
+
+
+
+def partition_of(org, dst, nparts):
+    return (org % nparts + (dst % nparts) * 7919) % nparts
+
+
+
+def _spill_file(args):
+    """
+    Aggregate one block level OD file into the partition spill files
+    {spillDir}/{part}-{fileIdx}.bin
+    """
+    fileIdx, fname, spillDir, nparts, chunksize = args
+    nrows = 0
+    reader = pd.read_csv(fname, usecols=range(2 + N_COUNTS), dtype=np.int64,
+                         chunksize=chunksize, compression='infer')
+    for chunk in reader:
+        v = chunk.values
+        nrows += len(v)
+        org, dst, counts = reduce_pairs(v[:,0] // 10000, v[:,1] // 10000, v[:,2:])
+        part = partition_of(org, dst, nparts)
+        rec = np.empty(len(org), dtype=RECORD)
+        rec['org'] = org
+        rec['dst'] = dst
+        rec['counts'] = counts
+        for p in np.unique(part):
+            with open(os.path.join(spillDir, '{0}-{1}.bin'.format(p, fileIdx)), 'ab') as fout:
+                rec[part == p].tofile(fout)
+    return nrows
+
+
+
+def _reduce_partition(args):
+    """
+    Reduce the spill files of one partition into {spillDir}/part-{part}.csv
+    """
+    part, spillDir = args
+    rec = np.concatenate([np.fromfile(fn, dtype=RECORD) for fn in
+                          glob.glob(os.path.join(spillDir, '{0}-*.bin'.format(part)))] +
+                         [np.empty(0, dtype=RECORD)])
+    org, dst, counts = reduce_pairs(rec['org'], rec['dst'], rec['counts'])
+    fout = os.path.join(spillDir, 'part-{0}.csv'.format(part))
+    np.savetxt(fout, np.column_stack((org, dst, counts)), fmt='%d', delimiter=',')
+    return fout
+
+
+
+def aggregate_tract_flow(files, foutName, memory=2 * 1024**3, n_jobs=1, tmpDir=None):
+    """
+    Aggregate the block level LEHD OD files into tract level flows.
+    
+    Input:
+        files - the block level OD csv files (or .csv.gz)
+        foutName - the output csv, one line per tract pair:
+                   origin, destination, the 10 job counts
+        memory - the memory cap in bytes, shared by the n_jobs workers
+        tmpDir - directory of the spill files
+    Output:
+        number of block pairs read
+    """
+    perWorker = memory // max(1, n_jobs)
+    chunksize = max(1000, perWorker // ROW_BYTES)
+    # the reduced tract pairs are fewer than the block pairs, and a spilled
+    # row takes about as much space as a text row
+    inputBytes = sum(os.path.getsize(fn) * (5 if fn.endswith('.gz') else 1) for fn in files)
+    nparts = max(1, int(np.ceil(inputBytes * 4.0 / perWorker)))
+    spillDir = tempfile.mkdtemp(prefix='tractflow-', dir=tmpDir)
+    try:
+        tasks = [(i, fn, spillDir, nparts, chunksize) for i, fn in enumerate(files)]
+        parts = [(p, spillDir) for p in range(nparts)]
+        if n_jobs > 1:
+            pool = multiprocessing.Pool(n_jobs)
+            nrows = 0
+            for k, n in enumerate(pool.imap_unordered(_spill_file, tasks)):
+                nrows += n
+                print '{0} out of {1} files processed.'.format(k + 1, len(files))
+            outputs = pool.map(_reduce_partition, parts)
+            pool.close()
+            pool.join()
+        else:
+            nrows = sum(_spill_file(t) for t in tasks)
+            outputs = [_reduce_partition(p) for p in parts]
+
+        tmp = foutName + '.tmp'
+        with open(tmp, 'wb') as fout:
+            for fn in outputs:
+                with open(fn, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout)
+        os.rename(tmp, foutName)
+    finally:
+        shutil.rmtree(spillDir)
+    return nrows
+
+
+
+
+import unittest
+
+class TestTractFlow(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        blocks = np.array([170310101001000, 170310101002001, 170310102003000,
+                           170310102004002, 170310103001003, 170310201001000])
+        self.files = []
+        self.reference = {}
+        for k in range(3):
+            n = 3000
+            rows = np.column_stack((blocks[rng.randint(len(blocks), size=n)],
+                                    blocks[rng.randint(len(blocks), size=n)],
+                                    rng.randint(0, 20, size=(n, N_COUNTS))))
+            df = pd.DataFrame(rows, columns=['w_geocode', 'h_geocode', 'S000', 'SA01', 'SA02', 'SA03',
+                                             'SE01', 'SE02', 'SE03', 'SI01', 'SI02', 'SI03'])
+            df['createdate'] = 20130916
+            fname = os.path.join(self.dir, 'od-{0}.csv'.format(k) + ('.gz' if k == 2 else ''))
+            df.to_csv(fname, index=False, compression='gzip' if k == 2 else None)
+            self.files.append(fname)
+            for r in rows:
+                org, dst = str(r[0])[:-4], str(r[1])[:-4]
+                dst_dict = self.reference.setdefault(org, {})
+                if dst in dst_dict:
+                    mergeBlockCensus(dst_dict[dst], list(r[2:]))
+                else:
+                    dst_dict[dst] = list(r[2:])
+        
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        
+    def read_flow(self, fname):
+        flow = {}
+        with open(fname, 'r') as fin:
+            for line in fin:
+                ls = line.strip().split(',')
+                assert (ls[0], ls[1]) not in flow
+                flow[(ls[0], ls[1])] = [int(x) for x in ls[2:]]
+        return flow
+        
+    def check(self, memory, n_jobs):
+        foutName = os.path.join(self.dir, 'tract-flow.csv')
+        nrows = aggregate_tract_flow(self.files, foutName, memory, n_jobs, tmpDir=self.dir)
+        assert nrows == 9000
+        flow = self.read_flow(foutName)
+        assert flow == dict(((org, dst), c) for org in self.reference
+                            for dst, c in self.reference[org].items())
+        # the spill files are removed
+        assert sorted(os.listdir(self.dir)) == sorted([os.path.basename(fn) for fn in self.files] +
+                                                      ['tract-flow.csv'])
+        
+    def test_single_partition(self):
+        self.check(2 * 1024**3, 1)
+        
+    def test_bounded_memory(self):
+        # chunks of 1000 rows and several partitions
+        self.check(64 * 1024, 1)
+        
+    def test_parallel(self):
+        self.check(64 * 1024, 2)
+        
+    def test_reduce_pairs(self):
+        org, dst, counts = reduce_pairs(np.array([2, 1, 2, 1]), np.array([5, 5, 5, 3]),
+                                        np.array([[1, 2], [3, 4], [5, 6], [7, 8]]))
+        np.testing.assert_array_equal(org, [1, 1, 2])
+        np.testing.assert_array_equal(dst, [3, 5, 5])
+        np.testing.assert_array_equal(counts, [[7, 8], [3, 4], [6, 8]])
+            
+
+
+if __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1] == 'test':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestTractFlow)
+    unittest.TextTestRunner(verbosity=2).run(suite)
+elif __name__ == '__main__':
     
     arguments = {}
     if len(sys.argv) % 2 == 1:
@@ -54,56 +265,25 @@ if __name__ == '__main__':
     else:
         print """Usage: TractFlow.py [options] [value]
         Possible options:
-            year       e.g. 2010 default '2010'"""
+            year       e.g. 2010 default '2010'
+            memory     memory cap in MB, default 2048
+            jobs       number of worker processes, default all cores"""
             
             
     year = 2010
     if 'year' in arguments:
         year = arguments['year']
+    memory = int(arguments.get('memory', 2048)) * 1024**2
+    n_jobs = int(arguments.get('jobs', multiprocessing.cpu_count()))
         
     
-    tracts = {}
     dirPath = '../data/{0}'.format(year)
-    files = os.listdir(dirPath)
-    cnt = 0
+    files = sorted(os.path.join(dirPath, fn) for fn in os.listdir(dirPath))
     foutName = '../data/state_all_tract_level_od_JT00_{0}.csv'.format(year)
     
     if os.path.exists(foutName):
         print 'The year {0} is already merged.\nQuit Program'.format(year)
         sys.exit(0)
     
-    for fn in files:
-        f = open(os.path.join(dirPath, fn), 'r')
-        cnt += 1
-        # get rid of header line
-        next(f)
-        for line in f:
-            ls = line.split(",")    # ls length 13
-            tract_org = long(ls[0]) / 10000
-            tract_dst = long(ls[1]) / 10000
-            # get count S000 SA01 SA02 SA03 SE01 SE02 SE03 SI01 SI02 SI03
-            counts = []
-            for s in ls[2:-1]:
-                counts.append( int(s) )
-            
-            if tract_org in tracts:
-                if tract_dst in tracts[tract_org]:
-                    mergeBlockCensus(tracts[tract_org][tract_dst], counts)
-                else:
-                    tracts[tract_org][tract_dst] = counts
-            else:
-                tracts[tract_org] = {}
-                tracts[tract_org][tract_dst] = counts
-                
-        f.close()
-        if cnt % 5 == 0:
-            print '{0} out of {1} files processed.'.format(cnt, len(files))
-            
-            
-    savePairWiseTractsFeatures(foutName, tracts)
-    
-            
-    
-                        
-
-
+    nrows = aggregate_tract_flow(files, foutName, memory, n_jobs)
+    print '{0} block pairs of {1} files are aggregated into {2}'.format(nrows, len(files), foutName)
@@ -1,16 +1,27 @@
 from flask import Flask, request, jsonify, redirect, make_response
-from flask import render_template, send_from_directory
+from flask import render_template, url_for, abort, Response
 from NBRegression import *
+from jobQueue import JobQueue
+from StringIO import StringIO
+import glob
+import sys
 
 import os
 here = os.path.dirname(os.path.abspath(__file__))
 
-import glob
-
 
 app = Flask(__name__)
 app.debug = True
 
+# the permutation tests run in the background, two at a time
+queue = JobQueue(workers=2)
+# rows per page of the array endpoints
+PAGE_SIZE = 1000
+# runs per page of /history
+HISTORY_PAGE = 100
+# the function tag of the results of the earlier versions of the server
+LEGACY_RESULT = 'legacy_permutation'
+
 
 features = ['density', 'disadvantage', 'ethnic', 'pctblack', 'pctship',
     'population', 'poverty', 'residential', 'sociallag', 'spatiallag',
@@ -52,56 +63,137 @@ def set_parameter():
         elif a.get(k) == 'none':
             features.remove(k)
 
-    import sys
-    import time
-    import os
-    fname = 'file-{0}'.format(time.strftime('%m-%d-%y-%H-%M-%S'))
-    sys.stdout = open(os.path.join(here, 'templates', fname), 'w')
-    # every print is redirected to the file
-    print 'Selected features', features 
-    print 'Features take log', logF
-    print 'Year', year
-    print 'Flow type:', flowT, '(0 - total, 4 - low income)'
-    print 'crime type', crimeT
-    print 'number of iterations', iters, '\n'
+    # the same settings in any order give the same job
+    features.sort()
+    logF.sort()
+    head = ['Selected features {0}'.format(features),
+            'Features take log {0}'.format(logF),
+            'Year {0}'.format(year),
+            'Flow type: {0} (0 - total, 4 - low income)'.format(flowT),
+            'crime type {0}'.format(crimeT),
+            'number of iterations {0}'.format(iters)]
+    job_id = queue.submit(nb_permutation_job, head, year, features, logF, crimeT, flowT, iters,
+                          description='\n'.join(head))
+    return job_response(job_id, url_for('format_result', fname=job_id))
+
+
+
+def nb_permutation_job(head, year, features, logF, crimeT, flowT, iters):
+    """
+    The permutation test job. It runs in the job directory, where the
+    permuted coefficients are saved in permutation.npz. The job result has
+    one part, like the p-value jobs, with the settings and the table rows.
+    """
+    for line in head[:-1]:
+        print line
+    print head[-1], '\n'
+    res = permutationTest_onChicagoCrimeData(year=year, features=features, 
+            logFeatures=logF, crimeType=crimeT, flowType=flowT, iters=iters,
+            workdir=os.getcwd())
+    res['head'] = head
+    res['rows'] = [{'key': f, 'values': [res['coefficients'][f], res['pvalues'][f]]}
+                   for f in res['features']]
+    return [res]
+
+
+
+def read_permutation_output(fin):
+    """
+    Parse the results of the earlier versions of the server, the output of
+    permutation_test.R after the six lines of settings and a blank line.
+    Each feature is a line with the name and a line with the values.
+    """
+    head = [fin.readline().strip() for x in range(6)]
+    fin.readline() 
+    key = fin.readline().strip()
+    rows = [] 
+    while (key != ''):
+        values = [float(v) for v in fin.readline().split()]
+        rows.append({'key': key, 'values': values})
+        key = fin.readline().strip()
+    return head, rows
+
+
+
+def wants_json():
+    """
+    Whether the client asks for JSON rather than a page, as the API clients
+    do. The browser form posts prefer text/html.
+    """
+    accept = request.accept_mimetypes
+    return accept['application/json'] > accept['text/html']
 
-    permutationTest_onChicagoCrimeData(year=year, features=features, 
-            logFeatures=logF, crimeType=crimeT, flowType=flowT, iters=iters)
-    # print redirection ends
-    sys.stdout.close()
-    s = None
-    return redirect('result/' + fname)
+
+
+def job_response(job_id, page):
+    """
+    The links of a submitted job as JSON for the API clients, otherwise a
+    redirect to `page`, as the form submissions always got
+    """
+    if not wants_json():
+        return redirect(page)
+    return jsonify({'job': job_id,
+                    'status': url_for('job_status', job_id=job_id),
+                    'log': url_for('job_log', job_id=job_id),
+                    'result': url_for('job_result', job_id=job_id)}), 202
+
+
+
+def import_legacy_results():
+    """
+    Add the results of the earlier versions of the server, templates/file*,
+    to the job index. Only the files not indexed yet are read.
+    """
+    known = set(job['id'] for job in queue.list_jobs(function=LEGACY_RESULT))
+    results = []
+    for f in glob.glob(here + '/templates/file*'):
+        name = os.path.basename(f)
+        if name in known:
+            continue
+        with open(f, 'r') as fin:
+            head = [next(fin).strip() for x in range(6)]
+        results.append((name, '\n'.join(head), os.path.getmtime(f)))
+    queue.import_results(LEGACY_RESULT, results)
+
+import_legacy_results()
 
 
 
 @app.route('/history')
 def list_previous_results():
-    s = glob.glob(here + '/templates/file*')    
+    page = max(0, request.args.get('page', 0, type=int))
+    # one row more tells if there is a next page
+    jobs = queue.list_jobs(function=['nb_permutation_job', LEGACY_RESULT],
+                           limit=HISTORY_PAGE + 1, offset=page * HISTORY_PAGE)
     items = []
-    for f in s:
-        with open(f, 'r') as fin:
-            head = [next(fin) for x in range(6)]
-        fn = os.path.basename(f)
-        item = {'head': head, 'name': fn}
-        items.append(item)
-    return render_template('history.html', items=items) 
+    for job in jobs[:HISTORY_PAGE]:
+        head = job['description'].split('\n')
+        if job['function'] != LEGACY_RESULT:
+            head.append('Status: ' + job['status'])
+        items.append({'head': head, 'name': job['id']})
+    return render_template('history.html', items=items, page=page,
+                           more=len(jobs) > HISTORY_PAGE) 
 
 
 
 @app.route('/result/<fname>')
 def format_result(fname):
-    fn = here + '/templates/' + fname
-    with open(fn, 'r') as fin:
-        head = [fin.readline() for x in range(6)]
-        fin.readline() 
-        key = fin.readline().strip()
-        rows = [] 
-        while (key != ''):
-            values = fin.readline().split(" ")
-            row = {'key': key, 'values': values}
-            rows.append(row)
-            key = fin.readline().strip()
-    return render_template('result.html', head=head, rows = rows)
+    if queue.exists(fname):
+        res = queue.result(fname)
+        if res is None:
+            status = queue.status(fname)
+            head = status['description'].split('\n') + ['Status: ' + status['status']]
+            return render_template('result.html', head=head, rows=[])
+        head, rows = res[0]['head'], res[0]['rows']
+        with np.load(res[0]['arrays']) as data:
+            downloads = [(name, url_for('download_job_array', job_id=fname, part=0, name=name))
+                         for name in data.files]
+    else:
+        # results of the earlier versions of the server
+        with open(here + '/templates/' + os.path.basename(fname), 'r') as fin:
+            head, rows = read_permutation_output(fin)
+        downloads = []
+    return render_template('result.html', head=head, rows = rows, downloads=downloads)
 
         
         
@@ -117,8 +209,8 @@ def nb_permute():
 def new_permute():
     
     a =  request.args
-    year = int(a.get('year')) if a.get('year') != '' else '2010'
-    iters = a.get('iters') if a.get('iters') != '' else 10
+    year = int(a.get('year')) if a.get('year') != '' else 2010
+    iters = int(a.get('iters')) if a.get('iters') != '' else 10
     lags = []
     lags.append( "1" if "social-lag-crime" in a else "0" )
     lags.append( "1" if "spatial-lag-crime" in a else "0" )
@@ -133,20 +225,124 @@ def new_permute():
     print a
     print lagsFlag, iters, ep, year
     
-    fname = "glmmadmb--totallehd-totalcrime-bysource-{0}-logpop-{1}-{2}-logpopdensty-{3}-{4}-.out".format(
-            ep, lagsFlag, iters, tl, sf)
-    coefficients_pvalue(lagsFlag, tempflag=tl, selfflow=sf, itersN=iters, exposure=ep, year=year)    
-    
-    return redirect('download/' + fname)
+    # the job runs in its job directory, so outdir '.' keeps the summaries,
+    # arrays and checkpoints of every job apart
+    job_id = queue.submit(coefficients_pvalue, lagsFlag, tempflag=tl, selfflow=sf, itersN=iters,
+                          exposure=ep, year=year, outdir='.',
+                          description='{0} {1} {2} {3} {4} {5}'.format(lagsFlag, iters, ep, tl, sf, year))
+    return job_response(job_id, url_for('job_status', job_id=job_id))
+
+
+
+@app.route('/jobs')
+def list_jobs():
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    return jsonify({'jobs': queue.list_jobs(request.args.get('function'), limit, offset),
+                    'offset': offset, 'limit': limit})
 
 
-@app.route('/download/<fname>')
-def download_result(fname):
-    fn = here + '/../R/'
-    response = make_response(send_from_directory(fn, fname))
-    response.cache_control.max_age = 0
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    if not queue.exists(job_id):
+        abort(404)
+    return jsonify(queue.status(job_id))
+
+
+
+@app.route('/jobs/<job_id>/log')
+def job_log(job_id):
+    if not queue.exists(job_id):
+        abort(404)
+    response = make_response(queue.log(job_id))
+    response.mimetype = 'text/plain'
+    return response
+
+
+
+@app.route('/jobs/<job_id>/stderr')
+def job_stderr(job_id):
+    if not queue.exists(job_id):
+        abort(404)
+    response = make_response(queue.log(job_id, 'stderr'))
+    response.mimetype = 'text/plain'
+    return response
+
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    if not queue.exists(job_id):
+        abort(404)
+    status = queue.status(job_id)
+    if status['status'] != 'done':
+        return jsonify(status), 409
+    return jsonify({'job': job_id, 'result': queue.result(job_id)})
+
+
+
+def job_arrays(job_id, part):
+    """
+    The arrays of the part-th result of a p-value or permutation job
+    """
+    if not queue.exists(job_id) or queue.status(job_id)['status'] != 'done':
+        abort(404)
+    res = queue.result(job_id)
+    if not isinstance(res, list) or part >= len(res) or 'arrays' not in res[part]:
+        abort(404)
+    return np.load(res[part]['arrays'])
+
+
+
+@app.route('/jobs/<job_id>/arrays/<int:part>')
+def list_job_arrays(job_id, part):
+    with job_arrays(job_id, part) as data:
+        return jsonify(dict((name, list(data[name].shape)) for name in data.files))
+
+
+
+@app.route('/jobs/<job_id>/arrays/<int:part>/<name>')
+def job_array_page(job_id, part, name):
+    """
+    Rows [offset, offset + limit) of a result array
+    """
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    with job_arrays(job_id, part) as data:
+        if name not in data.files:
+            abort(404)
+        a = data[name]
+    page = a[offset:offset+limit]
+    return jsonify({'name': name, 'shape': list(a.shape), 'offset': offset,
+                    'limit': limit, 'rows': page.tolist()})
+
+
+
+@app.route('/jobs/<job_id>/download/<int:part>/<name>')
+def download_job_array(job_id, part, name):
+    """
+    Stream a result array as CSV, PAGE_SIZE rows at a time
+    """
+    with job_arrays(job_id, part) as data:
+        if name not in data.files:
+            abort(404)
+        a = data[name]
+    if a.ndim < 2:
+        a = a.reshape((len(a), 1))
+    elif a.ndim > 2:
+        # one row per permutation, e.g. of the permuted coefficients
+        a = a.reshape((-1, a.shape[-1]))
+
+    def generate():
+        for s in range(0, len(a), PAGE_SIZE):
+            out = StringIO()
+            np.savetxt(out, a[s:s+PAGE_SIZE], delimiter=',', fmt='%s')
+            yield out.getvalue()
+
+    response = Response(generate(), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename={0}-{1}.csv'.format(job_id, name)
     return response
-    
     
     
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Crime count cube
+
+One streaming pass over the raw file ../data/Crimes_-_2001_to_present.csv
+counts the crimes by
+
+    year x region x crime type x hour-of-day
+
+at tract and CA level together. The CA counts are aggregated from the tract
+counts with the tract to CA reference, the same way as CAFeature.py does.
+
+The cube is saved as ../data/chicago-crime-cube.npz, and the crime count
+retrieval functions read slices of it directly instead of the per-year
+files chicago-crime-{tract,ca}-level-{year}.csv.
+
+Usage:
+    python crimeCube.py
+"""
+
+import numpy as np
+import warnings
+from Crime import Tract, readCrimeBlocks
+from CAFeature import get_Tract_CA_ref
+from regionAssign import assign_regions, region_index
+
+import os
+here = os.path.dirname(os.path.abspath(__file__))
+
+CUBE_FILE = here + '/../data/chicago-crime-cube.npz'
+RAW_FILE = here + '/../data/Crimes_-_2001_to_present.csv'
+
+
+
+def _grow(cube, shape, yearOffset=0):
+    """
+    Enlarge the cube with zeros to the given shape. The old cube is placed
+    `yearOffset` entries down the year axis.
+    """
+    if cube.shape == shape:
+        return cube
+    c = np.zeros(shape, dtype=cube.dtype)
+    c[yearOffset:yearOffset+cube.shape[0], :, :cube.shape[2], :] = cube
+    return c
+
+
+
+def build_crime_cube(rawfileName=RAW_FILE, foutName=CUBE_FILE, chunksize=500000):
+    """
+    Build the year x region x type x hour crime count cube in one pass.
+
+    Output:
+        the saved file name
+    """
+    tracts = Tract.createAllTractObjects()
+    tractKey = sorted(tracts.keys())
+    caKey = range(1, 78)
+    TC_ref = get_Tract_CA_ref()
+
+    year0 = None    # the year of the first entry on the year axis
+    types = []
+    typeIdx = {}
+    cube = np.zeros((0, len(tractKey), 0, 24), dtype=np.int32)
+
+    cntTotal = 0
+    for block in readCrimeBlocks(rawfileName, chunksize):
+        good = block['lat'].notnull() & block['lon'].notnull() & block['date'].notnull()
+        block = block[good]
+        cntTotal += len(block)
+
+        tidx = region_index(assign_regions(block['lon'].values, block['lat'].values, tracts), tractKey)
+        valid = tidx != -1
+        block = block[valid]
+        tidx = tidx[valid]
+        if len(block) == 0:
+            continue
+
+        # map block categories and years onto the cube axes
+        for tp in block['type'].cat.categories:
+            if tp not in typeIdx:
+                typeIdx[tp] = len(types)
+                types.append(tp)
+        catmap = np.array([typeIdx[tp] for tp in block['type'].cat.categories], dtype=int)
+        yr = block['date'].dt.year.values.astype(int)
+        if year0 is None:
+            year0 = yr.min()
+        lo = min(year0, yr.min())
+        hi = max(year0 + cube.shape[0] - 1, yr.max())
+        cube = _grow(cube, (hi - lo + 1, len(tractKey), len(types), 24), year0 - lo)
+        year0 = lo
+
+        cidx = catmap[block['type'].cat.codes.values]
+        hour = block['date'].dt.hour.values
+        flat = np.ravel_multi_index((yr - year0, tidx, cidx, hour), cube.shape)
+        uniq, cnts = np.unique(flat, return_counts=True)
+        cube.ravel()[uniq] += cnts.astype(np.int32)
+        print "{0} records have been counted".format(cntTotal)
+
+    years = range(year0, year0 + cube.shape[0])
+    tract_ca = np.array([TC_ref.get(k, -1) for k in tractKey])
+    ca_cube = np.zeros((len(years), len(caKey), len(types), 24), dtype=np.int32)
+    for j, ca in enumerate(caKey):
+        ca_cube[:,j] = cube[:, tract_ca == ca].sum(axis=1)
+
+    np.savez_compressed(foutName, tract=cube, ca=ca_cube, years=np.array(years),
+                        tract_ids=np.array(tractKey), ca_ids=np.array(caKey),
+                        crime_types=np.array(types))
+    return foutName
+
+
+
+class CrimeCube:
+    """
+    The loaded crime count cube.
+    """
+
+    def __init__(self, fname=CUBE_FILE):
+        data = np.load(fname)
+        self.cube = {'tract': data['tract'], 'ca': data['ca']}
+        self.ids = {'tract': data['tract_ids'].tolist(), 'ca': data['ca_ids'].tolist()}
+        self.years = data['years'].tolist()
+        self.types = [str(t) for t in data['crime_types']]
+
+
+    def typeIndex(self, col):
+        """
+        Indices of the crime types in `col`. 'total' selects all types.
+        The unknown types are skipped with a warning, as in the per-year
+        files, e.g. DOMESTIC VIOLENCE of the violent crimes.
+        """
+        if 'total' in col:
+            return range(len(self.types))
+        missing = [c for c in col if c not in self.types]
+        if missing:
+            warnings.warn("Crime types {0} are not in the crime cube".format(missing))
+        return [self.types.index(c) for c in col if c in self.types]
+
+
+    def count(self, year, col=['total'], region='ca'):
+        """
+        Crime count of the given types per region, shape (#region,)
+        """
+        c = self.cube[region][self.years.index(int(year))]
+        return c[:, self.typeIndex(col), :].sum(axis=(1, 2))
+
+
+    def hourly(self, year, col=['total'], region='ca'):
+        """
+        Crime count of the given types per hour and region, shape (24, #region)
+        """
+        c = self.cube[region][self.years.index(int(year))]
+        return c[:, self.typeIndex(col), :].sum(axis=1).T
+
+
+
+_cube = {}
+
+def load_crime_cube(fname=CUBE_FILE):
+    """
+    Load the cube once per process. Return None if the cube is not built.
+    """
+    if not os.path.exists(fname):
+        return None
+    mtime = os.path.getmtime(fname)
+    if fname not in _cube or _cube[fname][0] != mtime:
+        _cube[fname] = (mtime, CrimeCube(fname))
+    return _cube[fname][1]
+
+
+
+if __name__ == '__main__':
+    print "Build crime cube from {0}".format(RAW_FILE)
+    print build_crime_cube()
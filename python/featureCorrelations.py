@@ -189,18 +189,9 @@ def correlation_socialflow_crime(region='tract', useRate=False,
         print 'Use crime rate per 10,000 population'
         
         if region == 'tract':
-            C_mtx = []
-            cnt = 0
-            
-            for k in tractkey:
-                if k in U[1]:
-                    C_mtx.append(U[1][k])
-                else:
-                    cnt += 1
-                    C_mtx.append( [1] + [0 for i in range(6)] ) # population 1
-        
-            U = ( U[0], np.array( C_mtx ) )
-            print len(tractkey), cnt
+            present = tract_demographics()[3]
+            U[1][~present, 0] = 1   # population 1
+            print len(tractkey), np.sum(~present)
             
         popul = U[1][:,0].reshape(U[1].shape[0],1)
         Y = np.divide(Y, popul) * 10000
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Feature store of materialized feature matrices
+
+The features of one (year, region) are kept in the directory
+
+    ../data/feature-store/{region}-{year}/
+
+as one .npy file per feature block, plus manifest.json. The manifest lists
+for each block its file, shape, column names, and the size and mtime of
+the source files it is built from. A block is built on its first use, and
+built again when one of its source files changes. Later uses memory-map
+the .npy file, so only the columns that are read are loaded from disk.
+
+The blocks are
+
+    demographics - generate_corina_features
+    income, education, race - the xlsx demographics (CA only)
+    poi - getFourSquarePOIDistribution, POI count per category
+    taxi - getTaxiFlow, raw taxi flow with zero diagonal
+    spatial - the geographical spatial lag weight
+    lehd0, lehd4 - the raw LEHD flow of all jobs and of low income jobs
+
+The arrays are read-only. Copy them before changing them in place.
+
+Usage:
+    store = get_feature_store(2010, 'ca')
+    names, D = store.get('demographics')
+    x = store.column('demographics', 'poverty index')
+
+    python featureStore.py 2010     # build all blocks of 2010
+"""
+
+import numpy as np
+import json
+import time
+import tempfile
+import fcntl
+from FeatureUtils import (generate_corina_features, retrieve_income_features,
+                          retrieve_education_features, retrieve_race_features,
+                          generate_geographical_SpatialLag, generate_geographical_SpatialLag_ca,
+                          load_od_matrix, TRACT_DEMO_FILE)
+from foursquarePOI import getFourSquarePOIDistribution, getFourSquarePOIDistributionHeader
+from taxiFlow import getTaxiFlow
+from tract import LAYER_SHAPEFILES
+
+import os
+here = os.path.dirname(os.path.abspath(__file__))
+
+STORE_ROOT = here + '/../data/feature-store'
+DATA = here + '/../data/'
+# bump to rebuild all blocks after a change of the builders
+STORE_VERSION = 1
+
+
+
+def _build_demographics(year, region):
+    return generate_corina_features(region)
+
+
+def _build_income(year, region):
+    return retrieve_income_features()
+
+
+def _build_education(year, region):
+    return retrieve_education_features()
+
+
+def _build_race(year, region):
+    return retrieve_race_features()
+
+
+def _build_poi(year, region):
+    return getFourSquarePOIDistributionHeader(), getFourSquarePOIDistribution(gridLevel=region)
+
+
+def _build_taxi(year, region):
+    return None, getTaxiFlow(normalization="none", gridLevel=region)
+
+
+def _build_spatial(year, region):
+    if region == 'ca':
+        return None, generate_geographical_SpatialLag_ca()
+    W, ordkey = generate_geographical_SpatialLag()
+    return ordkey, W
+
+
+def _build_lehd(lehd_type):
+    def build(year, region):
+        W, ordkey = load_od_matrix(year, lehd_type, region)
+        return ordkey, W.toarray()
+    return build
+
+
+
+def _shapefile(region):
+    return [LAYER_SHAPEFILES[region][0] + ext for ext in ['.shp', '.dbf']]
+
+
+def _od_file(year, region):
+    if region == 'ca':
+        return [DATA + 'chicago_ca_od_{0}.csv'.format(year)]
+    return [DATA + 'chicago_od_tract_{0}.csv'.format(year)]
+
+
+"""
+Block name -> (regions, builder(year, region), source files(year, region)).
+A builder returns the column names (or None) and the array.
+"""
+BLOCKS = {
+    'demographics': (['ca', 'tract'], _build_demographics,
+                     lambda year, region: [DATA + 'Chicago_demographics.csv'] if region == 'ca'
+                                          else [TRACT_DEMO_FILE] + _shapefile(region)),
+    'income': (['ca'], _build_income, lambda year, region: [DATA + 'chicago-ca-income.xlsx']),
+    'education': (['ca'], _build_education, lambda year, region: [DATA + 'chicago-ca-education.xlsx']),
+    'race': (['ca'], _build_race, lambda year, region: [DATA + 'chicago-ca-race.xlsx']),
+    'poi': (['ca', 'tract'], _build_poi,
+            lambda year, region: [here + ('/POI_dist.csv' if region == 'ca' else '/POI_dist_tract.csv')]),
+    'taxi': (['ca', 'tract'], _build_taxi,
+             lambda year, region: [here + ('/taxi-CA-static.matrix' if region == 'ca' else '/TF_tract.csv')]),
+    'spatial': (['ca', 'tract'], _build_spatial, lambda year, region: _shapefile(region)),
+    'lehd0': (['ca', 'tract'], _build_lehd(0), _od_file),
+    'lehd4': (['ca', 'tract'], _build_lehd(4), _od_file),
+}
+
+
+
+def _stat(fname):
+    if not os.path.exists(fname):
+        return None
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime]
+
+
+
+class FeatureStore:
+    """
+    The materialized feature blocks of one year and region.
+    """
+
+    def __init__(self, year=2010, region='ca', root=STORE_ROOT):
+        self.year = year
+        self.region = region
+        self.path = os.path.join(root, '{0}-{1}'.format(region, year))
+        self.manifestFile = os.path.join(self.path, 'manifest.json')
+        self.arrays = {}
+        self.manifest = {'version': STORE_VERSION, 'year': year, 'region': region, 'blocks': {}}
+        if os.path.exists(self.manifestFile):
+            with open(self.manifestFile, 'r') as fin:
+                m = json.load(fin)
+            if m.get('version') == STORE_VERSION:
+                self.manifest = m
+
+
+    def blocks(self):
+        return sorted(k for k, v in BLOCKS.items() if self.region in v[0])
+
+
+    def sources(self, name):
+        return BLOCKS[name][2](self.year, self.region)
+
+
+    def is_valid(self, name):
+        """
+        Whether the block is built from the current source files
+        """
+        entry = self.manifest['blocks'].get(name)
+        if entry is None or not os.path.exists(os.path.join(self.path, entry['file'])):
+            return False
+        for fname in self.sources(name):
+            if entry['sources'].get(fname) != _stat(fname):
+                return False
+        return True
+
+
+    def build(self, name):
+        """
+        Build the block from its source files and add it to the manifest
+        """
+        if self.region not in BLOCKS[name][0]:
+            raise KeyError('No block {0} at {1} level'.format(name, self.region))
+        # stat the sources first, a change during the build invalidates it
+        sources = dict((fname, _stat(fname)) for fname in self.sources(name))
+        columns, a = BLOCKS[name][1](self.year, self.region)
+        a = np.ascontiguousarray(a, dtype=float)
+        if columns is not None:
+            columns = [c if isinstance(c, basestring) else int(c) for c in columns]
+
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        # a tmp file of its own, other processes may build the same block
+        fname = name + '.npy'
+        fd, tmp = tempfile.mkstemp(suffix='.tmp.npy', prefix=name + '.', dir=self.path)
+        with os.fdopen(fd, 'wb') as fout:
+            np.save(fout, a)
+        os.rename(tmp, os.path.join(self.path, fname))
+
+        self.arrays.pop(name, None)
+        self._update_manifest(name, {'file': fname, 'shape': list(a.shape),
+                                     'dtype': str(a.dtype), 'columns': columns,
+                                     'sources': sources, 'built': time.time()})
+
+
+    def _update_manifest(self, name, entry):
+        """
+        Add the block entry to the manifest on disk. The manifest is read
+        again under a file lock, so the entries that other processes wrote
+        in the meantime are kept.
+        """
+        with open(os.path.join(self.path, 'manifest.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self.manifestFile):
+                with open(self.manifestFile, 'r') as fin:
+                    m = json.load(fin)
+                if m.get('version') == STORE_VERSION:
+                    self.manifest = m
+            self.manifest['blocks'][name] = entry
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', prefix='manifest.', dir=self.path)
+            with os.fdopen(fd, 'w') as fout:
+                json.dump(self.manifest, fout, indent=2, sort_keys=True)
+            os.rename(tmp, self.manifestFile)
+
+
+    def get(self, name):
+        """
+        The column names (or None) and the read-only, memory-mapped array
+        of the block. The block is built first if it is missing or stale.
+        """
+        if name not in self.arrays or not self.is_valid(name):
+            if not self.is_valid(name):
+                self.build(name)
+            entry = self.manifest['blocks'][name]
+            self.arrays[name] = np.load(os.path.join(self.path, entry['file']), mmap_mode='r')
+        return self.manifest['blocks'][name]['columns'], self.arrays[name]
+
+
+    def column(self, name, col):
+        """
+        One named column of a block
+        """
+        columns, a = self.get(name)
+        return a[:, columns.index(col)]
+
+
+    def materialize(self):
+        """
+        Build all the stale blocks of this year and region
+        """
+        for name in self.blocks():
+            if not self.is_valid(name):
+                print "Build {0} of {1} {2}".format(name, self.region, self.year)
+                self.build(name)
+
+
+
+_stores = {}
+
+def get_feature_store(year=2010, region='ca'):
+    """
+    The feature store of (year, region), opened once per process
+    """
+    key = (year, region)
+    if key not in _stores:
+        _stores[key] = FeatureStore(year, region)
+    return _stores[key]
+
+
+
+if __name__ == '__main__':
+    import sys
+    years = [int(y) for y in sys.argv[1:]] or [2010]
+    for year in years:
+        for region in ['ca', 'tract']:
+            get_feature_store(year, region).materialize()
@@ -28,11 +28,16 @@ from FeatureUtils import retrieve_crime_count, generate_corina_features, \
     generate_geographical_SpatialLag_ca, generate_GWR_weight, get_centroid_ca, \
     retrieve_income_features, retrieve_averge_house_price
 from foursquarePOI import getFourSquarePOIDistribution
-from taxiFlow import getTaxiFlow, taxi_flow_normalization
+from featureStore import get_feature_store
+from taxiFlow import getTaxiFlow, taxi_flow_normalization, taxi_flow_normalization_loo
 import statsmodels.api as sm
+import multiprocessing
+from permutationEngine import permutation_indices, run_permutations
 import unittest
 
 N = 77
+# worker processes of the leave-one-out evaluation
+N_JOBS = multiprocessing.cpu_count()
 
 
 def extract_raw_samples(year=2010, crime_t=['total'], crime_rate=True):
@@ -40,7 +45,8 @@ def extract_raw_samples(year=2010, crime_t=['total'], crime_rate=True):
     Extract all samples with raw labels and features. Return None if the 
     corresponding feature is not selected.
     
-    This function is called once only to avoid unnecessary disk I/O.
+    This function is called once only to avoid unnecessary disk I/O. The
+    features are memory-mapped from the feature store, and are read-only.
     
     Input:
     year        - which year to study
@@ -54,11 +60,12 @@ def extract_raw_samples(year=2010, crime_t=['total'], crime_rate=True):
     Tf - taxi flow matrix (count)
     Gd - geo weight matrix
     """
+    store = get_feature_store(year, 'ca')
     # Crime count
     y_cnt = retrieve_crime_count(year, col = crime_t)
     
     # Crime rate / count
-    demo = generate_corina_features()
+    demo = store.get('demographics')
     population = demo[1][:,0].reshape(demo[1].shape[0], 1)
     Y = y_cnt / population * 10000 if crime_rate else y_cnt
     assert(Y.shape == (N,1))
@@ -67,13 +74,13 @@ def extract_raw_samples(year=2010, crime_t=['total'], crime_rate=True):
     D = demo[1]
     
     # POI features
-    P = getFourSquarePOIDistribution(useRatio=False)
+    P = store.get('poi')[1]
     
     # Taxi flow matrix
-    Tf = getTaxiFlow(normalization="none")
+    Tf = store.get('taxi')[1]
     
     # Geo weight matrix
-    Gd = generate_geographical_SpatialLag_ca()
+    Gd = store.get('spatial')[1]
     
     return Y, D, P, Tf, Gd
     
@@ -96,6 +103,16 @@ def permute_feature(features):
 
 
 
+def loo_mask(n, leaveOneOut):
+    """
+    Boolean mask of the training samples when sample `leaveOneOut` is tested
+    """
+    keep = np.ones(n, dtype=bool)
+    keep[leaveOneOut] = False
+    return keep
+
+
+
 def build_nodal_features( X, leaveOneOut):
     """
     Build nodal features for various prediction models.
@@ -109,18 +126,16 @@ def build_nodal_features( X, leaveOneOut):
     Xn is a (train, test) tuple.
     """
     assert leaveOneOut > -1
-    Xn = np.ones((76, 1))
-    Xn_test = [1]
-    for nodal_feature in X:
-        nodal_feature_loo = np.delete(nodal_feature, leaveOneOut, 0)    
-        Xn = np.concatenate((Xn, nodal_feature_loo), axis=1)
-        Xn_test = np.concatenate((Xn_test, nodal_feature[leaveOneOut, :]))
-    assert Xn.shape[0] == 76
+    n = X[0].shape[0] if len(X) > 0 else N
+    Xa = np.concatenate((np.ones((n, 1)),) + tuple(X), axis=1)
+    Xn = Xa[loo_mask(n, leaveOneOut)]
+    Xn_test = Xa[leaveOneOut]
+    assert Xn.shape[0] == n - 1
     return Xn, Xn_test 
 
 
 
-def build_taxi_features(Y, Tf, leaveOneOut, normalization="bydestination"):
+def build_taxi_features(Y, Tf, leaveOneOut, normalization="bydestination", Tf_norm=None):
     """
     Build taxi flow features.
     
@@ -128,32 +143,24 @@ def build_taxi_features(Y, Tf, leaveOneOut, normalization="bydestination"):
     Y - crime rate / count
     Tf - taxi flow count matrix. need normalization first.
     leaveOneOut - the index of testing region
+    Tf_norm - the (Tf_loo, Tf_test) of taxi_flow_normalization_loo for all
+              folds, or None to normalize the left out fold only
     
     Output:
     T - taxi flow feature, calculated by
             T = Tf * Y
     T is a (train, test) tuple.
     """
-    # leave one out
-    if leaveOneOut > -1:
-        Tf_loo = np.delete(Tf, leaveOneOut, 0)
-        Tf_loo = np.delete(Tf_loo, leaveOneOut, 1)
-        Y_loo = np.delete(Y, leaveOneOut, 0)
-        
-    # taxi flow normalization (by destination)
-    Tf_norml = taxi_flow_normalization(Tf_loo, normalization)
+    keep = loo_mask(Tf.shape[0], leaveOneOut)
+    if Tf_norm is None:
+        Tf_norml, Tf_test = taxi_flow_normalization_loo(Tf, normalization, [leaveOneOut])
+        Tf_norml, Tf_test = Tf_norml[0], Tf_test[0]
+    else:
+        Tf_norml, Tf_test = Tf_norm[0][leaveOneOut], Tf_norm[1][leaveOneOut]
+    Y_loo = Y[keep]
     
     # calculate taxi flow feature
     T = np.dot(Tf_norml, Y_loo)
-
-    # for testing sample
-    if normalization == "bydestination":
-        Tf_test = Tf[:,leaveOneOut]
-    elif normalization == "bysource" or normalization == "none":
-        Tf_test = Tf[leaveOneOut,:]
-    Tf_test = np.delete(Tf_test, leaveOneOut).astype(float)
-    if normalization != "none":
-        Tf_test /= np.sum(Tf_test) if np.sum(Tf_test) != 0 else 1
     return T, np.dot(Tf_test, Y_loo)
         
     
@@ -173,16 +180,14 @@ def build_geo_features(Y, Gd, leaveOneOut=-1):
     G is a (train, test) tuple.
     """
     assert leaveOneOut > -1
-    Gd_loo = np.delete(Gd, leaveOneOut, 0)
-    Gd_loo = np.delete(Gd_loo, leaveOneOut, 1)
-    Y_loo = np.delete(Y, leaveOneOut, 0)
+    keep = loo_mask(Gd.shape[0], leaveOneOut)
+    Y_loo = Y[keep]
+    return np.dot(Gd[np.ix_(keep, keep)], Y_loo), np.dot(Gd[leaveOneOut, keep], Y_loo)
 
-    Gd_test = np.delete(Gd[leaveOneOut, :], leaveOneOut)
-    return np.dot(Gd_loo, Y_loo), np.dot(Gd_test, Y_loo)
 
 
-
-def build_features(Y, D, P, Tf, Yt, Gd, Yg, testK, features=['all'], taxi_norm="bydestination"):
+def build_features(Y, D, P, Tf, Yt, Gd, Yg, testK, features=['all'], taxi_norm="bydestination",
+                   Tf_norm=None):
     """
     Build features for both training and testing samples in leave one out setting.
 
@@ -196,6 +201,7 @@ def build_features(Y, D, P, Tf, Yt, Gd, Yg, testK, features=['all'], taxi_norm="
     Yg - crime vector for geo feature calculation
     testK - index of testing sample    
     features    - a list features. ['all'] == ['demo', 'poi', 'geo', 'taxi']
+    Tf_norm - the taxi flow normalization of all folds, see build_taxi_features
     
     Output:
     X_train
@@ -213,7 +219,7 @@ def build_features(Y, D, P, Tf, Yt, Gd, Yg, testK, features=['all'], taxi_norm="
     X_test = Xn[1]
     
     if 'all' in features or 'taxi' in features:
-        T = build_taxi_features(Yt, Tf, testK, taxi_norm)
+        T = build_taxi_features(Yt, Tf, testK, taxi_norm, Tf_norm)
         X_train = np.concatenate((X_train, T[0]), axis=1)
         X_test = np.concatenate((X_test, T[1]))
         
@@ -221,31 +227,94 @@ def build_features(Y, D, P, Tf, Yt, Gd, Yg, testK, features=['all'], taxi_norm="
         G = build_geo_features(Yg, Gd, testK)
         X_train = np.concatenate((X_train, G[0]), axis=1)
         X_test = np.concatenate((X_test, G[1]))
-    Y_train = np.delete(Y, testK)
+    Y_train = Y[loo_mask(len(Y), testK), 0]
     Y_test = Y[testK, 0]
     return X_train, X_test, Y_train, Y_test
-    
 
-def leaveOneOut_error(Y, D, P, Tf, Yt, Gd, Yg, features=['all'], gwr_gamma=None, taxi_norm="bydestination"):
+
+
+def build_full_features(Y, D, P, Tf, Yt, Gd, Yg, features=['all'], taxi_norm="bydestination"):
+    """
+    Build the features of all samples without leaving one out, in the same
+    column order as build_features.
+    """
+    X = [np.ones((len(Y), 1))]
+    if 'all' in features or 'demo' in features:
+        X.append(D)
+    if 'all' in features or 'poi' in features:
+        X.append(P)
+    if 'all' in features or 'taxi' in features:
+        X.append(np.dot(taxi_flow_normalization(Tf, taxi_norm), Yt))
+    if 'all' in features or 'geo' in features:
+        X.append(np.dot(Gd, Yg))
+    return np.concatenate(X, axis=1), Y[:,0]
+
+
+
+_folds = {}
+
+def _init_folds(data):
+    _folds.update(data)
+
+
+def _fold_prediction(k):
+    """
+    Fit the NB model of the leave-one-out fold k and predict the test sample,
+    on the data set up by _init_folds.
+    """
+    d = _folds
+    X_train, X_test, Y_train, Y_test = build_features(d['Y'], d['D'], d['P'], d['Tf'], d['Yt'], d['Gd'],
+                                                      d['Yg'], k, d['features'], d['taxi_norm'],
+                                                      d['Tf_norm'])
+    gwr_gamma = d['gwr_gamma']
+    gamma = gwr_gamma[loo_mask(len(d['Y']), k), k] if gwr_gamma is not None else None
+    # Train NegativeBinomial Model from statsmodels library
+    nbm = sm.GLM(Y_train, X_train, family=sm.families.NegativeBinomial(), freq_weights=gamma)
+    nb_res = nbm.fit(start_params=d['start'])
+    return nbm.predict(nb_res.params, X_test)
+    
+
+def leaveOneOut_error(Y, D, P, Tf, Yt, Gd, Yg, features=['all'], gwr_gamma=None, taxi_norm="bydestination",
+                      n_jobs=1):
     """
     Use GLM model from python statsmodels library to fit data.
     Evaluate with leave-one-out setting, return the average of n errors.
     
+    Every fold starts from the coefficients fitted on all samples, and the
+    taxi flow of all folds is normalized once. The folds run in `n_jobs`
+    worker processes, which get the data once when they start. The errors are collected in fold order, so the result does not
+    depend on the number of workers.
+    
     Input:    
     features    - a list features. ['all'] == ['demo', 'poi', 'geo', 'taxi']
     gwr_gamma   - the GWR weight matrx
+    n_jobs      - number of worker processes
 
     Output:
     error - the average error of k leave-one-out evaluation
     """
+    X_full, Y_full = build_full_features(Y, D, P, Tf, Yt, Gd, Yg, features, taxi_norm)
+    start = sm.GLM(Y_full, X_full, family=sm.families.NegativeBinomial()).fit().params
+    
+    Tf_norm = None
+    if 'all' in features or 'taxi' in features:
+        Tf_norm = taxi_flow_normalization_loo(Tf, taxi_norm)
+    data = {'Y': Y, 'D': D, 'P': P, 'Tf': Tf, 'Yt': Yt, 'Gd': Gd, 'Yg': Yg, 'features': features,
+            'gwr_gamma': gwr_gamma, 'taxi_norm': taxi_norm, 'start': start, 'Tf_norm': Tf_norm}
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, _init_folds, (data,))
+        try:
+            ybars = pool.map(_fold_prediction, range(len(Y)))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        _init_folds(data)
+        ybars = map(_fold_prediction, range(len(Y)))
+    
     errors = []
-    for k in range(len(Y)):
-        X_train, X_test, Y_train, Y_test = build_features(Y, D, P, Tf, Yt, Gd, Yg, k, features, taxi_norm)
-        gamma = np.delete(gwr_gamma[:,k], k) if gwr_gamma is not None else None
-        # Train NegativeBinomial Model from statsmodels library
-        nbm = sm.GLM(Y_train, X_train, family=sm.families.NegativeBinomial(), freq_weights=gamma)
-        nb_res = nbm.fit()
-        ybar = nbm.predict(nb_res.params, X_test)
+    for k, ybar in enumerate(ybars):
+        Y_test = Y[k, 0]
         y_error = np.abs(ybar - Y_test)
         if y_error > 20 * Y_test:
             print k, y_error, Y_test
@@ -255,30 +324,156 @@ def leaveOneOut_error(Y, D, P, Tf, Yt, Gd, Yg, features=['all'], gwr_gamma=None,
 
 
 
-def permutation_test_significance(Y, D, P, Tf, Gd, n, to_permute="demo"):
+class FoldBlocks:
     """
-    Permutation test on selected features to return significance.
+    The leave-one-out blocks shared by all permutations of one data set.
+    
+    For every fold k it keeps the normalized taxi flow matrix and the geo
+    weight matrix of the training regions, and the weight vectors of the
+    test region. A permuted crime vector then only needs one batched matrix
+    product to give the lag features of all folds.
     """
-    model_error = leaveOneOut_error(Y, D, P, Tf, Y, Gd, Y)
-    Yt = np.copy(Y)
-    Yg = np.copy(Y)
-    cnt = 0.0
-    for i in range(n):
-        if i % (n/10) == 0:
-            print "Permutation test {0}%, current pvalue {1} ...".format(i/(n/10)*10, cnt/n)
-        if to_permute == "demo":
-            D = permute_feature(D)
-        elif to_permute == "poi":
-            P = permute_feature(P)
-        elif to_permute == "taxi":
-            Yt = permute_feature(Yt)
-        elif to_permute == "geo":
-            Yg = permute_feature(Yg)
-        else:
+    
+    def __init__(self, Y, D, P, Tf, Gd, features=['all'], taxi_norm="bydestination"):
+        n = len(Y)
+        self.Y = Y[:,0]
+        self.D = D
+        self.P = P
+        self.features = features
+        self.masks = np.array([loo_mask(n, k) for k in range(n)])
+        # index of the training regions of each fold, shape (n, n-1)
+        self.train = np.array([np.nonzero(m)[0] for m in self.masks])
+        
+        self.blocks = []
+        if 'all' in features or 'taxi' in features:
+            self.blocks.append('taxi')
+            self.Tf_loo, self.Tf_test = taxi_flow_normalization_loo(Tf, taxi_norm)
+        if 'all' in features or 'geo' in features:
+            self.blocks.append('geo')
+            self.Gd_loo = np.array([Gd[np.ix_(tr, tr)] for tr in self.train])
+            self.Gd_test = np.array([Gd[k, tr] for k, tr in enumerate(self.train)])
+    
+    
+    def lag(self, W_loo, W_test, Yb):
+        """
+        Lag features of a batch of crime vectors Yb, shape (B, n).
+        
+        Output:
+            training features (B, n, n-1), test features (B, n)
+        """
+        Yk = Yb[:, self.train]
+        train = np.matmul(W_loo[None], Yk[...,None])[...,0]
+        test = np.sum(W_test[None] * Yk, axis=2)
+        return train, test
+    
+    
+    def design(self, D, P, Tlag=None, Glag=None):
+        """
+        Full design of every fold, in the column order of build_features.
+        Tlag and Glag are the (train, test) lag features of one crime vector.
+        
+        Output:
+            a list of (X_train, X_test) tuples, one per fold
+        """
+        X = [np.ones((len(self.Y), 1))]
+        if 'all' in self.features or 'demo' in self.features:
+            X.append(D)
+        if 'all' in self.features or 'poi' in self.features:
+            X.append(P)
+        Xn = np.concatenate(X, axis=1)
+        
+        folds = []
+        for k, m in enumerate(self.masks):
+            X_train = [Xn[m]]
+            X_test = [Xn[k]]
+            for lag in (Tlag, Glag):
+                if lag is not None:
+                    X_train.append(lag[0][k][:,None])
+                    X_test.append(lag[1][k:k+1])
+            folds.append((np.concatenate(X_train, axis=1), np.concatenate(X_test)))
+        return folds
+    
+    
+    def error(self, folds, start=None):
+        """
+        Leave-one-out MAE and MRE of the NB model on the fold designs
+        """
+        errors = []
+        for k, (X_train, X_test) in enumerate(folds):
+            Y_train = self.Y[self.masks[k]]
+            nbm = sm.GLM(Y_train, X_train, family=sm.families.NegativeBinomial())
+            ybar = nbm.predict(nbm.fit(start_params=start).params, X_test)
+            y_error = np.abs(ybar - self.Y[k])
+            if y_error > 20 * self.Y[k]:
+                continue
+            errors.append(y_error)
+        return np.mean(errors), np.mean(errors) / np.mean(self.Y)
+    
+    
+    def evaluate(self, perms, to_permute, start=None):
+        """
+        Leave-one-out errors with the feature `to_permute` permuted by each
+        row of perms. Only the permuted block is recomputed, and the lag
+        features of the whole batch come from one matrix product.
+        
+        Output:
+            (B, 2) array of MAE and MRE
+        """
+        if to_permute not in ["demo", "poi", "taxi", "geo"]:
             raise ValueError("Feature to_permute not found.")
-        perm_error = leaveOneOut_error(Y, D, P, Tf, Yt, Gd, Yg)
-        if perm_error < model_error:
-            cnt += 1
+        fixed = {}
+        permuted = {}
+        for name in self.blocks:
+            W_loo, W_test = (self.Tf_loo, self.Tf_test) if name == 'taxi' else (self.Gd_loo, self.Gd_test)
+            if name == to_permute:
+                permuted[name] = self.lag(W_loo, W_test, self.Y[perms])
+            else:
+                train, test = self.lag(W_loo, W_test, self.Y[None])
+                fixed[name] = (train[0], test[0])
+        
+        res = []
+        for b, perm in enumerate(perms):
+            D = self.D[perm] if to_permute == "demo" else self.D
+            P = self.P[perm] if to_permute == "poi" else self.P
+            lags = dict(fixed)
+            for name, (train, test) in permuted.items():
+                lags[name] = (train[b], test[b])
+            res.append(self.error(self.design(D, P, lags.get('taxi'), lags.get('geo')), start))
+        return np.array(res)
+
+
+
+_fold_blocks = {}
+
+def _init_permutation(blocks, to_permute, start):
+    _fold_blocks['blocks'] = blocks
+    _fold_blocks['to_permute'] = to_permute
+    _fold_blocks['start'] = start
+
+
+def _evaluate_permutations(perms):
+    return _fold_blocks['blocks'].evaluate(perms, _fold_blocks['to_permute'], _fold_blocks['start'])
+
+
+
+def permutation_test_significance(Y, D, P, Tf, Gd, n, to_permute="demo", seed=0, n_jobs=1,
+                                  checkpoint=None):
+    """
+    Permutation test on selected features to return significance.
+    
+    The n permutations are drawn from a RNG with the given seed. They run
+    in `n_jobs` worker processes, and the finished results are saved to the
+    `checkpoint` file, so that an interrupted test resumes from there.
+    """
+    blocks = FoldBlocks(Y, D, P, Tf, Gd)
+    X_full, Y_full = build_full_features(Y, D, P, Tf, Y, Gd, Y)
+    start = sm.GLM(Y_full, X_full, family=sm.families.NegativeBinomial()).fit().params
+    model_error = blocks.evaluate(np.arange(len(Y))[None], to_permute, start)[0]
+    
+    perms = permutation_indices(len(Y), n, seed)
+    errors = run_permutations(_evaluate_permutations, perms, _init_permutation,
+                              (blocks, to_permute, start), n_jobs, checkpoint=checkpoint)
+    cnt = float(np.sum(errors[:,0] < model_error[0]))
     print "Significance for {0} is {1} with {2} permutations.".format(to_permute, cnt/n, n)
     return cnt / n
 
@@ -364,7 +559,7 @@ def main_evaluate_different_years(year):
         Tf = getTaxiFlow(filename="/taxi-CA-h{0}.matrix".format(h))
         mae, mre = leaveOneOut_error(Yh[h,:].reshape((N,1)), D, P, Tf, Yh[h,:].reshape((N,1)), Gd, 
                                      Yh[h,:].reshape((N,1)), features=['demo', 'poi'],
-                                       taxi_norm="bydestination")
+                                       taxi_norm="bydestination", n_jobs=N_JOBS)
         print h, mae, mre
         MAE.append(mae)
         MRE.append(mre)
@@ -378,7 +573,8 @@ def main_calculate_significance():
     sig = {}
     for f in ["demo", "geo", "taxi", "poi"]:
         Y, D, P, Tf, Gd = extract_raw_samples(2010, crime_t=['total'])
-        s = permutation_test_significance(Y, D, P, Tf, Gd, 2000, to_permute=f)
+        s = permutation_test_significance(Y, D, P, Tf, Gd, 2000, to_permute=f, n_jobs=N_JOBS,
+                                          checkpoint="significance-{0}.npz".format(f))
         sig[f] = s
     import pickle
     pickle.dump(sig, open("significance", 'w'))
@@ -395,7 +591,7 @@ def main_evaluate_feature_setting(year=2010, crime_t=['total']):
     gwnbr_MAEs = []
     gwnbr_MREs = []
     for feature_setting in feature_settings:
-        mae, mre = leaveOneOut_error(Y, D, P, Tf, Y, Gd, Y, feature_setting)
+        mae, mre = leaveOneOut_error(Y, D, P, Tf, Y, Gd, Y, feature_setting, n_jobs=N_JOBS)
         nb_MAEs.append(mae)
         nb_MREs.append(mre)
         # Tune bandwidth for GWR model
@@ -403,7 +599,7 @@ def main_evaluate_feature_setting(year=2010, crime_t=['total']):
         gwr_mre = 1.0
         for h in H:
             gwr_gamma = generate_GWR_weight(h)
-            mae, mre = leaveOneOut_error(Y, D, P, Tf, Y, Gd, Y, feature_setting, gwr_gamma)
+            mae, mre = leaveOneOut_error(Y, D, P, Tf, Y, Gd, Y, feature_setting, gwr_gamma, n_jobs=N_JOBS)
             if mae < gwr_mae:
                 gwr_mae = mae
                 gwr_mre = mre
@@ -449,7 +645,7 @@ def main_compare_taxi_normalization_method():
             best_h = 0
             for h in H:
                 gwr_gamma = generate_GWR_weight(h)
-                mae, mre = leaveOneOut_error(Y, D, P, Tf, Y, Gd, Y, ["all"], gwr_gamma, taxi_norm)
+                mae, mre = leaveOneOut_error(Y, D, P, Tf, Y, Gd, Y, ["all"], gwr_gamma, taxi_norm, N_JOBS)
                 if mae < gwr_mae:
                     gwr_mae = mae
                     gwr_mre = mre
@@ -3,6 +3,10 @@
 Generate the foursquare POI feature of Chicago.
 Use the POI data at
     ../data/all_POIs_chicago
+or its compact copy made by poiStore.py.
+
+The features of tracts and CAs are generated in one run,
+    python foursquarePOI.py
 
 Created on Tue Jan 26 11:09:49 2016
 
@@ -11,7 +15,9 @@ Created on Tue Jan 26 11:09:49 2016
 
 
 from Crime import Tract
-from shapely.geometry import Point
+from regionAssign import assign_regions, region_index
+from matrixCache import load_matrix, cached
+from poiStore import POIStore, POI_FILE, STORE_DIR
 import pickle
 import numpy as np
         
@@ -25,13 +31,19 @@ here = os.path.dirname(os.path.abspath(__file__))
 def getFourSquareCount(leaveOut = -1):
     """
     retrieve Foursquare count from local file
+    
+    The result is read-only, see matrixCache.
     """
-    s = np.loadtxt("POI_cnt.csv", delimiter=",")
+    fname = here + "/POI_cnt.csv"
+    return cached(('poi_cnt', leaveOut), fname, lambda: _leaveOut_rows(load_matrix(fname), leaveOut))
     
+
+
+def _leaveOut_rows(d, leaveOut):
     if leaveOut > 0:
-        s = np.delete(s, leaveOut-1, 0)
-    return s
-    
+        return d[np.arange(d.shape[0]) != leaveOut-1]
+    return np.array(d)
+
 
 def getFourSquarePOIDistributionHeader():
     header = ['Food', 'Residence', 'Travel', 'Arts & Entertainment', 
@@ -43,111 +55,142 @@ def getFourSquarePOIDistributionHeader():
 def getFourSquarePOIDistribution( leaveOut = -1, gridLevel = 'ca', useRatio=False):
     """
     retrieve Foursquare POI distribution from local file
+    
+    The result is read-only, see matrixCache.
     """
     if gridLevel == 'ca':
-        d = np.loadtxt(here + "/POI_dist.csv", delimiter=",")
+        fname = here + "/POI_dist.csv"
     elif gridLevel == 'tract':
-        d = np.loadtxt(here + '/POI_dist_tract.csv', delimiter=",")
+        fname = here + '/POI_dist_tract.csv'
     
-    if leaveOut > 0:
-        d = np.delete(d, leaveOut-1, 0)
-        
-    if useRatio:
-        poi_sum = np.sum(d, axis=1)
-        for i in range(len(poi_sum)):
-            d[i] = d[i] / poi_sum[i]
-        d = np.nan_to_num(d)
+    def load():
+        d = _leaveOut_rows(load_matrix(fname), leaveOut)
+        if useRatio:
+            poi_sum = np.sum(d, axis=1, keepdims=True)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                d = np.nan_to_num(d / poi_sum)
+        return d
     
-    return d
+    return cached(('poi_dist', leaveOut, useRatio), fname, load)
     
     
     
-def generatePOIfeature(gridLevel = 'ca'):
+# columns of the POI count files
+POI_CNT_COLUMNS = ['checkin_count', 'user_count', 'poi_count']
+
+
+
+def _store_is_current(fname, storeDir):
+    store = os.path.join(storeDir, 'pois.npy')
+    if not os.path.exists(store):
+        return False
+    return not os.path.exists(fname) or os.stat(store).st_mtime >= os.stat(fname).st_mtime
+
+
+
+def load_poi_columns(fname=POI_FILE, storeDir=STORE_DIR):
     """
-    generate POI features and write out to a file
+    Load the POIs of the categories in category_hierarchy.pickle as columns
     
-    regionLevel could be "ca" or "tract"
+    The POIs are read from the compact store of poiStore if it is newer
+    than the pickle `fname`, and unpickled otherwise.
     
-    ['Food', 'Residence', 'Travel', 'Arts & Entertainment', 
-    'Outdoors & Recreation', 'College & Education', 'Nightlife', 
-    'Professional', 'Shops', 'Event']
+    Output:
+        a dict of the arrays lon, lat, cat (index of the top level category
+        in getFourSquarePOIDistributionHeader), checkin_count and user_count
     """
-    if gridLevel == 'ca':
-        cas = Tract.createAllCAObjects()
-    elif gridLevel == 'tract':
-        cas = Tract.createAllTractObjects()
-
-    ordKey = sorted(cas.keys())
+    with open(here + '/category_hierarchy.pickle', 'r') as f2:
+        poi_cat = pickle.load(f2)
+    header = getFourSquarePOIDistributionHeader()
+    code = dict((c, header.index(top)) for c, top in poi_cat.items())
     
-    gcn = np.zeros((len(cas), 3))   # check-in count, user count, and POI count
-    gcat = {}
+    if _store_is_current(fname, storeDir):
+        store = POIStore(storeDir)
+        cat = store.category_codes(code)
+        valid = cat >= 0
+        return {'lon': np.array(store.pois['lon'][valid], dtype=float),
+                'lat': np.array(store.pois['lat'][valid], dtype=float),
+                'cat': cat[valid].astype(np.int16),
+                'checkin_count': np.array(store.pois['checkin_count'][valid], dtype=float),
+                'user_count': np.array(store.pois['user_count'][valid], dtype=float)}
     
-    with open('../data/all_POIs_chicago', 'r') as fin:
+    with open(fname, 'r') as fin:
         POIs = pickle.load(fin)
-        
-    with open('category_hierarchy.pickle', 'r') as f2:
-        poi_cat = pickle.load(f2)
+    pois = [poi for poi in POIs.values() if poi.cat in code]
+    return {'lon': np.array([poi.location.lon for poi in pois], dtype=float),
+            'lat': np.array([poi.location.lat for poi in pois], dtype=float),
+            'cat': np.array([code[poi.cat] for poi in pois], dtype=np.int16),
+            'checkin_count': np.array([poi.checkin_count for poi in pois], dtype=float),
+            'user_count': np.array([poi.user_count for poi in pois], dtype=float)}
+
+
+
+def aggregate_pois(pois, ridx, n):
+    """
+    POI features of n regions, given the region index `ridx` of each POI
+    (-1 if it is in no region)
     
-    cnt = 0
-    for poi in POIs.values():
-        loc = Point(poi.location.lon, poi.location.lat)
-        if poi.cat in poi_cat:
-            cat = poi_cat[poi.cat]
-        else:
-            continue
-        
-        for key, grid in cas.items():
-            if grid.polygon.contains(loc):
-                gcn[ordKey.index(key),0] += poi.checkin_count
-                gcn[ordKey.index(key),1] += poi.user_count
-                gcn[ordKey.index(key),2] += 1
-                """
-                Build a two-level dictionary,
-                first index by region id,
-                then index by category id,
-                finally, the value is number of POI under the category.
-                """
-                if key in gcat:
-                    if cat in gcat[key]:
-                        gcat[key][cat] += 1
-                    else:
-                        gcat[key][cat] = 1
-                else:
-                    gcat[key] = {}
-                    gcat[key][cat] = 1
-                    
-                # break the polygon loop
-                cnt += 1
-                break
-    
-    s = 0
-    hi_catgy = []
-    for catdict in gcat.values():
-        hi_catgy += catdict.keys()
-        for c in catdict.values():
-            s += c
-            
-    hi_catgy = list(set(hi_catgy))
-    print hi_catgy
+    Output:
+        dist - (n, categories) POI count of each category
+        cnt - (n, 3) check-in count, user count and POI count
+    """
+    ncat = len(getFourSquarePOIDistributionHeader())
+    valid = ridx >= 0
+    idx = ridx[valid]
+    dist = np.bincount(idx * ncat + pois['cat'][valid], minlength=n * ncat).reshape((n, ncat))
+    cnt = np.column_stack([np.bincount(idx, weights=pois[c][valid], minlength=n)
+                           for c in POI_CNT_COLUMNS[:2]] + [np.bincount(idx, minlength=n)])
+    return dist.astype(float), cnt
+
+
+
+def generatePOIfeature(pois=None):
+    """
+    generate POI features of tracts and CAs and write out to the files
     
+        POI_dist_tract.csv, POI_cnt_tract.csv, POI_tract.pickle
+        POI_dist.csv, POI_cnt.csv
     
-    gdist = np.zeros( (len(cas), len(hi_catgy)) )
-    for key, distDict in gcat.items():
-        for idx, cate in enumerate(hi_catgy):
-            if cate in distDict:            
-                gdist[ordKey.index(key), idx] = distDict[cate]
-            else:
-                gdist[ordKey.index(key), idx] = 0
-                
-    if gridLevel == 'ca':
-        np.savetxt(here + "/POI_dist.csv", gdist, delimiter="," )
-        np.savetxt(here + "/POI_cnt.csv", gcn, delimiter="," )
-    elif gridLevel == 'tract':
-        np.savetxt(here + "/POI_dist_tract.csv", gdist, delimiter="," )
-        np.savetxt(here + "/POI_cnt_tract.csv", gcn, delimiter="," )
-        with open(here + "/POI_tract.pickle", 'w') as fout:
-            pickle.dump(ordKey, fout)
-            pickle.dump(gcat, fout)
+    The POIs are assigned to tracts, and a CA gets the POIs of its tracts
+    by the tract to CA reference.
+    The columns of POI_dist are in the order of
+    getFourSquarePOIDistributionHeader, and those of POI_cnt are check-in
+    count, user count, and POI count.
+    
+    Input:
+        pois - the POI columns as load_poi_columns, loaded if None
+    """
+    from CAFeature import get_Tract_CA_ref
+    
+    if pois is None:
+        pois = load_poi_columns()
+    tracts = Tract.createAllTractObjects()
+    ordKey = sorted(tracts.keys())
+    tidx = region_index(assign_regions(pois['lon'], pois['lat'], tracts), ordKey)
+    gdist, gcn = aggregate_pois(pois, tidx, len(ordKey))
+    
+    # CA index of each tract, -1 if the tract has no CA. The last entry is
+    # for the POIs outside all tracts (tidx -1)
+    TC_ref = get_Tract_CA_ref()
+    tract_ca = np.array([TC_ref.get(k, 0) for k in ordKey] + [0]) - 1
+    cdist, ccn = aggregate_pois(pois, tract_ca[tidx], 77)
+    
+    np.savetxt(here + "/POI_dist.csv", cdist, delimiter="," )
+    np.savetxt(here + "/POI_cnt.csv", ccn, delimiter="," )
+    np.savetxt(here + "/POI_dist_tract.csv", gdist, delimiter="," )
+    np.savetxt(here + "/POI_cnt_tract.csv", gcn, delimiter="," )
+    
+    """
+    The two-level dictionary of tract id, then category, to the number of
+    POIs, for tract_poi_profile
+    """
+    header = getFourSquarePOIDistributionHeader()
+    gcat = {}
+    for i in np.nonzero(gcn[:,2])[0]:
+        gcat[ordKey[i]] = dict((header[j], int(gdist[i,j])) for j in np.nonzero(gdist[i])[0])
+    with open(here + "/POI_tract.pickle", 'w') as fout:
+        pickle.dump(ordKey, fout)
+        pickle.dump(gcat, fout)
     
     
 
@@ -209,6 +252,6 @@ if __name__ == '__main__':
         elif sys.argv[1] == "poiProfile":
             tp = tract_poi_profile()
     else:
-        generatePOIfeature(gridLevel='tract')
+        generatePOIfeature()
 
 #    np.savetxt("../R/poi_dist.csv", d, delimiter=",")
@@ -10,7 +10,7 @@ Created on Fri May 19 20:30:20 2017
 
 from tract import Tract
 import pandas as pd
-from shapely.geometry import Point
+from regionAssign import assign_regions
 import pickle
 
 
@@ -28,13 +28,11 @@ def retrieve_CA_avg_house_price():
     house_cnt = {k:0 for k in cas.keys()}
     avg_price = {k:0.0 for k in cas.keys()}
     
-    for idx, house in houses.iterrows():
-        p = Point(house.lon, house.lat)
-        for k, ca in cas.items():
-            if ca.polygon.contains(p):
-                house_cnt[k] += 1
-                avg_price[k] += house.priceSqft
-                break
+    rid = assign_regions(houses.lon.values, houses.lat.values, cas)
+    for k, price in zip(rid.tolist(), houses.priceSqft.values):
+        if k != -1:
+            house_cnt[k] += 1
+            avg_price[k] += price
     
     for k in house_cnt.keys():
         if house_cnt[k] == 0:
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+Background jobs of the chicago_crime_server.
+
+A request submits a job and gets the job id back at once. At most `workers`
+jobs run at the same time, each in a fresh process, so every job has its
+own stdout, stderr and working directory. The job processes are not
+daemonic, and may start their own multiprocessing pools. Each job keeps its
+files in jobs/<job id>/:
+
+    status.json - status (queued, running, done, failed), times, progress
+    log.txt     - everything the job prints, including child processes
+    stderr.txt  - the standard error of the job and its child processes,
+                  e.g. warnings and tracebacks
+    result.json - the return value of the job function
+
+The status is kept on disk, so it can be read by any server process.
+
+The job id is the SHA-1 of the function name and the canonical JSON of its
+arguments. A job submitted again with the same arguments gets the id of the
+queued, running or finished job, and only a failed job runs again. The
+jobs are also listed in the sqlite table jobs/index.db, so they can be
+listed without opening the job directories. The jobs that a restarted
+server finds queued or running are marked failed. Results made outside the
+queue, e.g. by earlier versions of the server, can be added to the index
+with import_results.
+
+Usage:
+    queue = JobQueue(workers=2)
+    job_id = queue.submit(coefficients_pvalue, "1100", itersN=10)
+    queue.status(job_id)
+"""
+
+import multiprocessing
+import threading
+import traceback
+import hashlib
+import sqlite3
+import Queue
+import json
+import time
+import sys
+import os
+import permutationEngine
+here = os.path.dirname(os.path.abspath(__file__))
+
+JOB_ROOT = here + '/jobs'
+INDEX_COLUMNS = ['id', 'function', 'description', 'params', 'status', 'submitted', 'finished']
+
+
+
+def _to_json(o):
+    if hasattr(o, 'tolist'):
+        return o.tolist()
+    return str(o)
+
+
+
+def _write_json(fname, obj):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as fout:
+        json.dump(obj, fout, default=_to_json)
+    os.rename(tmp, fname)
+
+
+
+def _read_json(fname):
+    with open(fname, 'r') as fin:
+        return json.load(fin)
+
+
+
+def job_key(func, args, kwargs):
+    """
+    SHA-1 of the function name and its arguments in canonical JSON
+    """
+    params = json.dumps([func.__name__, list(args), kwargs], sort_keys=True,
+                        separators=(',', ':'), default=_to_json)
+    return hashlib.sha1(params.encode('utf-8')).hexdigest(), params
+
+
+
+def _connect(root):
+    db = sqlite3.connect(os.path.join(root, 'index.db'), timeout=60)
+    db.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, function TEXT, '
+               'description TEXT, params TEXT, status TEXT, submitted REAL, finished REAL)')
+    db.execute('CREATE INDEX IF NOT EXISTS jobs_submitted ON jobs (submitted)')
+    return db
+
+
+
+def _update_status(jobdir, **kwargs):
+    fname = os.path.join(jobdir, 'status.json')
+    s = _read_json(fname)
+    s.update(kwargs)
+    _write_json(fname, s)
+
+
+
+def _run_job(jobdir, func, args, kwargs):
+    """
+    Run one job in the worker process.
+    """
+    log = open(os.path.join(jobdir, 'log.txt'), 'w', 1)
+    err = open(os.path.join(jobdir, 'stderr.txt'), 'w', 1)
+    # redirect the file descriptors too, so that Rscript output is captured.
+    # stderr has its own file, so warnings do not mix into the parsed output
+    os.dup2(log.fileno(), 1)
+    os.dup2(err.fileno(), 2)
+    sys.stdout = log
+    sys.stderr = err
+    os.chdir(jobdir)
+
+    def report(done, total):
+        _update_status(jobdir, progress=float(done) / total)
+    permutationEngine.progress_hook = report
+
+    _update_status(jobdir, status='running', started=time.time())
+    try:
+        res = func(*args, **kwargs)
+        _write_json(os.path.join(jobdir, 'result.json'), res)
+        _update_status(jobdir, status='done', finished=time.time(), progress=1.0)
+    except Exception as exc:
+        traceback.print_exc()
+        _update_status(jobdir, status='failed', finished=time.time(), error=repr(exc))
+    finally:
+        # fd 1 and 2 still point to the job files, multiprocessing flushes
+        # sys.stdout and sys.stderr at exit
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        log.close()
+        err.close()
+
+
+
+class JobQueue:
+    """
+    Run the submitted jobs in worker processes, `workers` at a time.
+    """
+
+    def __init__(self, workers=2, root=JOB_ROOT):
+        self.workers = workers
+        self.root = os.path.abspath(root)
+        self.pending = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        if not os.path.exists(root):
+            os.makedirs(root)
+        _connect(root).close()
+        self._fail_interrupted()
+
+
+    def _fail_interrupted(self):
+        """
+        Mark the jobs left queued or running by an earlier server process as
+        failed, so that submitting them again runs them. There is one server
+        process per job root.
+        """
+        db = _connect(self.root)
+        rows = db.execute("SELECT id FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+        db.close()
+        for (job_id,) in rows:
+            if self.exists(job_id):
+                _update_status(self.jobdir(job_id), status='failed', finished=time.time(),
+                               error='interrupted by a server restart')
+            self._index_status(job_id, 'failed')
+
+
+    def _dispatch(self):
+        while True:
+            jobdir, func, args, kwargs = self.pending.get()
+            job_id = os.path.basename(jobdir)
+            self._index_status(job_id, 'running')
+            p = multiprocessing.Process(target=_run_job, args=(jobdir, func, args, kwargs))
+            p.start()
+            p.join()
+            if p.exitcode != 0 and self.status(job_id)['status'] != 'failed':
+                _update_status(jobdir, status='failed', finished=time.time(),
+                               error='exit code {0}'.format(p.exitcode))
+            self._index_status(job_id)
+
+
+    def _index_status(self, job_id, status=None):
+        """
+        Copy the status of the job into the index. Only the server process
+        writes the index, the job processes only write their status.json.
+        """
+        s = self.status(job_id) if self.exists(job_id) else {'finished': None}
+        if status is not None:
+            s['status'] = status
+        db = _connect(self.root)
+        with db:
+            db.execute('UPDATE jobs SET status = ?, finished = ? WHERE id = ?',
+                       (s['status'], s['finished'], job_id))
+        db.close()
+
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs). func and the arguments have to be
+        picklable, i.e. func is a module level function.
+        The optional keyword `description` is stored with the job status.
+
+        Output:
+            the job id. It is the id of the earlier job with the same
+            arguments, unless that job failed.
+        """
+        description = kwargs.pop('description', '')
+        job_id, params = job_key(func, args, kwargs)
+        jobdir = self.jobdir(job_id)
+        with self.lock:
+            if self.exists(job_id) and self.status(job_id)['status'] != 'failed':
+                return job_id
+            if not os.path.exists(jobdir):
+                os.makedirs(jobdir)
+            for fname in ['log.txt', 'stderr.txt', 'result.json']:
+                if os.path.exists(os.path.join(jobdir, fname)):
+                    os.remove(os.path.join(jobdir, fname))
+            status = {'id': job_id, 'status': 'queued', 'function': func.__name__,
+                      'description': description, 'params': params, 'submitted': time.time(),
+                      'started': None, 'finished': None, 'progress': None, 'error': None}
+            _write_json(os.path.join(jobdir, 'status.json'), status)
+            db = _connect(self.root)
+            with db:
+                db.execute('INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           [status[c] for c in INDEX_COLUMNS])
+            db.close()
+        if not self.threads:
+            for i in range(self.workers):
+                t = threading.Thread(target=self._dispatch)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+        self.pending.put((jobdir, func, args, kwargs))
+        return job_id
+
+
+    def jobdir(self, job_id):
+        job_id = os.path.basename(job_id)
+        return os.path.join(self.root, job_id)
+
+
+    def exists(self, job_id):
+        return os.path.exists(os.path.join(self.jobdir(job_id), 'status.json'))
+
+
+    def status(self, job_id):
+        return _read_json(os.path.join(self.jobdir(job_id), 'status.json'))
+
+
+    def log(self, job_id, stream='stdout'):
+        """
+        The output of the job so far, of stream 'stdout' or 'stderr'
+        """
+        fname = os.path.join(self.jobdir(job_id), 'log.txt' if stream == 'stdout' else 'stderr.txt')
+        if not os.path.exists(fname):
+            return ''
+        with open(fname, 'r') as fin:
+            return fin.read()
+
+
+    def result(self, job_id):
+        """
+        The return value of a finished job, None if it is not done
+        """
+        fname = os.path.join(self.jobdir(job_id), 'result.json')
+        if not os.path.exists(fname):
+            return None
+        return _read_json(fname)
+
+
+    def import_results(self, function, results):
+        """
+        Add the results made outside the queue to the index, as done jobs of
+        `function`. `results` is a list of (id, description, submitted), the
+        ids already in the index are skipped.
+        """
+        db = _connect(self.root)
+        with db:
+            db.executemany("INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, '', 'done', ?, ?)",
+                           [(job_id, function, description, submitted, submitted)
+                            for job_id, description, submitted in results])
+        db.close()
+
+
+    def list_jobs(self, function=None, limit=-1, offset=0):
+        """
+        The index rows of the jobs of a function name or a list of names,
+        the latest first
+        """
+        query = 'SELECT {0} FROM jobs'.format(', '.join(INDEX_COLUMNS))
+        values = []
+        if function is not None:
+            functions = [function] if isinstance(function, basestring) else list(function)
+            query += ' WHERE function IN ({0})'.format(', '.join(['?'] * len(functions)))
+            values += functions
+        query += ' ORDER BY submitted DESC LIMIT ? OFFSET ?'
+        db = _connect(self.root)
+        rows = db.execute(query, values + [limit, offset]).fetchall()
+        db.close()
+        return [dict(zip(INDEX_COLUMNS, r)) for r in rows]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Binary cache of the text matrix files.
+
+The first load of a text matrix, e.g. taxi-CA-static.matrix or POI_dist.csv,
+saves it as a .npy file next to it, with the mtime of the text file. Later
+loads memory-map the .npy file, and a text file with another mtime is
+parsed again.
+
+The derived variants of a matrix (a region left out, a normalization) are
+kept in a small in-process LRU, keyed by the variant and the mtime of the
+source file. All returned arrays are read-only, copy them before changing
+them in place.
+
+Usage:
+    s = load_matrix(here + "/TF_tract.csv")
+    d = cached(('poi', 'ca', leaveOut), fname, lambda: ...)
+"""
+
+import numpy as np
+from collections import OrderedDict
+import tempfile
+import os
+
+
+# number of variants kept in memory
+LRU_SIZE = 64
+_lru = OrderedDict()
+
+
+
+def _readonly(a):
+    a = np.asarray(a)
+    a.flags.writeable = False
+    return a
+
+
+
+def load_matrix(fname, delimiter=","):
+    """
+    The read-only, memory-mapped matrix of the text file `fname`
+    """
+    mtime = os.stat(fname).st_mtime
+    npy = fname + '.npy'
+    if not os.path.exists(npy) or abs(os.stat(npy).st_mtime - mtime) > 1e-3:
+        a = np.loadtxt(fname, delimiter=delimiter)
+        # a tmp file of its own, other processes may convert the same file
+        fd, tmp = tempfile.mkstemp(suffix='.tmp.npy', prefix=os.path.basename(fname) + '.',
+                                   dir=os.path.dirname(npy) or '.')
+        with os.fdopen(fd, 'wb') as fout:
+            np.save(fout, a)
+        os.utime(tmp, (mtime, mtime))
+        os.rename(tmp, npy)
+    return np.load(npy, mmap_mode='r')
+
+
+
+def cached(key, fname, compute):
+    """
+    The read-only result of compute(), cached under `key` until the source
+    file `fname` changes
+    """
+    key = (key, fname, os.stat(fname).st_mtime)
+    if key in _lru:
+        a = _lru.pop(key)
+    else:
+        a = _readonly(compute())
+    _lru[key] = a
+    while len(_lru) > LRU_SIZE:
+        _lru.popitem(last=False)
+    return a
+
+
+
+def clear_cache():
+    _lru.clear()
@@ -19,7 +19,7 @@ import sys
 sys.path.append("../")
 
 from graph_embedding import get_graph_embedding_features
-from feature_evaluation import extract_raw_samples, leaveOneOut_error
+from feature_evaluation import extract_raw_samples, leaveOneOut_error, N_JOBS
 # from nn_leaveOneOut import leaveOneOut_error
 from Crime import Tract
 from FeatureUtils import retrieve_income_features, retrieve_averge_house_price
@@ -407,7 +407,7 @@ def evaluate_various_embedding_features_with_lag_model(year, spatial):
         Gmf = np.concatenate((src, dst.T), axis=1)
         
         mae, mre = leaveOneOut_error(Yhat, D, P, similarityMatrix(Tmf), Yhat,
-                                     keep_topk(similarityMatrix(Gmf), 20), Yhat, features=features_, taxi_norm="bydestination")
+                                     keep_topk(similarityMatrix(Gmf), 20), Yhat, features=features_, taxi_norm="bydestination", n_jobs=N_JOBS)
         mf_mre.append(mre)
         mf_mae.append(mae)
         print "MF MRE: {0}".format(mre)
@@ -416,7 +416,7 @@ def evaluate_various_embedding_features_with_lag_model(year, spatial):
         Tline = line[h] # sum([e for e in line.values()])
         Gline = get_graph_embedding_features('geo_all.txt')
         mae, mre = leaveOneOut_error(Yhat, D, P, similarityMatrix(Tline), Yhat,
-                                     keep_topk(similarityMatrix(Gline)), Yhat, features=features_, taxi_norm="bydestination")
+                                     keep_topk(similarityMatrix(Gline)), Yhat, features=features_, taxi_norm="bydestination", n_jobs=N_JOBS)
         line_mre.append(mre)
         line_mae.append(mae)
         print "LINE_slotted MRE: {0}".format(mre)
@@ -426,7 +426,7 @@ def evaluate_various_embedding_features_with_lag_model(year, spatial):
         
         mae, mre = leaveOneOut_error(Yhat, D, P, similarityMatrix(dwt[h]), Yhat,
                                      similarityMatrix(dws[h]), Yhat, features=features_, #['demo', 'poi', 'geo'],
-                                    taxi_norm="none")
+                                    taxi_norm="none", n_jobs=N_JOBS)
         
         dw_mre.append(mre)
         dw_mae.append(mae)
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+In-process negative binomial (NB2) regression.
+
+It follows glm.nb of the R package MASS, which nbr_eval.R and
+nbr_eval_kfold.R used to call through Rscript:
+
+    1. fit a Poisson GLM with log link by IRLS,
+    2. estimate the dispersion theta by maximum likelihood (theta.ml),
+    3. alternate the IRLS fit of the NB GLM with fixed theta and the theta
+       estimate until the log-likelihood and theta converge.
+
+As with the R formula `y ~ .`, an intercept is added to the features and the
+aliased columns (e.g. a constant 'intercept' column) are dropped. The dropped
+columns get a NaN coefficient, like the NA of R.
+
+Usage:
+    mod = NegBinGLM().fit(features, Y)
+    ybar = mod.predict(features_test)
+"""
+
+import numpy as np
+from scipy.special import gammaln, digamma, zeta
+
+
+# glm.control() defaults of R
+EPSILON = 1e-8
+MAXIT = 25
+
+
+
+def independent_columns(X, tol=min(1e-7, EPSILON / 1000)):
+    """
+    Index of the columns of X that are not aliased by the preceding columns.
+    As in the QR of R glm.fit (LINPACK dqrdc2), a column is aliased if its
+    norm after projecting out the kept columns is below tol times its
+    original norm. The default tol is the one of glm.fit,
+    min(1e-7, epsilon / 1000).
+    """
+    keep = []
+    Q = np.zeros((X.shape[0], 0))
+    for j in range(X.shape[1]):
+        x = X[:,j]
+        nx = np.sqrt(np.dot(x, x))
+        # project twice, one pass loses the orthogonality needed at this tol
+        r = x - Q.dot(Q.T.dot(x))
+        r = r - Q.dot(Q.T.dot(r))
+        nr = np.sqrt(np.dot(r, r))
+        if nx > 0 and nr > tol * nx:
+            keep.append(j)
+            Q = np.column_stack((Q, r / nr))
+    return np.array(keep, dtype=int)
+
+
+
+def theta_ml(y, mu, limit=MAXIT, eps=np.finfo(float).eps ** 0.25):
+    """
+    ML estimate of theta for fixed mu by Newton iterations, as MASS theta.ml
+    """
+    n = len(y)
+    t0 = n / np.sum((y / mu - 1) ** 2)
+    it = 0
+    delta = 1.
+    while it + 1 < limit and abs(delta) > eps:
+        it += 1
+        t0 = abs(t0)
+        score = np.sum(digamma(t0 + y) - digamma(t0) + np.log(t0) + 1
+                       - np.log(t0 + mu) - (y + t0) / (mu + t0))
+        # trigamma(x) = zeta(2, x)
+        info = np.sum(-zeta(2, t0 + y) + zeta(2, t0) - 1 / t0
+                      + 2 / (mu + t0) - (y + t0) / (mu + t0) ** 2)
+        delta = score / info
+        t0 = t0 + delta
+    return max(t0, 0.)
+
+
+
+def nb_loglik(y, mu, theta):
+    return np.sum(gammaln(theta + y) - gammaln(theta) - gammaln(y + 1) + theta * np.log(theta)
+                  + y * np.log(mu + (y == 0)) - (theta + y) * np.log(theta + mu))
+
+
+
+def _deviance(y, mu, theta):
+    """
+    Deviance of the Poisson (theta is None) or NB model
+    """
+    if theta is None:
+        r = mu - y
+        pos = y > 0
+        r[pos] += y[pos] * np.log(y[pos] / mu[pos])
+    else:
+        r = y * np.log(np.maximum(1, y) / mu) - (y + theta) * np.log((y + theta) / (mu + theta))
+    return 2 * np.sum(r)
+
+
+
+def irls(X, y, eta, theta=None, maxit=MAXIT, epsilon=EPSILON, offset=0.):
+    """
+    Fit the GLM with log link by iteratively reweighted least squares.
+
+    Input:
+        X - design matrix with independent columns
+        y - response
+        eta - the starting linear predictor
+        theta - NB dispersion, None for the Poisson model
+        offset - the offset added to the linear predictor
+
+    Output:
+        the coefficients, the fitted mean
+    """
+    mu = np.exp(eta)
+    dev = _deviance(y, mu, theta)
+    beta = None
+    for it in range(maxit):
+        var = mu if theta is None else mu + mu ** 2 / theta
+        z = eta - offset + (y - mu) / mu
+        w = np.sqrt(mu ** 2 / var)
+        beta_new = np.linalg.lstsq(X * w[:,None], z * w, rcond=None)[0]
+        eta_new = X.dot(beta_new) + offset
+        mu_new = np.exp(eta_new)
+        dev_new = _deviance(y, mu_new, theta)
+        # step halving on divergence, as glm.fit
+        halving = 0
+        while not np.isfinite(dev_new) and beta is not None and halving < maxit:
+            beta_new = (beta_new + beta) / 2
+            eta_new = X.dot(beta_new) + offset
+            mu_new = np.exp(eta_new)
+            dev_new = _deviance(y, mu_new, theta)
+            halving += 1
+        beta, eta, mu = beta_new, eta_new, mu_new
+        converged = abs(dev_new - dev) / (abs(dev_new) + 0.1) < epsilon
+        dev = dev_new
+        if converged:
+            break
+    return beta, mu
+
+
+
+class NegBinGLM:
+    """
+    Negative binomial regression with log link, as MASS glm.nb
+    """
+
+    def __init__(self, maxit=MAXIT, epsilon=EPSILON):
+        self.maxit = maxit
+        self.epsilon = epsilon
+
+
+    def design(self, features):
+        features = np.asarray(features, dtype=float)
+        if features.ndim == 1:
+            features = features.reshape((1, len(features)))
+        return np.column_stack((np.ones(features.shape[0]), features))
+
+
+    def fit(self, features, Y, start=None, offset=None):
+        """
+        Input:
+            features - n x p feature matrix without intercept column
+                       (a constant column is dropped as aliased)
+            Y - response counts (or rates)
+            start - starting coefficients of length p+1, e.g. from a fit on
+                    the full data, which skips the initial Poisson fit
+            offset - the offset of each sample, as offset() in R formula
+        """
+        y = np.asarray(Y, dtype=float).ravel()
+        Z = self.design(features)
+        self.cols = independent_columns(Z)
+        X = Z[:, self.cols]
+        offset = 0. if offset is None else np.asarray(offset, dtype=float).ravel()
+
+        if start is None:
+            beta, mu = irls(X, y, np.log(y + 0.1), None, self.maxit, self.epsilon, offset)
+        else:
+            beta = np.asarray(start, dtype=float)[self.cols]
+            mu = np.exp(X.dot(beta) + offset)
+        th = theta_ml(y, mu, self.maxit)
+
+        d1 = np.sqrt(2 * max(1, len(y) - X.shape[1]))
+        d2 = delta = 1.
+        Lm = nb_loglik(y, mu, th)
+        Lm0 = Lm + 2 * d1
+        it = 0
+        while it < self.maxit and abs(Lm0 - Lm) / d1 + abs(delta) / d2 > self.epsilon:
+            it += 1
+            beta, mu_new = irls(X, y, np.log(mu), th, self.maxit, self.epsilon, offset)
+            t0 = th
+            # theta is updated with the previous mean, as glm.nb does
+            th = theta_ml(y, mu, self.maxit)
+            mu = mu_new
+            delta = t0 - th
+            Lm0 = Lm
+            Lm = nb_loglik(y, mu, th)
+
+        self.converged = it < self.maxit
+        self.coef = np.empty(Z.shape[1])
+        self.coef.fill(np.nan)
+        self.coef[self.cols] = beta
+        self.theta = th
+        self.loglik = Lm
+        self.fitted = mu
+        return self
+
+
+    def predict(self, features, offset=None):
+        Z = self.design(features)
+        offset = 0. if offset is None else np.asarray(offset, dtype=float).ravel()
+        return np.exp(Z[:, self.cols].dot(self.coef[self.cols]) + offset)
+
+
+
+def nb_loo_errors(features, Y, verboseoutput=False):
+    """
+    Leave-one-out absolute errors of the NB regression, as nbr_eval.R.
+    Each fold starts from the coefficients of the full-data fit.
+    """
+    features = np.asarray(features, dtype=float)
+    y = np.asarray(Y, dtype=float).ravel()
+    full = NegBinGLM().fit(features, y)
+    errors = np.zeros(len(y))
+    mask = np.ones(len(y), dtype=bool)
+    for i in range(len(y)):
+        mask[i] = False
+        mod = NegBinGLM().fit(features[mask], y[mask], start=full.coef)
+        ybar = mod.predict(features[i])[0]
+        mask[i] = True
+        errors[i] = abs(ybar - y[i])
+        if verboseoutput:
+            print i+1, y[i], ybar, errors[i], errors[i] / y[i]
+    return errors
+
+
+
+def nb_loo_evaluation(features, Y, verboseoutput=False):
+    """
+    Leave-one-out evaluation of the NB regression.
+
+    Output:
+        mean absolute error, its standard deviation, mean relative error
+    """
+    errors = nb_loo_errors(features, Y, verboseoutput)
+    y = np.asarray(Y, dtype=float).ravel()
+    mae = np.mean(errors)
+    return mae, np.std(errors, ddof=1), mae / np.mean(y)
+
+
+
+import unittest
+
+class TestNegBinGLM(unittest.TestCase):
+    
+    def sample(self, n=200, seed=0):
+        rng = np.random.RandomState(seed)
+        X = rng.randn(n, 2)
+        mu = np.exp(1. + 0.5 * X[:,0] - 0.3 * X[:,1])
+        theta = 2.
+        y = rng.poisson(rng.gamma(theta, mu / theta))
+        return X, y
+    
+    def test_independent_columns(self):
+        X = np.column_stack((np.ones(5), np.arange(5.), 2 * np.arange(5.), np.arange(5.) ** 2))
+        np.testing.assert_array_equal(independent_columns(X), [0, 1, 3])
+        # nearly aliased columns are kept down to the glm.fit tolerance 1e-11
+        rng = np.random.RandomState(0)
+        X = rng.randn(50, 3)
+        for eps, cols in [(1e-9, [0, 1, 2, 3]), (1e-13, [0, 1, 2])]:
+            Z = np.column_stack((X, X[:,0] - 3 * X[:,1] + eps * rng.randn(50)))
+            np.testing.assert_array_equal(independent_columns(Z), cols)
+    
+    def test_fit_against_statsmodels(self):
+        import statsmodels.api as sm
+        X, y = self.sample()
+        mod = NegBinGLM().fit(X, y)
+        ref = sm.NegativeBinomial(y, sm.add_constant(X), loglike_method='nb2').fit(disp=0)
+        np.testing.assert_allclose(mod.coef, ref.params[:3], rtol=1e-4)
+        np.testing.assert_allclose(1 / mod.theta, ref.params[3], rtol=1e-3)
+        np.testing.assert_allclose(mod.loglik, ref.llf, rtol=1e-6)
+        assert mod.converged
+    
+    def test_aliased_column(self):
+        X, y = self.sample()
+        mod = NegBinGLM().fit(np.column_stack((X, np.ones(len(y)), 2 * X[:,0])), y)
+        ref = NegBinGLM().fit(X, y)
+        assert np.all(np.isnan(mod.coef[3:]))
+        np.testing.assert_allclose(mod.coef[:3], ref.coef)
+        np.testing.assert_allclose(mod.predict(np.column_stack((X, np.ones(len(y)), 2 * X[:,0]))),
+                                   ref.predict(X))
+    
+    def test_offset(self):
+        X, y = self.sample()
+        offset = np.log(np.arange(1, len(y) + 1) % 3 + 1.)
+        mod = NegBinGLM().fit(X, y, offset=offset)
+        shifted = NegBinGLM().fit(X, y)
+        # the offset moves the fitted mean by exp(offset)
+        np.testing.assert_allclose(mod.predict(X, offset=offset), mod.fitted, rtol=1e-10)
+        assert not np.allclose(mod.coef, shifted.coef)
+    
+    def test_loo_errors_against_refits(self):
+        X, y = self.sample(n=40, seed=1)
+        errors = nb_loo_errors(X, y)
+        for i in range(len(y)):
+            keep = np.arange(len(y)) != i
+            mod = NegBinGLM().fit(X[keep], y[keep])
+            np.testing.assert_allclose(errors[i], abs(mod.predict(X[i])[0] - y[i]), rtol=1e-5)
+            
+            
+            
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestNegBinGLM)
+    unittest.TextTestRunner(verbosity=2).run(suite)
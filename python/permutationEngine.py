@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Batched permutation test runner.
+
+All permutations are drawn up front from a seeded RandomState, so a run is
+reproducible and can be resumed. The permutations are split into chunks,
+which are evaluated by a worker pool. After every finished chunk the
+results are saved to a checkpoint file, and an interrupted run with the
+same permutations and inputs only evaluates the chunks that are left.
+The checkpoint keeps the SHA-1 of the inputs, and a checkpoint of other
+inputs is not reused.
+
+The caller provides
+    evaluate(perms) - a top level function that maps a (B, n) array of
+                      permutation indices to a (B, m) array of results
+    init(*initargs) - an optional top level function setting up the shared
+                      data of `evaluate` in each worker process
+
+If `progress_hook` is set to a function, it is called with the number of
+finished and all permutations after every chunk.
+"""
+
+import numpy as np
+import multiprocessing
+import hashlib
+import os
+
+
+progress_hook = None
+
+
+
+def permutation_indices(n, size, seed=0):
+    """
+    `size` permutations of range(n) from a seeded RNG, shape (size, n)
+    """
+    rng = np.random.RandomState(seed)
+    return np.array([rng.permutation(n) for i in range(size)])
+
+
+
+def input_hash(*objs):
+    """
+    SHA-1 of the inputs of a run: arrays (also ctypes arrays) by dtype,
+    shape and content, dicts, lists and objects by their items, functions
+    by name and the rest by repr
+    """
+    h = hashlib.sha1()
+    def update(o):
+        if hasattr(o, '_length_'):
+            o = np.ctypeslib.as_array(o)
+        if isinstance(o, np.ndarray):
+            h.update('array {0} {1}'.format(o.dtype.str, o.shape).encode('utf-8'))
+            h.update(np.ascontiguousarray(o).tobytes())
+        elif isinstance(o, dict):
+            h.update('dict {0}'.format(len(o)).encode('utf-8'))
+            for k in sorted(o.keys()):
+                update(k)
+                update(o[k])
+        elif isinstance(o, (list, tuple)):
+            h.update('list {0}'.format(len(o)).encode('utf-8'))
+            for x in o:
+                update(x)
+        elif callable(o) and hasattr(o, '__name__'):
+            h.update('function {0}.{1}'.format(o.__module__, o.__name__).encode('utf-8'))
+        elif hasattr(o, '__dict__'):
+            h.update('object {0}'.format(type(o).__name__).encode('utf-8'))
+            update(vars(o))
+        else:
+            h.update(repr(o).encode('utf-8'))
+    update(list(objs))
+    return h.hexdigest()
+
+
+
+def load_checkpoint(fname, perms, key):
+    """
+    Load the results saved for exactly these permutations and inputs.
+    
+    Output:
+        the results and the mask of the finished permutations, or None if
+        there is no such checkpoint
+    """
+    if fname is None or not os.path.exists(fname):
+        return None
+    data = np.load(fname)
+    if 'key' not in data.files or str(data['key']) != key:
+        print "Checkpoint {0} is of other inputs, start over".format(fname)
+        return None
+    if data['perms'].shape != perms.shape or not np.array_equal(data['perms'], perms):
+        return None
+    return data['results'], data['done']
+
+
+
+def save_checkpoint(fname, perms, key, results, done):
+    tmp = fname + '.tmp.npz'
+    np.savez(tmp, perms=perms, key=np.array(key), results=results, done=done)
+    os.rename(tmp, fname)
+
+
+
+def run_permutations(evaluate, perms, init=None, initargs=(), n_jobs=1, chunksize=10, checkpoint=None,
+                     settings=None):
+    """
+    Evaluate all permutations.
+
+    Input:
+        evaluate, init, initargs - see the module docstring
+        perms - (size, n) permutation indices
+        n_jobs - number of worker processes
+        chunksize - permutations per task
+        checkpoint - the .npz file keeping finished results, or None
+        settings - anything else the results depend on. The checkpoint is
+                   only reused for the same evaluate, initargs and settings.
+
+    Output:
+        (size, m) array of results, in the order of perms
+    """
+    key = input_hash(evaluate, initargs, settings)
+    results = done = None
+    saved = load_checkpoint(checkpoint, perms, key)
+    chunks = [(i, min(i + chunksize, len(perms))) for i in range(0, len(perms), chunksize)]
+    if saved is not None:
+        results, done = saved
+        chunks = [(s, e) for s, e in chunks if not np.all(done[s:e])]
+        print "Resume from {0}, {1} chunks left".format(checkpoint, len(chunks))
+    else:
+        done = np.zeros(len(perms), dtype=bool)
+
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs, init, initargs)
+        outputs = pool.imap(evaluate, [perms[s:e] for s, e in chunks])
+    else:
+        if init is not None:
+            init(*initargs)
+        outputs = (evaluate(perms[s:e]) for s, e in chunks)
+
+    try:
+        for i, res in enumerate(outputs):
+            s, e = chunks[i]
+            res = np.asarray(res, dtype=float).reshape((e - s, -1))
+            if results is None:
+                results = np.empty((len(perms), res.shape[1]))
+                results.fill(np.nan)
+            results[s:e] = res
+            done[s:e] = True
+            if checkpoint is not None:
+                save_checkpoint(checkpoint, perms, key, results, done)
+            if progress_hook is not None:
+                progress_hook(int(np.sum(done)), len(perms))
+    except BaseException:
+        # also on KeyboardInterrupt, the finished chunks are in the checkpoint
+        if n_jobs > 1:
+            pool.terminate()
+            pool.join()
+        raise
+
+    if n_jobs > 1:
+        pool.close()
+        pool.join()
+    return results
+
+
+
+import unittest
+import tempfile
+import shutil
+
+_weights = None
+_calls = []
+_stop_after = [None]
+
+class _Interrupt(Exception):
+    pass
+
+def _init_weights(w):
+    global _weights
+    _weights = np.asarray(w)
+
+def _weighted_sum(perms):
+    """
+    Test evaluate: the weighted sum of each permutation, NaN for those
+    starting with 0. Raises after _stop_after[0] calls, if set.
+    """
+    if _stop_after[0] is not None and len(_calls) >= _stop_after[0]:
+        raise _Interrupt()
+    _calls.append(len(perms))
+    res = np.dot(perms, _weights).astype(float)
+    res[perms[:,0] == 0] = np.nan
+    return res[:,None]
+
+class TestPermutationEngine(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'perms.npz')
+        self.perms = permutation_indices(6, 25, seed=3)
+        self.w = np.arange(6)
+        self.expected = np.dot(self.perms, self.w).astype(float)
+        self.expected[self.perms[:,0] == 0] = np.nan
+        del _calls[:]
+        _stop_after[0] = None
+        
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        
+    def test_permutation_indices(self):
+        np.testing.assert_array_equal(self.perms, permutation_indices(6, 25, seed=3))
+        np.testing.assert_array_equal(np.sort(self.perms, axis=1), np.tile(np.arange(6), (25, 1)))
+        
+    def test_ordered_results(self):
+        res = run_permutations(_weighted_sum, self.perms, _init_weights, (self.w,), chunksize=4)
+        np.testing.assert_array_equal(res[:,0], self.expected)
+        assert np.any(np.isnan(res))
+        
+    def test_parallel(self):
+        res1 = run_permutations(_weighted_sum, self.perms, _init_weights, (self.w,), chunksize=4)
+        res2 = run_permutations(_weighted_sum, self.perms, _init_weights, (self.w,), n_jobs=2,
+                                chunksize=4)
+        np.testing.assert_array_equal(res1, res2)
+        
+    def test_resume(self):
+        _stop_after[0] = 3
+        self.assertRaises(_Interrupt, run_permutations, _weighted_sum, self.perms, _init_weights,
+                          (self.w,), chunksize=4, checkpoint=self.fname)
+        key = input_hash(_weighted_sum, (self.w,), None)
+        results, done = load_checkpoint(self.fname, self.perms, key)
+        assert np.sum(done) == 12 and np.all(done[:12])
+        # only the chunks left are evaluated, also when finished results are NaN
+        assert np.any(np.isnan(results[:12]))
+        del _calls[:]
+        _stop_after[0] = None
+        res = run_permutations(_weighted_sum, self.perms, _init_weights, (self.w,), chunksize=4,
+                               checkpoint=self.fname)
+        assert _calls == [4, 4, 4, 1]
+        np.testing.assert_array_equal(res[:,0], self.expected)
+        
+    def test_interrupted_pool(self):
+        _stop_after[0] = 1
+        try:
+            run_permutations(_weighted_sum, self.perms, _init_weights, (self.w,), n_jobs=2,
+                             chunksize=4, checkpoint=self.fname)
+        except _Interrupt:
+            # the traceback still holds the pool here
+            assert multiprocessing.active_children() == []
+        else:
+            self.fail('the interruption was not raised')
+        
+    def test_stale_checkpoint(self):
+        run_permutations(_weighted_sum, self.perms, _init_weights, (self.w,), chunksize=4,
+                         checkpoint=self.fname)
+        assert load_checkpoint(self.fname, self.perms, input_hash(_weighted_sum, (self.w + 1,), None)) is None
+        assert load_checkpoint(self.fname, self.perms[::-1], input_hash(_weighted_sum, (self.w,), None)) is None
+        # other weights or settings start over
+        del _calls[:]
+        res = run_permutations(_weighted_sum, self.perms, _init_weights, (self.w + 1,), chunksize=4,
+                               checkpoint=self.fname)
+        assert len(_calls) == 7
+        np.testing.assert_array_equal(res[:,0], self.expected + np.sum(self.perms, axis=1))
+        del _calls[:]
+        run_permutations(_weighted_sum, self.perms, _init_weights, (self.w + 1,), chunksize=4,
+                         checkpoint=self.fname, settings={'year': 2010})
+        assert len(_calls) == 7
+            
+            
+            
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestPermutationEngine)
+    unittest.TextTestRunner(verbosity=2).run(suite)
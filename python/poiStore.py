@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Compact store of the Foursquare POIs.
+
+The pickled dict of query.POI objects in ../data/all_POIs_chicago is
+converted once into the directory ../data/poi-store/ with
+
+    pois.npy        - structured array, one record per POI with the fields
+                      pid, name (UTF-8 bytes), lat, lon, cat, checkin_count,
+                      user_count
+    categories.json - the category names, `cat` is the index into it
+
+The store is memory-mapped on load, so only the fields that are read are
+paged in. POIStore[i] gives a light POIView with the attributes of
+query.POI, for code that wants objects.
+
+Usage:
+    python poiStore.py          # convert ../data/all_POIs_chicago
+
+    store = POIStore()
+    lon = store.pois['lon']
+    poi = store[0]
+    poi.name, poi.location.lat, poi.cat
+"""
+
+import numpy as np
+import pickle
+import json
+from query import Point
+
+import os
+here = os.path.dirname(os.path.abspath(__file__))
+
+POI_FILE = here + '/../data/all_POIs_chicago'
+STORE_DIR = here + '/../data/poi-store'
+
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return str(s)
+
+
+
+def convert_poi_pickle(fname=POI_FILE, path=STORE_DIR):
+    """
+    Convert the pickled dict of query.POI objects into the store at `path`
+
+    Output:
+        the number of POIs
+    """
+    with open(fname, 'r') as fin:
+        POIs = pickle.load(fin)
+    pois = sorted(POIs.values(), key=lambda poi: poi.pid)
+
+    categories = sorted(set(poi.cat for poi in pois))
+    code = dict((c, i) for i, c in enumerate(categories))
+    if all(isinstance(poi.pid, (int, long)) for poi in pois):
+        pid_type = np.int64
+    else:
+        pid_type = 'S{0}'.format(max(len(_utf8(poi.pid)) for poi in pois))
+    names = [_utf8(poi.name) for poi in pois]
+    dtype = [('pid', pid_type), ('name', 'S{0}'.format(max(len(n) for n in names) or 1)),
+             ('lat', np.float64), ('lon', np.float64), ('cat', np.int32),
+             ('checkin_count', np.int64), ('user_count', np.int64)]
+
+    a = np.empty(len(pois), dtype=dtype)
+    a['pid'] = [poi.pid if pid_type == np.int64 else _utf8(poi.pid) for poi in pois]
+    a['name'] = names
+    a['lat'] = [poi.location.lat for poi in pois]
+    a['lon'] = [poi.location.lon for poi in pois]
+    a['cat'] = [code[poi.cat] for poi in pois]
+    a['checkin_count'] = [poi.checkin_count for poi in pois]
+    a['user_count'] = [poi.user_count for poi in pois]
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(os.path.join(path, 'categories.json'), 'w') as fout:
+        json.dump(categories, fout)
+    tmp = os.path.join(path, 'pois.tmp.npy')
+    np.save(tmp, a)
+    os.rename(tmp, os.path.join(path, 'pois.npy'))
+    return len(a)
+
+
+
+class POIView(object):
+    """
+    One POI of the store, with the attributes of query.POI
+    """
+    __slots__ = ('store', 'i')
+
+    def __init__(self, store, i):
+        self.store = store
+        self.i = i
+
+    @property
+    def pid(self):
+        pid = self.store.pois['pid'][self.i]
+        return pid.item() if self.store.pois.dtype['pid'].kind == 'i' else pid.decode('utf-8')
+
+    @property
+    def name(self):
+        return self.store.pois['name'][self.i].decode('utf-8')
+
+    @property
+    def location(self):
+        r = self.store.pois[self.i]
+        return Point(float(r['lat']), float(r['lon']))
+
+    @property
+    def cat(self):
+        return self.store.categories[self.store.pois['cat'][self.i]]
+
+    @property
+    def checkin_count(self):
+        return int(self.store.pois['checkin_count'][self.i])
+
+    @property
+    def user_count(self):
+        return int(self.store.pois['user_count'][self.i])
+
+
+
+class POIStore:
+    """
+    The memory-mapped POI store at `path`
+    """
+
+    def __init__(self, path=STORE_DIR):
+        self.pois = np.load(os.path.join(path, 'pois.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'categories.json'), 'r') as fin:
+            self.categories = json.load(fin)
+
+    def __len__(self):
+        return len(self.pois)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.pois)
+        if not 0 <= i < len(self.pois):
+            raise IndexError(i)
+        return POIView(self, i)
+
+    def __iter__(self):
+        for i in range(len(self.pois)):
+            yield POIView(self, i)
+
+    def category_codes(self, mapping, missing=-1):
+        """
+        Map the category codes of all POIs through the dict `mapping` of
+        category name to integer code, `missing` for the other categories
+        """
+        lookup = np.array([mapping.get(c, missing) for c in self.categories] + [missing])
+        return lookup[self.pois['cat']]
+
+
+
+if __name__ == '__main__':
+    import sys
+    fname = sys.argv[1] if len(sys.argv) > 1 else POI_FILE
+    print "Convert {0} into {1}".format(fname, STORE_DIR)
+    print convert_poi_pickle(fname), "POIs"
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Permutation p-values of the NB model features.
+
+Python replacement of ../R/pvalue-evaluation.R and the leaveOneOut,
+leaveOneOut.PermuteLag functions of ../R/NBUtils.R. The NB model is fitted
+in process by nbGLM, and the inputs are read from memory instead of the
+pvalue-*.csv files.
+
+The model uses five demographics features, optionally the temporal lag and
+the self flow, plus the lags selected by the four character flag string
+lagsFlag:
+
+    social lag, spatial lag, social lag of disadvantage index,
+    spatial lag of disadvantage index
+
+The leave-one-out MAE of the model is compared with the MAE after permuting
+one feature, `itersN` times per feature. The p-value of a feature is the
+fraction of permutations with a lower MAE than the original model.
+
+The loaded inputs are put into shared memory once, and all the worker
+processes read them from there.
+"""
+
+import numpy as np
+import json
+import os
+from multiprocessing.sharedctypes import RawArray
+from nbGLM import NegBinGLM
+from permutationEngine import permutation_indices, run_permutations
+
+
+DEMO_COLUMNS = ['total population', 'population density', 'disadvantage index',
+                'residential stability', 'ethnic diversity']
+# lag of each character in lagsFlag
+LAG_FLAGS = ['social.lag', 'spatial.lag', 'social.lag.disadv', 'spatial.lag.disadv']
+# column order of the lags in the model
+LAG_COLUMNS = ['social.lag', 'social.lag.disadv', 'spatial.lag', 'spatial.lag.disadv']
+
+
+
+def row_normalize(W):
+    """
+    Divide each row by its sum. All-zero rows stay zero.
+    """
+    s = W.sum(axis=1, keepdims=True)
+    R = np.zeros(W.shape)
+    np.divide(W, s, out=R, where=s != 0)
+    return R
+
+
+
+def normalize_social_lag(sco, socialnorm="bysource"):
+    """
+    Normalize the social flow matrix, as normalize.social.lag in NBUtils.R
+    """
+    if socialnorm == "bysource":
+        return row_normalize(sco)
+    elif socialnorm == "bydestination":
+        return row_normalize(sco.T)
+    elif socialnorm == "bypair":
+        sco = sco + sco.T
+        return sco / sco.sum()
+    return sco
+
+
+
+def social_lag_test(W2, i, keep, socialnorm, v):
+    """
+    Social lag of the test region i from the training values v
+    """
+    if socialnorm == "bydestination":
+        w = W2[keep, i]
+    else:
+        w = W2[i, keep]
+    if socialnorm in ["bysource", "bydestination"]:
+        return w.dot(v) / w.sum()
+    elif socialnorm == "bypair":
+        Wk = W2[np.ix_(keep, keep)]
+        return w.dot(v) / (Wk + Wk.T).sum()
+    return w.dot(v)
+
+
+
+def lag_flags(lags):
+    return dict((name, lags[k] == '1') for k, name in enumerate(LAG_FLAGS))
+
+
+
+def feature_names(names, lags, exposure):
+    """
+    Names of the model coefficients, the intercept first
+    """
+    flags = lag_flags(lags)
+    cols = [c for c in names if not (exposure == "exposure" and c == 'total population')]
+    return ['(intercept)'] + cols + [c for c in LAG_COLUMNS if flags[c]]
+
+
+
+def full_lags(X, names, W2, A, Y, socialnorm):
+    """
+    The lags computed from all regions, as leaveOneOut.PermuteLag
+    """
+    sco = normalize_social_lag(W2, socialnorm)
+    w1 = row_normalize(A)
+    dis = X[:, names.index('disadvantage index')]
+    return {'social.lag': sco.dot(Y), 'social.lag.disadv': sco.dot(dis),
+            'spatial.lag': w1.dot(Y), 'spatial.lag.disadv': w1.dot(dis)}
+
+
+
+def leave_one_out(X, names, W2, A, Y, lags, socialnorm="bysource", exposure="exposure", lagvals=None):
+    """
+    Leave-one-out evaluation of the NB model, as leaveOneOut in NBUtils.R.
+
+    Input:
+        X - N x p nodal features, with column names `names`
+        W2 - social flow matrix, W2_ij is the flow from i to j
+        A - binary contiguity matrix
+        Y - crime count
+        lags - the lagsFlag string
+        lagvals - fixed lag vectors of all regions, as PermuteLag. If None,
+                  the lags of each fold are computed without the test region.
+
+    Output:
+        absolute errors (N,), coefficients (N, k). Both are NaN for the
+        folds where the fitting fails.
+    """
+    N = len(Y)
+    flags = lag_flags(lags)
+    dis = names.index('disadvantage index')
+    pop = names.index('total population')
+    w1 = row_normalize(A)
+    k = len(feature_names(names, lags, exposure))
+    errors = np.empty(N)
+    errors.fill(np.nan)
+    coefs = np.empty((N, k))
+    coefs.fill(np.nan)
+
+    keep = np.ones(N, dtype=bool)
+    for i in range(N):
+        keep[i] = False
+        y = Y[keep]
+        F = [X[keep]]
+        test = [X[i]]
+        if lagvals is None:
+            y2 = X[keep, dis]
+            if flags['social.lag'] or flags['social.lag.disadv']:
+                sco = normalize_social_lag(W2[np.ix_(keep, keep)], socialnorm)
+            if flags['spatial.lag'] or flags['spatial.lag.disadv']:
+                spt = row_normalize(A[np.ix_(keep, keep)])
+            for c in LAG_COLUMNS:
+                if not flags[c]:
+                    continue
+                v = y2 if c.endswith('disadv') else y
+                if c.startswith('social'):
+                    F.append(sco.dot(v)[:,None])
+                    test.append([social_lag_test(W2, i, keep, socialnorm, v)])
+                else:
+                    F.append(spt.dot(v)[:,None])
+                    test.append([w1[i, keep].dot(v)])
+        else:
+            for c in LAG_COLUMNS:
+                if flags[c]:
+                    F.append(lagvals[c][keep][:,None])
+                    test.append([lagvals[c][i]])
+        F = np.concatenate(F, axis=1)
+        test = np.concatenate(test)
+
+        # normalize features with the training mean and sd
+        center = F.mean(axis=0)
+        scale = F.std(axis=0, ddof=1)
+        scale[scale == 0] = 1
+        F = (F - center) / scale
+        test = (test - center) / scale
+
+        offset = test_offset = None
+        if exposure == "exposure":
+            offset, test_offset = F[:,pop], test[pop:pop+1]
+            F = np.delete(F, pop, 1)
+            test = np.delete(test, pop)
+        try:
+            mod = NegBinGLM().fit(F, y, offset=offset)
+            ybar = mod.predict(test, offset=test_offset)[0]
+        except (np.linalg.LinAlgError, FloatingPointError, ValueError):
+            keep[i] = True
+            continue
+        keep[i] = True
+        errors[i] = abs(ybar - Y[i])
+        coefs[i] = mod.coef
+    return errors, coefs
+
+
+
+"""
+Worker side. The inputs are shared memory arrays set up once per worker.
+"""
+_shared = {}
+
+def _init_shared(arrays, config):
+    for key, (raw, shape) in arrays.items():
+        _shared[key] = np.frombuffer(raw).reshape(shape)
+    _shared.update(config)
+
+
+def _evaluate_permutations(rows):
+    """
+    MAE of each permutation. The first entry of a row is the index of the
+    permuted feature (demographics first, then the lags), and the rest is
+    the permutation.
+    """
+    d = _shared
+    X, names, p = d['X'], d['names'], d['X'].shape[1]
+    res = []
+    for row in rows:
+        fid, perm = int(row[0]), row[1:]
+        if fid < p:
+            Xp = X.copy()
+            Xp[:,fid] = X[perm, fid]
+            errors, _ = leave_one_out(Xp, names, d['W2'], d['A'], d['Y'], d['lags'],
+                                      d['socialnorm'], d['exposure'])
+        else:
+            lagvals = dict((c, d[c]) for c in LAG_COLUMNS)
+            name = d['permuted_lags'][fid - p]
+            lagvals[name] = lagvals[name][perm]
+            errors, _ = leave_one_out(X, names, d['W2'], d['A'], d['Y'], d['lags'],
+                                      d['socialnorm'], d['exposure'], lagvals)
+        res.append([np.nanmean(errors)])
+    return np.array(res)
+
+
+
+def _share(a):
+    a = np.ascontiguousarray(a, dtype=float)
+    raw = RawArray('d', a.size)
+    np.frombuffer(raw).reshape(a.shape)[:] = a
+    return raw, a.shape
+
+
+
+def pvalue_evaluation(demo, W2, A, Y, lags="1111", socialnorm="bysource", exposure="exposure",
+                      logpop="logpop", logpopden="logpopdensty", templag=None, selfflow=None,
+                      itersN=10, seed=0, n_jobs=1, fout=None, checkpoint=None):
+    """
+    Permutation p-values of the NB model features.
+
+    Input:
+        demo - (field names, value array) from generate_corina_features
+        W2 - social flow matrix with zero diagonal
+        A - binary contiguity matrix of the CAs
+        Y - crime count
+        lags, socialnorm, exposure, logpop, logpopden - as the arguments of
+            pvalue-evaluation.R
+        templag - average crime count of the previous years, or None
+        selfflow - the flow within each CA, or None
+        fout - the JSON summary file, or None. The arrays are saved next to
+               it, in the .npz file of the same name.
+
+    Output:
+        a dict of the model MAE, the mean fold coefficients and the p-values.
+        With fout, the key 'arrays' is the name of the .npz file with
+            features - the permuted features
+            permuted_mae - MAE of each permutation, features x itersN
+            errors - the leave-one-out errors of the model
+            coefs - the coefficients of each fold, with names coef_names
+    """
+    C = demo[1]
+    names = list(DEMO_COLUMNS)
+    X = C[:, [demo[0].index(c) for c in DEMO_COLUMNS]].astype(float)
+    totpop = C[:, demo[0].index('total population')]
+    if logpop == "logpop":
+        X[:,0] = np.log(totpop / 1000)
+    if logpopden == "logpopdensty":
+        X[:,1] = np.log(X[:,1])
+    if templag is not None:
+        X = np.column_stack((X, np.log(np.ravel(templag))))
+        names.append('templag')
+    if selfflow is not None:
+        X = np.column_stack((X, np.ravel(selfflow) / totpop * 1000))
+        names.append('selfflow')
+    assert np.all(np.isfinite(X))
+    Y = np.ravel(Y).astype(float)
+
+    errors, coefs = leave_one_out(X, names, W2, A, Y, lags, socialnorm, exposure)
+    mae_org = np.nanmean(errors)
+    print "Model MAE", mae_org
+
+    flags = lag_flags(lags)
+    permuted_lags = [c for c in LAG_FLAGS if flags[c]]
+    features = names + permuted_lags
+    lagvals = full_lags(X, names, W2, A, Y, socialnorm)
+
+    arrays = dict((k, _share(v)) for k, v in [('X', X), ('W2', W2), ('A', A), ('Y', Y)] + list(lagvals.items()))
+    config = {'names': names, 'lags': lags, 'socialnorm': socialnorm, 'exposure': exposure,
+              'permuted_lags': permuted_lags}
+
+    perms = permutation_indices(len(Y), len(features) * itersN, seed)
+    fid = np.repeat(np.arange(len(features)), itersN)
+    rows = np.column_stack((fid, perms))
+    mae = run_permutations(_evaluate_permutations, rows, _init_shared, (arrays, config),
+                           n_jobs, chunksize=1, checkpoint=checkpoint)[:,0]
+
+    permuted_mae = mae.reshape((len(features), itersN))
+    pvalues = []
+    for k, f in enumerate(features):
+        pvalues.append(float(np.sum(mae_org > permuted_mae[k])) / itersN)
+        print f, pvalues[-1]
+    coef_names = feature_names(names, lags, exposure)
+
+    res = {'arguments': {'lags': lags, 'socialnorm': socialnorm, 'exposure': exposure,
+                         'logpop': logpop, 'logpopden': logpopden, 'itersN': itersN,
+                         'templag': templag is not None, 'selfflow': selfflow is not None,
+                         'seed': seed},
+           'mae': mae_org,
+           'coefficients': dict(zip(coef_names, np.nanmean(coefs, axis=0).tolist())),
+           'pvalues': dict(zip(features, pvalues))}
+    if fout is not None:
+        res['arrays'] = os.path.splitext(fout)[0] + '.npz'
+        np.savez(res['arrays'], features=np.array(features), permuted_mae=permuted_mae,
+                 errors=errors, coefs=coefs, coef_names=np.array(coef_names))
+        with open(fout, 'w') as f:
+            json.dump(res, f, indent=2, sort_keys=True)
+    return res
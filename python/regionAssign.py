@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Batch point-in-polygon assignment of GPS points to regions.
+
+All region assignment paths (crime records, taxi trips, POIs, houses) share
+this module. The points are given as NumPy longitude/latitude arrays, and
+the regions are the map of region ID to Tract object returned by
+Tract.createAllCAObjects() or Tract.createAllTractObjects().
+
+The points are sorted by longitude once, so each region only scans the
+points inside the longitude band of its bounding box. The remaining
+candidates are tested against the polygon in one vectorized call.
+"""
+
+import numpy as np
+from shapely.vectorized import contains
+
+
+
+def assign_regions(lon, lat, regions, missing=-1):
+    """
+    Assign each point to the region containing it.
+
+    Input:
+        lon - longitude array
+        lat - latitude array
+        regions - a map of region ID to Tract object
+        missing - the value for points outside all regions
+
+    Output:
+        an int array of region IDs, one for each point
+    """
+    lon = np.asarray(lon, dtype=float).ravel()
+    lat = np.asarray(lat, dtype=float).ravel()
+    assert lon.shape == lat.shape
+
+    order = np.argsort(lon, kind='mergesort')
+    xs = lon[order]
+    ys = lat[order]
+    ids = np.empty(len(xs), dtype=int)
+    ids.fill(missing)
+    unassigned = np.ones(len(xs), dtype=bool)
+
+    for key in sorted(regions.keys()):
+        polygon = regions[key].polygon
+        x0, y0, x1, y1 = polygon.bounds
+        lo = np.searchsorted(xs, x0, side='left')
+        hi = np.searchsorted(xs, x1, side='right')
+        if lo == hi:
+            continue
+        band = slice(lo, hi)
+        cand = np.nonzero( unassigned[band] & (ys[band] >= y0) & (ys[band] <= y1) )[0] + lo
+        if len(cand) == 0:
+            continue
+        # use the prepared polygon cached by the region layer if any
+        geom = getattr(regions[key], 'prepared', polygon)
+        inside = cand[contains(geom, xs[cand], ys[cand])]
+        ids[inside] = key
+        unassigned[inside] = False
+
+    res = np.empty_like(ids)
+    res[order] = ids
+    return res
+
+
+
+def region_index(ids, ordKey, missing=-1):
+    """
+    Map region IDs to their position in the sorted key list `ordKey`.
+    Points outside all regions keep the `missing` value.
+    """
+    ordKey = np.asarray(ordKey)
+    ids = np.asarray(ids)
+    valid = ids != missing
+    idx = np.empty(len(ids), dtype=int)
+    idx.fill(missing)
+    idx[valid] = np.searchsorted(ordKey, ids[valid])
+    return idx
+
+
+
+import unittest
+
+class _Region:
+    def __init__(self, polygon, prepared=False):
+        self.polygon = polygon
+        if prepared:
+            # as set by tract.RegionLayer
+            from shapely.prepared import prep
+            self.prepared = prep(polygon)
+
+class TestRegionAssign(unittest.TestCase):
+    
+    def setUp(self):
+        from shapely.geometry import Polygon
+        self.regions = {
+            3: _Region(Polygon([(0,0), (1,0), (1,1), (0,1)])),
+            # nonconvex L shape, its bounding box covers region 3 partly
+            7: _Region(Polygon([(1,0), (3,0), (3,2), (0.5,2), (0.5,1), (1,1)])),
+            12: _Region(Polygon([(4,4), (5,4), (4.5,5)])),
+        }
+        rng = np.random.RandomState(0)
+        self.lon = rng.uniform(-1, 6, 2000)
+        self.lat = rng.uniform(-1, 6, 2000)
+        
+    def brute_force(self, missing=-1):
+        from shapely.geometry import Point
+        res = []
+        for x, y in zip(self.lon, self.lat):
+            ids = [k for k in sorted(self.regions) if self.regions[k].polygon.contains(Point(x, y))]
+            res.append(ids[0] if ids else missing)
+        return np.array(res)
+        
+    def test_assign_regions(self):
+        ids = assign_regions(self.lon, self.lat, self.regions)
+        np.testing.assert_array_equal(ids, self.brute_force())
+        assert set(ids) == set([-1, 3, 7, 12])
+        
+    def test_prepared_regions(self):
+        regions = dict((k, _Region(r.polygon, prepared=True)) for k, r in self.regions.items())
+        ids = assign_regions(self.lon, self.lat, regions)
+        np.testing.assert_array_equal(ids, self.brute_force())
+        
+    def test_missing_value(self):
+        ids = assign_regions(self.lon, self.lat, self.regions, missing=0)
+        np.testing.assert_array_equal(ids, self.brute_force(missing=0))
+        np.testing.assert_array_equal(assign_regions([10., -5.], [10., 0.5], self.regions), [-1, -1])
+        
+    def test_region_index(self):
+        ids = np.array([12, -1, 3, 7, 3])
+        np.testing.assert_array_equal(region_index(ids, [3, 7, 12]), [2, -1, 0, 1, 0])
+            
+            
+            
+if __name__ == '__main__':
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestRegionAssign)
+    unittest.TextTestRunner(verbosity=2).run(suite)
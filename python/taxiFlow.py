@@ -10,9 +10,14 @@ Created on Mon Jan 25 16:19:18 2016
 
 
 from Crime import Tract
-from shapely.geometry import Point
-import csv
+from regionAssign import assign_regions, region_index
+from matrixCache import load_matrix, cached
 import numpy as np
+from scipy import sparse
+import pandas as pd
+import multiprocessing
+from collections import deque
+import json
 
 import os.path
 
@@ -22,7 +27,8 @@ here = os.path.dirname(os.path.abspath(__file__))
 
 
 
-def getTaxiFlow(leaveOut = -1, normalization="bydestination", gridLevel='ca', filename="/taxi-CA-static.matrix"):
+def getTaxiFlow(leaveOut = -1, normalization="bydestination", gridLevel='ca', filename="/taxi-CA-static.matrix",
+                hours=None, days=None):
     """
     Retrieve taxi flow from file
     
@@ -32,122 +38,429 @@ def getTaxiFlow(leaveOut = -1, normalization="bydestination", gridLevel='ca', fi
     ranges from 1 to 77
     
     normalization takes value "none/bydestination/bysource"
+    
+    hours, days select a time window, e.g. hours=range(18, 24) or days=[5, 6]
+    (0 is Monday). With a window, the flow is summed from the time-sliced
+    taxi tensor instead of the static matrix; None stands for all hours or
+    all days.
+    
+    The matrix is loaded from the binary cache of the text file, and the
+    result is kept in the in-process LRU of matrixCache. It is read-only.
     """
-    if gridLevel == 'ca':
-        s = np.loadtxt(here + "/taxi-CA-static.matrix", delimiter=",") #  , TF.csv
+    if hours is not None or days is not None:
+        fname = _tensor_file(gridLevel)
+        hours = tuple(range(HOURS) if hours is None else hours)
+        days = tuple(range(DAYS) if days is None else days)
+    elif gridLevel == 'ca':
+        fname = here + "/taxi-CA-static.matrix" #  , TF.csv
     elif gridLevel == 'tract':
-        s = np.loadtxt(here + "/TF_tract.csv", delimiter=",")
+        fname = here + "/TF_tract.csv"
+    key = ('taxi', leaveOut, normalization, hours, days)
+    return cached(key, fname, lambda: _load_taxi_flow(fname, leaveOut, normalization, hours, days))
+
+
+
+def _load_taxi_flow(fname, leaveOut, normalization, hours, days):
+    if hours is not None:
+        T = np.load(fname, mmap_mode='r')
+        s = np.zeros(T.shape[2:])
+        for h in hours:
+            for d in days:
+                s += T[h, d]
+    else:
+        s = np.array(load_matrix(fname))
     n = s.shape[0]
     
     for i in range(n):
         s[i,i] = 0
     
     if leaveOut > 0:
-        s = np.delete(s, leaveOut -1, 0)
-        s = np.delete(s, leaveOut -1, 1)
-        
-    n = s.shape[0]
+        keep = np.arange(n) != leaveOut - 1
+        s = s[np.ix_(keep, keep)]
     
     return taxi_flow_normalization(s, normalization)
     
 
 
-def taxi_flow_normalization(tf, method="bydestination"):
+def taxi_flow_normalization(tf, method="bydestination", debug=False):
     """
     Normalize the taxi flow matrix `tf`.
     Input:
-    tf - raw taxi flow matrix tf_ij is flow from i to j
+    tf - raw taxi flow matrix tf_ij is flow from i to j, dense or sparse
     method - choice of normalization
+    debug - check that every row of the result sums to 1 (or is all zero),
+            and raise AssertionError if not
     
     Output:
-    tf_norm - normlized taxi flow matrix, tf_norm_ij is flow from j to i
-    """
-    n = tf.shape[0]
-    tf = tf.astype(float)
-    try:
-        assert tf.dtype == "float64"
-        if method == "bydestination":
-            tf = np.transpose(tf)
-            fsum = np.sum(tf, axis=1, keepdims=True)
+    tf_norm - normlized taxi flow matrix, tf_norm_ij is flow from j to i.
+              A sparse input gives a CSR matrix.
+    """
+    if method not in ["bydestination", "bysource", "none"]:
+        raise ValueError("Normalization method {0} is not implemented.".format(method))
+    if sparse.issparse(tf):
+        tf = tf.T.tocsr() if method == "bydestination" else tf.tocsr()
+        tf = tf.astype(float)
+        if method != "none":
+            fsum = np.asarray(tf.sum(axis=1)).ravel()
             fsum[fsum==0] = 1
-            assert fsum.shape == (n,1)
-            tf = tf / fsum
-            np.testing.assert_almost_equal(tf.sum(), n)
-            np.testing.assert_almost_equal(tf.sum(axis=1)[n-1], 1)
-        elif method == "bysource":
+            tf = sparse.diags(1 / fsum).dot(tf).tocsr()
+    else:
+        tf = np.asarray(tf, dtype=float)
+        tf = tf.T.copy() if method == "bydestination" else tf.copy()
+        if method != "none":
             fsum = np.sum(tf, axis=1, keepdims=True)
             fsum[fsum==0] = 1
-            tf = tf / fsum
-            assert fsum.shape == (n,1)
-            np.testing.assert_almost_equal(tf.sum(axis=1)[n-1], 1)
-        elif method == "none":
-            pass
-        else:
-            print "Normalization method is not implemented."
-    except AssertionError as err:
-        print "taxiFlow::taxi_flow_normalization", tf.sum(), n, err
-        import sys
-        import traceback
-        _, _, tb = sys.exc_info()
-        traceback.print_tb(tb) # Fixed format
-        
+            tf /= fsum
+    if debug and method != "none":
+        rsum = np.asarray(tf.sum(axis=1)).ravel()
+        assert np.allclose(rsum[rsum != 0], 1), "taxiFlow::taxi_flow_normalization rows do not sum to 1"
     return tf
+
+
+
+def taxi_flow_normalization_loo(tf, method="bydestination", folds=None):
+    """
+    Normalize the taxi flow of all leave-one-out folds in one batch.
+    
+    The row sums are computed once for the whole matrix, and the flow of
+    the held-out region is subtracted from them in each fold.
+    
+    Input:
+    tf - raw taxi flow matrix, dense or sparse. A sparse matrix is made
+         dense, the flow among the kept regions of all folds is one dense
+         array anyway.
+    method - as taxi_flow_normalization
+    folds - the held-out regions (0 based), all regions if None
+    
+    Output:
+    Tf_loo - (folds, n-1, n-1), taxi_flow_normalization of the flow among
+             the regions kept in each fold
+    Tf_test - (folds, n-1), the normalized flow between the held-out region
+              and the kept regions, the column of tf for "bydestination"
+              and the row for "bysource" and "none"
+    """
+    if method not in ["bydestination", "bysource", "none"]:
+        raise ValueError("Normalization method {0} is not implemented.".format(method))
+    if sparse.issparse(tf):
+        tf = tf.toarray()
+    A = np.asarray(tf, dtype=float)
+    if method == "bydestination":
+        A = A.T
+    n = A.shape[0]
+    folds = np.arange(n) if folds is None else np.asarray(folds, dtype=int)
+    # index of the kept regions of each fold, shape (folds, n-1)
+    keep = np.arange(n - 1)[None] + (np.arange(n - 1)[None] >= folds[:,None])
+    
+    Tf_loo = A[keep[:,:,None], keep[:,None,:]]
+    Tf_test = A[folds[:,None], keep]
+    if method != "none":
+        rsum = A.sum(axis=1)
+        # row sums without the held-out column
+        fsum = rsum[keep] - A[keep, folds[:,None]]
+        fsum[fsum==0] = 1
+        Tf_loo /= fsum[:,:,None]
+        tsum = rsum[folds] - A[folds, folds]
+        tsum[tsum==0] = 1
+        Tf_test /= tsum[:,None]
+    return Tf_loo, Tf_test
             
 
 
 
-def generateTaxiFlow(gridLevel='ca'):
+TAXI_DIR = here + '/../data/ChicagoTaxi/'
+TENSOR_DIR = here + '/../data/taxi-tensor/'
+# column of the trip start time in the trip files
+TIME_COLUMN = 1
+HOURS = 24
+DAYS = 7
+_tracts = {}
+
+def _init_tracts():
+    tracts = Tract.createAllTractObjects()
+    _tracts['regions'] = tracts
+    _tracts['ordKey'] = sorted(tracts.keys())
+
+
+
+def _count_trips(trips):
     """
-    Generate taxi flow and write it to a file
+    Tract to tract trip counts of one chunk of trips, given as the flat
+    index sid * n + eid of the tract pairs and the count of each pair
     
-    This is slow to run
+    If the trips have a fifth column, it is the time slot hour * 7 + day of
+    week of each trip, and the flat index is (slot * n + sid) * n + eid.
     """
-    if gridLevel == 'ca':
-        cas = Tract.createAllCAObjects()
-    elif gridLevel == 'tract':
-        cas = Tract.createAllTractObjects()
-    n = len(cas)
-    TF = np.zeros((n, n))   # taxi flow matrix
+    if not _tracts:
+        _init_tracts()
+    tracts, ordKey = _tracts['regions'], _tracts['ordKey']
+    n = len(ordKey)
+    sid = region_index(assign_regions(trips[:,0], trips[:,1], tracts), ordKey)
+    eid = region_index(assign_regions(trips[:,2], trips[:,3], tracts), ordKey)
+    valid = (sid != -1) & (eid != -1)
+    flat = sid[valid] * n + eid[valid]
+    if trips.shape[1] > 4:
+        flat += trips[valid, 4].astype(np.int64) * n * n
+    flat, cnts = np.unique(flat, return_counts=True)
+    return flat, cnts, len(trips)
+
+
+
+def _read_trips(fnames, chunksize, timeCol=None):
+    for fname in fnames:
+        print "Count taxi flow in {0}".format(fname)
+        usecols = [3, 4, 5, 6] if timeCol is None else [timeCol, 3, 4, 5, 6]
+        # pandas keeps the columns in file order, whatever the usecols order
+        cols = sorted(usecols)
+        coords = [cols.index(c) for c in [3, 4, 5, 6]]
+        reader = pd.read_csv(fname, sep='\t', usecols=usecols, chunksize=chunksize)
+        for chunk in reader:
+            trips = chunk.iloc[:, coords].values.astype(float)
+            if timeCol is not None:
+                t = pd.DatetimeIndex(pd.to_datetime(chunk.iloc[:, cols.index(timeCol)]))
+                slot = np.asarray(t.hour) * DAYS + np.asarray(t.dayofweek)
+                trips = np.column_stack((trips, slot))
+            yield trips
+
+
+
+def _count_chunks(chunks, pool=None, n_jobs=1):
+    """
+    Count the trips of the chunks, in the worker pool if one is given.
+    At most 2 * n_jobs chunks are in memory.
+    """
+    if pool is None:
+        for trips in chunks:
+            yield _count_trips(trips)
+        return
+    pending = deque()
+    for trips in chunks:
+        pending.append(pool.apply_async(_count_trips, (trips,)))
+        if len(pending) >= 2 * n_jobs:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+
+def _tract_ca_index(tractKey):
+    """
+    The CA index (0 to 76) of each tract in tractKey, -1 if it has no CA
+    """
+    from CAFeature import get_Tract_CA_ref
+    TC_ref = get_Tract_CA_ref()
+    return np.array([TC_ref.get(k, 0) for k in tractKey]) - 1
+
+
+
+def generateTaxiFlow(fnames=None, n_jobs=1, chunksize=1000000):
+    """
+    Generate the taxi flow of tracts and CAs in one pass over the trip files,
+    and write them to TF_tract.csv and taxi-CA-static.matrix
+    
+    The trip files are read in chunks, and the chunks are assigned to tracts
+    by `n_jobs` worker processes. At most 2 * n_jobs chunks are in memory.
+    The CA flow is aggregated from the tract flow with the tract to CA
+    reference, the same way as CAFeature.py does.
     
-    ordKey = sorted(cas.keys())
+    Input:
+        fnames - the trip files, by default all files in ../data/ChicagoTaxi/
+    Output:
+        the tract flow matrix, the CA flow matrix
+    """
+    if fnames is None:
+        fnames = sorted(os.path.join(TAXI_DIR, fn) for fn in os.listdir(TAXI_DIR))
+    tractKey = sorted(Tract.createAllTractObjects().keys())
+    n = len(tractKey)
+    TF = np.zeros(n * n)
     
+    pool = multiprocessing.Pool(n_jobs, _init_tracts) if n_jobs > 1 else None
     cnt = 0
-#    import os
-#    fnames = os.listdir("../data/ChicagoTaxi/")
-    fnames = ['201401-03.txt']
+    for flat, cnts, ntrips in _count_chunks(_read_trips(fnames, chunksize), pool, n_jobs):
+        TF[flat] += cnts
+        cnt += ntrips
+        print "{0} trips have been added".format(cnt)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    TF = TF.reshape((n, n))
+    
+    # CA flow, M is the tract to CA indicator matrix
+    tract_ca = _tract_ca_index(tractKey)
+    M = np.zeros((n, 77))
+    valid = tract_ca >= 0
+    M[np.nonzero(valid)[0], tract_ca[valid]] = 1
+    CF = M.T.dot(TF).dot(M)
     
+    np.savetxt(here + "/TF_tract.csv", TF, delimiter="," )
+    np.savetxt(here + "/taxi-CA-static.matrix", CF, delimiter="," )
+    return TF, CF
+
+
+
+"""
+Time-sliced taxi flow
+
+The trip counts by hour of day x day of week x origin x destination are kept
+in TENSOR_DIR as the uint32 arrays taxi-tract.npy (24 x 7 x 801 x 801, about
+430MB) and taxi-ca.npy (24 x 7 x 77 x 77), which are memory-mapped on use.
+manifest.json lists the trip files that are counted in the tensors, with
+their size and mtime, so a new monthly file is added without reading the
+earlier ones again.
+"""
+
+def _tensor_file(gridLevel):
+    return os.path.join(TENSOR_DIR, 'taxi-{0}.npy'.format(gridLevel))
+
+
+
+def _reduce_counts(flat, cnts):
+    flat, inv = np.unique(np.concatenate(flat), return_inverse=True)
+    return flat, np.bincount(inv, weights=np.concatenate(cnts)).astype(np.int64)
+
+
+
+def getTaxiTensor(gridLevel='ca'):
+    """
+    The read-only, memory-mapped trip count tensor of the region level,
+    indexed by [hour, day of week, origin, destination]
+    """
+    return np.load(_tensor_file(gridLevel), mmap_mode='r')
+
+
+
+def _journal_file():
+    return os.path.join(TENSOR_DIR, 'journal.npz')
+
+
+
+def _write_journal(key, tensors, deltas):
+    """
+    Save the trip file name and the old values of the tensor entries that
+    its counts change, and sync them to disk before the tensors change
+    """
+    arrays = {'key': np.array(key)}
+    for gridLevel, f, c in deltas:
+        arrays[gridLevel + '_index'] = f
+        arrays[gridLevel + '_old'] = tensors[gridLevel].reshape(-1)[f]
+    tmp = _journal_file() + '.tmp'
+    with open(tmp, 'wb') as fout:
+        np.savez(fout, **arrays)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.rename(tmp, _journal_file())
+
+
+
+def _undo_journal(manifest, tensors):
+    """
+    Restore the old tensor values of a file whose counts were added by an
+    interrupted run, unless the file made it into the manifest
+    """
+    if not os.path.exists(_journal_file()):
+        return
+    data = np.load(_journal_file())
+    if str(data['key']) not in manifest['files']:
+        print "Undo the unfinished counts of {0}".format(data['key'])
+        for gridLevel, T in tensors.items():
+            T.reshape(-1)[data[gridLevel + '_index']] = data[gridLevel + '_old']
+            T.flush()
+    data.close()
+    os.remove(_journal_file())
+
+
+
+def appendTaxiTensor(fnames=None, n_jobs=1, chunksize=1000000, timeCol=TIME_COLUMN):
+    """
+    Add the trips of the new trip files into the time-sliced taxi tensors
+    of tracts and CAs. The files already in the manifest are skipped.
+    
+    A file is added to the manifest after its counts are written. Before
+    the counts of a file are added, the old values of the touched entries
+    are saved to journal.npz, and a run interrupted before the manifest
+    is written is undone from it at the next start. So an interrupted run
+    only counts the unfinished file again. A changed file cannot be taken
+    out of the counts, remove TENSOR_DIR to rebuild them.
+    
+    Input:
+        fnames - the trip files, by default all files in ../data/ChicagoTaxi/
+        timeCol - the column of the trip start time in the trip files
+    Output:
+        the names of the added files
+    """
+    if fnames is None:
+        fnames = sorted(os.path.join(TAXI_DIR, fn) for fn in os.listdir(TAXI_DIR))
+    manifestFile = os.path.join(TENSOR_DIR, 'manifest.json')
+    manifest = {'time_column': timeCol, 'files': {}}
+    if os.path.exists(manifestFile):
+        with open(manifestFile, 'r') as fin:
+            manifest = json.load(fin)
+    if manifest['time_column'] != timeCol:
+        raise ValueError("The taxi tensor is counted with time column {0}".format(manifest['time_column']))
+    
+    new = []
     for fname in fnames:
-        print "Count taxi flow in {0}".format(fname)
-        with open('../data/ChicagoTaxi/{0}'.format(fname), 'rU') as fin:
-            reader = csv.reader(fin, delimiter='\t' )
-            header = reader.next()
-            for row in reader:
-                # initialize points            
-                start = Point(float(row[3]), float(row[4]))
-                end = Point(float(row[5]), float(row[6]))
-                
-                sid = -1
-                eid = -1
-                for key, grid in cas.items():
-                    """
-                    grid key starts from 1
-                    map the start/end point of trip into grids to get flow
-                    """
-                    if grid.polygon.contains(start):
-                        sid = ordKey.index(key)
-                    if grid.polygon.contains(end):
-                        eid = ordKey.index(key)
-                    if sid != -1 and eid != -1:
-                        break
-                
-                TF[sid, eid] += 1
-                cnt += 1
-                if (cnt % 100000 == 0):
-                    print "{0} trips have been added".format(cnt)
-    if gridLevel == 'ca':
-        np.savetxt(here + "/TF.csv", TF, delimiter="," )
-    elif gridLevel == 'tract':
-        np.savetxt(here + "/TF_tract.csv", TF, delimiter="," )
+        st = os.stat(fname)
+        stat = [st.st_size, st.st_mtime]
+        key = os.path.basename(fname)
+        if key not in manifest['files']:
+            new.append((fname, key, stat))
+        elif manifest['files'][key] != stat:
+            raise ValueError("{0} has changed since it was added to the taxi tensor".format(fname))
+    if not new:
+        return []
+    
+    tractKey = sorted(Tract.createAllTractObjects().keys())
+    n = len(tractKey)
+    tract_ca = _tract_ca_index(tractKey)
+    if not os.path.exists(TENSOR_DIR):
+        os.makedirs(TENSOR_DIR)
+    tensors = {}
+    for gridLevel, m in [('tract', n), ('ca', 77)]:
+        fname = _tensor_file(gridLevel)
+        if os.path.exists(fname):
+            tensors[gridLevel] = np.load(fname, mmap_mode='r+')
+        else:
+            tensors[gridLevel] = np.lib.format.open_memmap(fname, mode='w+', dtype=np.uint32,
+                                                           shape=(HOURS, DAYS, m, m))
+    _undo_journal(manifest, tensors)
+    
+    pool = multiprocessing.Pool(n_jobs, _init_tracts) if n_jobs > 1 else None
+    for fname, key, stat in new:
+        flat, cnts = [], []
+        cnt = 0
+        for f, c, ntrips in _count_chunks(_read_trips([fname], chunksize, timeCol), pool, n_jobs):
+            flat.append(f)
+            cnts.append(c)
+            cnt += ntrips
+            print "{0} trips have been added".format(cnt)
+        if not flat:
+            flat, cnts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        flat, cnts = _reduce_counts(flat, cnts)
+        
+        # CA counts from the tract counts
+        slot, pair = np.divmod(flat, n * n)
+        sca, eca = tract_ca[pair // n], tract_ca[pair % n]
+        valid = (sca >= 0) & (eca >= 0)
+        ca_flat, ca_cnts = _reduce_counts([(slot[valid] * 77 + sca[valid]) * 77 + eca[valid]],
+                                          [cnts[valid]])
+        
+        deltas = [('tract', flat, cnts), ('ca', ca_flat, ca_cnts)]
+        _write_journal(key, tensors, deltas)
+        for gridLevel, f, c in deltas:
+            T = tensors[gridLevel].reshape(-1)
+            T[f] += c.astype(np.uint32)
+            tensors[gridLevel].flush()
+        
+        manifest['files'][key] = stat
+        tmp = manifestFile + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump(manifest, fout, indent=2, sort_keys=True)
+        os.rename(tmp, manifestFile)
+        os.remove(_journal_file())
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return [key for fname, key, stat in new]
 
 
 
@@ -164,11 +477,70 @@ def generate_graph_embedding_src():
             
 
 
+
+import unittest
+
+class TestTaxiFlowNormalization(unittest.TestCase):
+    
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.tf = rng.poisson(3, size=(7, 7)).astype(float)
+        # a region without outflow and one without inflow
+        self.tf[2,:] = 0
+        self.tf[:,5] = 0
+        
+    def reference(self, tf, method, f):
+        keep = np.arange(len(tf)) != f
+        loo = taxi_flow_normalization(tf[keep][:,keep], method)
+        test = tf[keep,f] if method == "bydestination" else tf[f,keep]
+        if method != "none" and test.sum() > 0:
+            test = test / test.sum()
+        return loo, test
+        
+    def test_loo_against_folds(self):
+        for method in ["bydestination", "bysource", "none"]:
+            for tf in [self.tf, sparse.csr_matrix(self.tf)]:
+                Tf_loo, Tf_test = taxi_flow_normalization_loo(tf, method)
+                assert Tf_loo.shape == (7, 6, 6) and Tf_test.shape == (7, 6)
+                for f in range(7):
+                    loo, test = self.reference(self.tf, method, f)
+                    np.testing.assert_allclose(Tf_loo[f], loo)
+                    np.testing.assert_allclose(Tf_test[f], test)
+                    
+    def test_selected_folds(self):
+        Tf_loo, Tf_test = taxi_flow_normalization_loo(self.tf, "bysource", folds=[5, 2])
+        for k, f in enumerate([5, 2]):
+            loo, test = self.reference(self.tf, "bysource", f)
+            np.testing.assert_allclose(Tf_loo[k], loo)
+            np.testing.assert_allclose(Tf_test[k], test)
+        
+    def test_sparse_normalization(self):
+        for method in ["bydestination", "bysource", "none"]:
+            res = taxi_flow_normalization(sparse.csr_matrix(self.tf), method, debug=True)
+            assert sparse.isspmatrix_csr(res)
+            np.testing.assert_allclose(res.toarray(), taxi_flow_normalization(self.tf, method, debug=True))
+        
+    def test_errors(self):
+        self.assertRaises(ValueError, taxi_flow_normalization, self.tf, "bycount")
+        self.assertRaises(ValueError, taxi_flow_normalization_loo, self.tf, "bycount")
+        # a finite row always sums to 1 or 0, an infinite flow does not
+        tf = self.tf.copy()
+        tf[0,1] = np.inf
+        self.assertRaises(AssertionError, taxi_flow_normalization, tf, "bysource", debug=True)
+            
+
+
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) == 2 and sys.argv[1] == 'generateTaxiFlow':
+    if len(sys.argv) == 2 and sys.argv[1] == 'test':
+        suite = unittest.TestLoader().loadTestsFromTestCase(TestTaxiFlowNormalization)
+        unittest.TextTestRunner(verbosity=2).run(suite)
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'generateTaxiFlow':
         print "Generate taxi flow"
-        generateTaxiFlow()
+        generateTaxiFlow(sys.argv[2:] or None, n_jobs=multiprocessing.cpu_count())
+    elif len(sys.argv) >= 2 and sys.argv[1] == 'appendTaxiTensor':
+        print "Add trip files to the time-sliced taxi tensor"
+        appendTaxiTensor(sys.argv[2:] or None, n_jobs=multiprocessing.cpu_count())
     elif len(sys.argv) == 2 and sys.argv[1] == 'graphEmbedding':
         print "Generate graph embedding source"
         generate_graph_embedding_src()
@@ -9,6 +9,7 @@ Created on Sun Dec 18 16:33:22 2016
 import matplotlib.pyplot as plt
 import numpy as np
 from shapely.geometry import Polygon, box
+from shapely.prepared import prep
 import shapefile
 import os
 here = os.path.dirname(os.path.abspath(__file__))
@@ -27,6 +28,24 @@ class Tract:
         self.timeHist = {'total': np.zeros(24)}
         if rec != None:
             self.CA = rec[7]
+            
+            
+    @classmethod
+    def fromLayer( cls, layer, key ):
+        """
+        Build one Tract object sharing the cached geometry of a RegionLayer
+        
+        The crime counters are fresh for every object.
+        """
+        trt = cls.__new__(cls)
+        trt.bbox = layer.bbox[key]
+        trt.polygon = layer.polygon[key]
+        trt.prepared = layer.prepared[key]
+        trt.count = {'total': 0}
+        trt.timeHist = {'total': np.zeros(24)}
+        if key in layer.CA:
+            trt.CA = layer.CA[key]
+        return trt
         
         
     
@@ -63,15 +82,10 @@ class Tract:
         
     @classmethod
     def createAllTractObjects( cls ):
-        cls.sf = shapefile.Reader(here + '/../data/Census-Tracts-2010/chicago-tract')
+        layer = getRegionLayer('tract')
         cls.tracts = {}
-        
-        shps = cls.sf.shapes()
-        for idx, shp in enumerate(shps):
-            rec = cls.sf.record(idx)
-            tid = int(rec[2])
-            trt = Tract(shp, rec)
-            cls.tracts[tid] = trt
+        for tid in layer.ids:
+            cls.tracts[tid] = Tract.fromLayer(layer, tid)
         
         return cls.tracts
             
@@ -80,14 +94,10 @@ class Tract:
             
     @classmethod
     def createAllCAObjects( cls ):
-        cls.casf = shapefile.Reader(here + '/../data/ChiCA_gps/ChiCaGPS')
+        layer = getRegionLayer('ca')
         cls.cas = {}
-        
-        shps = cls.casf.shapes()
-        for idx, shp in enumerate(shps):
-            tid = cls.casf.record(idx)[4]
-            trt = Tract(shp)
-            cls.cas[int(tid)] = trt
+        for tid in layer.ids:
+            cls.cas[tid] = Tract.fromLayer(layer, tid)
             
         return cls.cas
 
@@ -131,7 +141,114 @@ class Tract:
         plt.tight_layout()
         plt.savefig("case-region-on-map.pdf")
 #        plt.show()
+
+
+
+
+"""
+Shapefile of each region layer, the record field of region ID, and the
+record field of CA (tract layer only)
+"""
+LAYER_SHAPEFILES = {
+    'tract': (here + '/../data/Census-Tracts-2010/chicago-tract', 2, 7),
+    'ca': (here + '/../data/ChiCA_gps/ChiCaGPS', 4, None)
+}
+
+
+
+class RegionLayer:
+    """
+    The geometry of one region layer ('ca' or 'tract').
+    
+    Polygons, bounding boxes, prepared polygons and centroids are computed
+    once. The layer can be saved to a binary sidecar file next to the
+    shapefile, so that a cold start skips the shapefile parsing too.
+    """
+    
+    def __init__( self, ids, polygons, CA=None ):
+        """
+        Input:
+            ids - region IDs
+            polygons - shapely polygons in the same order as ids
+            CA - a map of tract ID to CA field, for the tract layer
+        """
+        order = np.argsort(ids, kind='mergesort')
+        self.ids = [ids[i] for i in order]
+        self.polygon = dict(zip(ids, polygons))
+        self.CA = CA if CA is not None else {}
+        self.bbox = {}
+        self.prepared = {}
+        for k in self.ids:
+            self.bbox[k] = box(*self.polygon[k].bounds)
+            self.prepared[k] = prep(self.polygon[k])
+        self.bounds = np.array([self.polygon[k].bounds for k in self.ids])
+        self.centroids = np.array([self.polygon[k].centroid.coords[0] for k in self.ids])
+        
+        
+    @classmethod
+    def fromShapefile( cls, fname, idField, caField=None ):
+        sf = shapefile.Reader(fname)
+        ids = []
+        polygons = []
+        CA = {}
+        for idx, shp in enumerate(sf.shapes()):
+            rec = sf.record(idx)
+            rid = int(rec[idField])
+            ids.append(rid)
+            polygons.append(Polygon(shp.points))
+            if caField is not None:
+                CA[rid] = rec[caField]
+        return cls(ids, polygons, CA)
         
+        
+    def save( self, fname, srcMtime ):
+        from shapely import wkb
+        import pickle
+        with open(fname, 'wb') as fout:
+            pickle.dump((srcMtime, self.ids, [wkb.dumps(self.polygon[k]) for k in self.ids], self.CA),
+                        fout, pickle.HIGHEST_PROTOCOL)
+            
+            
+    @classmethod
+    def load( cls, fname, srcMtime ):
+        """
+        Load the layer from the sidecar file. Return None if the sidecar is
+        missing or older than the shapefile.
+        """
+        from shapely import wkb
+        import pickle
+        if not os.path.exists(fname):
+            return None
+        with open(fname, 'rb') as fin:
+            mtime, ids, polygons, CA = pickle.load(fin)
+        if mtime != srcMtime:
+            return None
+        return cls(ids, [wkb.loads(p) for p in polygons], CA)
+
+
+
+_layers = {}
+
+def getRegionLayer( layer, persist=True ):
+    """
+    Get the RegionLayer of 'ca' or 'tract', loaded once per process.
+    
+    If persist is True, the parsed layer is saved to a sidecar file
+    {shapefile}.layer.pickle, which is reused until the shapefile changes.
+    """
+    if layer not in _layers:
+        fname, idField, caField = LAYER_SHAPEFILES[layer]
+        srcMtime = os.path.getmtime(fname + '.shp')
+        sidecar = fname + '.layer.pickle'
+        rl = RegionLayer.load(sidecar, srcMtime)
+        if rl is None:
+            rl = RegionLayer.fromShapefile(fname, idField, caField)
+            if persist:
+                rl.save(sidecar, srcMtime)
+        _layers[layer] = rl
+    return _layers[layer]
+
+
 
 
 def plotCA_cases():